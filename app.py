@@ -3,22 +3,54 @@ DeepSeek-OCR Web API Service
 基于 FastAPI 的 OCR 服务
 """
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from transformers import AutoModel, AutoTokenizer
-import torch
 import os
 import uuid
 from pathlib import Path
 import logging
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, Union, Tuple, Callable
 import base64
+import binascii
+import email.utils
+import gzip
+import io
+import json
+import re
+import ast
+import itertools
+import math
+import mimetypes
+import hashlib
+import shutil
 import sys
-from io import StringIO, BytesIO
+import zipfile
 import contextlib
-import fitz  # PyMuPDF
-from PIL import Image
+import asyncio
+import atexit
+import gc
+import multiprocessing
+import queue
+import random
+import signal
+import threading
+import time
+import types
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from pydantic import BaseModel, ValidationError
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+import aiofiles
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖：未安装时不接受 zstd 压缩的请求体
+    zstandard = None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -30,29 +62,205 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# 配置 CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # 全局变量
 model = None
 tokenizer = None
 MODEL_LOADED = False
+# 启动各阶段耗时（秒）：imports / tokenizer / weights / device_move / warmup / total
+STARTUP_TIMINGS: Dict[str, float] = {}
+# 服务状态：loading（加载模型）/ warming（预热）/ ready（可接收流量）/ failed（加载失败）
+MODEL_STATE = "loading"
+# 各模式的预热耗时（秒）
+WARMUP_SECONDS: Dict[str, float] = {}
 
 # 配置
 CUDA_DEVICE = os.getenv("CUDA_VISIBLE_DEVICES", "0")
 MODEL_PATH = os.getenv("MODEL_PATH", "/models/DeepSeek-OCR")
 UPLOAD_DIR = Path("./uploads")
 OUTPUT_DIR = Path("./outputs")
+DEFAULT_PROMPT = "<image>\n<|grounding|>Convert the document to markdown."
+PAGE_SPLIT = "\n\n<--- Page Split --->\n\n"
+# infer() 要求的输出目录（eval_mode 下不会写入结果文件）
+INFER_SCRATCH_DIR = OUTPUT_DIR / ".infer"
+# 内存中保留的已结束任务数量上限（超出后淘汰最早结束的任务）
+JOB_HISTORY_LIMIT = int(os.getenv("JOB_HISTORY_LIMIT", "1000"))
+# 动态微批：单批最多页数、收集窗口（毫秒）
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+# 快速加载：权重按目标精度从内存映射的 safetensors 直接加载到目标设备（失败时回退到逐步加载）
+MODEL_FAST_LOAD = os.getenv("MODEL_FAST_LOAD", "true").lower() in ("1", "true", "yes")
+# 启动预热的模式（逗号分隔的模式名，all 表示全部，none 表示不预热）
+WARMUP_MODES = os.getenv("WARMUP_MODES", "all")
+# 推理进程数：大于 1 时 fork 多个共享模型权重（写时复制）的推理进程，仅 CPU 模式有效
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+# 每个推理进程的 torch 线程数（默认平分 CPU 核数）
+INFERENCE_THREADS_PER_WORKER = int(os.getenv("INFERENCE_THREADS_PER_WORKER", "0")) or \
+    max(1, (os.cpu_count() or 1) // max(1, INFERENCE_WORKERS))
+# 推理后端：hf（transformers model.infer）、vllm（AsyncLLMEngine 连续批处理）或 fake（确定性的 CPU 假模型，用于压测）
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "hf").lower()
+# vLLM 后端：识别模式（整个进程固定一种）、同时解码的序列数上限、显存占用比例、最大上下文长度、最多切片数
+VLLM_MODE = os.getenv("VLLM_MODE", "Gundam")
+VLLM_MAX_NUM_SEQS = int(os.getenv("VLLM_MAX_NUM_SEQS", "100"))
+VLLM_GPU_MEMORY_UTILIZATION = float(os.getenv("VLLM_GPU_MEMORY_UTILIZATION", "0.75"))
+VLLM_MAX_MODEL_LEN = int(os.getenv("VLLM_MAX_MODEL_LEN", "8192"))
+VLLM_MAX_CROPS = int(os.getenv("VLLM_MAX_CROPS", "6"))
+# vLLM 实现（DeepseekOCRForCausalLM / DeepseekOCRProcessor）所在目录
+VLLM_CODE_DIR = Path(os.getenv("VLLM_CODE_DIR", str(Path(__file__).parent / "DeepSeek-OCR-master" / "DeepSeek-OCR-vllm")))
+# fake 后端（确定性的 CPU 假模型）：每个视觉 token 的预填充耗时、每个输出 token 的解码耗时（毫秒）、每页输出 token 数
+FAKE_VISION_TOKEN_MS = float(os.getenv("FAKE_VISION_TOKEN_MS", "0.05"))
+FAKE_OUTPUT_TOKEN_MS = float(os.getenv("FAKE_OUTPUT_TOKEN_MS", "2"))
+FAKE_OUTPUT_TOKENS = int(os.getenv("FAKE_OUTPUT_TOKENS", "200"))
+# 单个文档同时提交推理的页数（0 表示按推理后端自动选择：单线程 1、多进程为进程数、vLLM 为 VLLM_MAX_NUM_SEQS）
+PAGE_CONCURRENCY = int(os.getenv("PAGE_CONCURRENCY", "0"))
+# 是否把 PDF 渲染出的页面图片保存到 outputs/{task_id}/pages/（默认只在内存中处理）
+SAVE_PDF_PAGES = os.getenv("SAVE_PDF_PAGES", "false").lower() in ("1", "true", "yes")
+# PDF 预取深度：渲染线程最多领先 OCR 循环的页数
+PDF_PREFETCH_PAGES = int(os.getenv("PDF_PREFETCH_PAGES", "2"))
+# OCR 结果缓存：内存 LRU 条目数、磁盘目录及容量上限（MB）
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESULT_CACHE_DIR = Path(os.getenv("RESULT_CACHE_DIR", "./cache/results"))
+RESULT_CACHE_MEMORY_ENTRIES = int(os.getenv("RESULT_CACHE_MEMORY_ENTRIES", "256"))
+RESULT_CACHE_DISK_MB = int(os.getenv("RESULT_CACHE_DISK_MB", "1024"))
+# 模型版本（参与缓存键；默认使用 MODEL_PATH 和模型配置中的 commit hash）
+MODEL_REVISION = os.getenv("MODEL_REVISION")
+# 文件保留：uploads/ 与 outputs/ 的保留期（小时）、总容量上限（GB，0 表示不限）、清理间隔（秒）
+RETENTION_TTL_HOURS = float(os.getenv("RETENTION_TTL_HOURS", "0"))
+RETENTION_MAX_GB = float(os.getenv("RETENTION_MAX_GB", "0"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "600"))
+# 上传：请求体大小上限（MB，压缩的请求体按解压后计算）、分块写盘的块大小（KB）
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "512"))
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+# 准入控制：同时处理（含排队）的请求数上限、待识别页数上限（0 表示不限）
+ADMISSION_MAX_REQUESTS = int(os.getenv("ADMISSION_MAX_REQUESTS", "32"))
+ADMISSION_MAX_PAGES = int(os.getenv("ADMISSION_MAX_PAGES", "1000"))
+# 下载：不小于该大小（字节）的文本结果在任务完成时额外生成 .gz / .zst 预压缩副本
+DOWNLOAD_COMPRESS_MIN_BYTES = int(os.getenv("DOWNLOAD_COMPRESS_MIN_BYTES", "1024"))
+# 等待识别结果期间检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+# /ocr/batch：单次请求最多文件数（含 ZIP 内的条目）、同时解压并识别的文件数
+OCR_BATCH_MAX_ITEMS = int(os.getenv("OCR_BATCH_MAX_ITEMS", "1000"))
+OCR_BATCH_CONCURRENCY = int(os.getenv("OCR_BATCH_CONCURRENCY", str(BATCH_MAX_SIZE * 2)))
 
 # 创建必要的目录
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
+INFER_SCRATCH_DIR.mkdir(exist_ok=True)
+
+# 监控指标
+BATCH_SIZE = Histogram(
+    "ocr_batch_size",
+    "一次送进模型生成的页数（批量生成的批大小）",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+BATCH_FALLBACKS = Counter(
+    "ocr_batch_fallbacks_total",
+    "批量生成失败、改为逐页推理的批数",
+    ["reason"]  # unsupported: 模型代码不支持批量生成，之后不再尝试 / error: 本批出错（如显存不足），只有本批逐页推理
+)
+BATCH_QUEUE_WAIT_SECONDS = Histogram(
+    "ocr_batch_queue_wait_seconds",
+    "页面从提交到开始推理的排队时间（秒）",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+STAGE_SECONDS = Histogram(
+    "ocr_stage_duration_seconds",
+    "各处理阶段耗时（秒）",
+    ["stage", "mode", "file_type"],  # stage: upload / rasterize / preprocess / inference / extract / write
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+PAGES_TOTAL = Counter(
+    "ocr_pages_total",
+    "处理的页数",
+    ["mode", "file_type", "source"]  # source: model / cache
+)
+CHARACTERS_TOTAL = Counter(
+    "ocr_characters_total",
+    "识别输出的字符数",
+    ["mode", "file_type"]
+)
+ERRORS_TOTAL = Counter(
+    "ocr_errors_total",
+    "处理失败的请求数（不含 4xx）",
+    ["mode", "file_type"]
+)
+INFLIGHT_REQUESTS = Gauge(
+    "ocr_inflight_requests",
+    "正在处理的 OCR 请求数（含异步任务）",
+    ["mode", "file_type"]
+)
+MODEL_LOADED_GAUGE = Gauge(
+    "ocr_model_loaded",
+    "模型是否已加载（1/0）"
+)
+WARMUP_SECONDS_GAUGE = Gauge(
+    "ocr_warmup_seconds",
+    "启动预热时各模式的推理耗时（秒）",
+    ["mode"]
+)
+ADMISSION_QUEUE_REQUESTS = Gauge(
+    "ocr_admission_queue_requests",
+    "已准入、尚未完成的请求数"
+)
+ADMISSION_QUEUE_PAGES = Gauge(
+    "ocr_admission_queue_pages",
+    "已准入请求中尚未识别的页数"
+)
+ADMISSION_REJECTIONS = Counter(
+    "ocr_admission_rejections_total",
+    "因队列已满返回 429 的请求数",
+    ["reason"]  # requests / pages
+)
+REQUESTS_COALESCED = Counter(
+    "ocr_requests_coalesced_total",
+    "复用已有任务、未重新识别的请求数",
+    ["reason"]  # inflight: 合并到进行中的相同请求 / idempotency: 相同 Idempotency-Key 的重试
+)
+STREAM_FIRST_TOKEN_SECONDS = Histogram(
+    "ocr_stream_first_token_seconds",
+    "/ocr/stream 从收到图片到推送第一段文本的耗时（秒）",
+    ["mode"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2, 5, 10, 30)
+)
+PAGES_CANCELLED = Counter(
+    "ocr_pages_cancelled_total",
+    "因客户端断开或超过截止时间而取消、未完成识别的页数",
+    ["mode", "file_type", "reason"]  # reason: disconnect / deadline
+)
+CANCELLED_COMPUTE_SECONDS = Counter(
+    "ocr_cancelled_compute_saved_seconds_total",
+    "取消的页面按每页平均推理耗时估算节省的推理时间（秒）",
+    ["mode", "file_type", "reason"]
+)
+RESULT_CACHE_REQUESTS = Counter(
+    "ocr_result_cache_requests_total",
+    "结果缓存查询次数",
+    ["level", "result"]  # level: document / page；result: hit_memory / hit_disk / miss
+)
+RESULT_CACHE_EVICTIONS = Counter(
+    "ocr_result_cache_evictions_total",
+    "结果缓存淘汰的条目数",
+    ["tier"]  # memory / disk
+)
+RETENTION_RECLAIMED_BYTES = Counter(
+    "ocr_retention_reclaimed_bytes_total",
+    "文件保留清理回收的字节数",
+    ["reason"]  # ttl / quota / orphan
+)
+RETENTION_RECLAIMED_ENTRIES = Counter(
+    "ocr_retention_reclaimed_entries_total",
+    "文件保留清理删除的条目数",
+    ["reason"]
+)
+STORAGE_BYTES = Gauge(
+    "ocr_storage_bytes",
+    "uploads/ 与 outputs/ 的磁盘占用（字节，每次清理时更新）",
+    ["dir"]
+)
+RESULT_CACHE_DISK_BYTES = Gauge(
+    "ocr_result_cache_disk_bytes",
+    "结果缓存磁盘占用（字节）"
+)
 
 
 def is_pdf(file_path: str) -> bool:
@@ -65,184 +273,3308 @@ def is_pdf(file_path: str) -> bool:
         return False
 
 
-def pdf_to_images(pdf_path: str, dpi: int = 144) -> List[str]:
+# 文件头魔数 -> 扩展名
+FILE_SIGNATURES = (
+    (b"%PDF-", ".pdf"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"BM", ".bmp"),
+    (b"II*\x00", ".tiff"),
+    (b"MM\x00*", ".tiff"),
+)
+
+
+def sniff_file_type(data: bytes) -> Optional[str]:
+    """根据文件头识别文件类型，返回扩展名（如 ".pdf"、".png"），无法识别时返回 None"""
+    for signature, ext in FILE_SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+class PageRangeError(ValueError):
+    """页码范围参数不合法"""
+
+
+PAGE_RANGE_PATTERN = re.compile(r"^(-?\d+)(-(-?\d+)?)?$")
+
+
+def parse_page_spec(spec: str) -> List[Tuple[int, int]]:
     """
-    将 PDF 转换为图片
+    解析页码范围参数（只检查语法，不依赖总页数）
 
-    Args:
-        pdf_path: PDF 文件路径
-        dpi: 图片 DPI（默认 144，即 2x 缩放）
+    格式为逗号分隔的页码或范围，页码从 1 开始，负数表示倒数第几页:
+    "1-3,10,-1" -> 第 1~3 页、第 10 页和最后一页；"5-" -> 第 5 页到最后一页
+
+    Returns:
+        list: [(起始页, 结束页)]，负数尚未换算
+    """
+    ranges = []
+    for token in spec.replace(" ", "").split(","):
+        match = PAGE_RANGE_PATTERN.match(token)
+        if not match:
+            raise PageRangeError(f"无法解析的页码范围: {token!r}（示例: 1-3,10,-1）")
+        start = int(match.group(1))
+        end = int(match.group(3)) if match.group(3) else (-1 if match.group(2) else start)
+        if start == 0 or end == 0:
+            raise PageRangeError("页码从 1 开始（负数表示倒数第几页）")
+        ranges.append((start, end))
+    return ranges
+
+
+def select_pages(spec: str, page_count: int) -> List[int]:
+    """按页码范围参数选出要处理的页码（从 1 开始、升序、去重）"""
+    selected = set()
+    for start, end in parse_page_spec(spec):
+        first = start if start > 0 else page_count + 1 + start
+        last = end if end > 0 else page_count + 1 + end
+        if not (1 <= first <= page_count and 1 <= last <= page_count):
+            raise PageRangeError(f"页码超出范围: {start}-{end}（共 {page_count} 页）" if start != end
+                                 else f"页码超出范围: {start}（共 {page_count} 页）")
+        if first > last:
+            raise PageRangeError(f"页码范围起始页大于结束页: {start}-{end}")
+        selected.update(range(first, last + 1))
+    return sorted(selected)
+
+
+def render_pdf_page(page, zoom: float) -> tuple:
+    """
+    将 PDF 单页渲染为 PIL 图片
+
+    直接用 pixmap 的原始像素构造图片，不经过 PNG 编码/解码。
 
     Returns:
-        List[str]: 生成的图片路径列表
+        tuple: (图片, 像素内容的哈希)，哈希用于页面级结果缓存
+    """
+    import fitz  # PyMuPDF（延迟导入，缩短服务启动时间）
+
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    digest = hashlib.blake2b(pix.samples_mv, digest_size=20)
+    digest.update(f"{pix.width}x{pix.height}".encode())
+    # RGB 像素在 PIL 内部按 4 字节存储，这里只做一次拷贝
+    image = Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1)
+    return image, digest.hexdigest()
+
+
+class PdfPageStream:
+    """
+    后台渲染 PDF 页面（生产者-消费者）
+
+    渲染线程按页序把图片放入有界预取队列，OCR 循环逐页取出；指定 page_spec 时只渲染选中的页面。
+    队列中最多有 prefetch 页已渲染但尚未取走，因此第 N 页推理时第 N+1 页已在渲染或已就绪，
+    内存中也不会同时持有整个文档的页面。
+
+    用法:
+        stream = PdfPageStream(pdf_path)  # 或 PdfPageStream(pdf_bytes)
+        await stream.open()
+        try:
+            async for page_num, image in stream.pages():
+                ...
+        finally:
+            await stream.close()
+    """
+
+    def __init__(self, source: Union[str, bytes], dpi: int = 144, save_dir: Optional[str] = None, prefetch: int = 2,
+                 page_spec: Optional[str] = None):
+        # 文件路径，或内存中的 PDF 内容
+        self.source = source
+        self.page_spec = page_spec
+        # 要渲染的页码（open 后确定）
+        self.selected_pages: List[int] = []
+        self.zoom = dpi / 72.0
+        self.save_dir = save_dir
+        self.page_count = 0
+        # 页码 -> 渲染结果的像素哈希
+        self.page_hashes: Dict[int, str] = {}
+        # 页码 -> 渲染耗时（秒）
+        self.render_seconds: Dict[int, float] = {}
+        self._slots = threading.Semaphore(max(1, prefetch))
+        self._stop = threading.Event()
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._doc = None
+        self._thread: Optional[threading.Thread] = None
+
+    async def open(self) -> int:
+        """打开 PDF 并启动渲染线程，返回文档总页数（页码范围不合法时抛出 PageRangeError）"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        import fitz
+
+        if isinstance(self.source, bytes):
+            self._doc = await asyncio.to_thread(fitz.open, stream=self.source, filetype="pdf")
+        else:
+            self._doc = await asyncio.to_thread(fitz.open, self.source)
+        self.page_count = self._doc.page_count
+        try:
+            self.selected_pages = (select_pages(self.page_spec, self.page_count) if self.page_spec
+                                   else list(range(1, self.page_count + 1)))
+        except PageRangeError:
+            self._doc.close()
+            self._doc = None
+            raise
+        self._thread = threading.Thread(target=self._produce, name="pdf-rasterizer", daemon=True)
+        self._thread.start()
+        return self.page_count
+
+    async def close(self):
+        """停止渲染线程并关闭 PDF（提前结束时未渲染的页面不再渲染）"""
+        self._stop.set()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+        elif self._doc is not None:
+            self._doc.close()
+
+    async def pages(self):
+        """按页序产出 (页码, 图片)，页码从 1 开始"""
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            page_num, image, error = item
+            if error is not None:
+                raise RuntimeError(f"PDF 第 {page_num} 页转换失败: {error}")
+            self._slots.release()
+            yield page_num, image
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def _produce(self):
+        page_num = 0
+        try:
+            for page_num in self.selected_pages:
+                # 等待预取队列有空位
+                while not self._slots.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        return
+                if self._stop.is_set():
+                    return
+
+                render_start = time.perf_counter()
+                img, page_hash = render_pdf_page(self._doc[page_num - 1], self.zoom)
+                self.render_seconds[page_num] = time.perf_counter() - render_start
+                self.page_hashes[page_num] = page_hash
+                if self.save_dir is not None:
+                    os.makedirs(self.save_dir, exist_ok=True)
+                    img.save(Path(self.save_dir) / f"page_{page_num}.png")
+
+                logger.info(f"PDF 第 {page_num}/{self.page_count} 页已转换: {img.width}x{img.height}")
+                self._put((page_num, img, None))
+        except Exception as e:
+            self._put((page_num, None, e))
+        finally:
+            self._doc.close()
+            self._put(None)
+
+
+# 内存图片：infer() 只接受图片路径，这里用 "memory://<id>" 伪路径把 PIL 图片直接交给模型
+MEMORY_IMAGE_SCHEME = "memory://"
+_MEMORY_IMAGES: Dict[str, Image.Image] = {}
+_MEMORY_LOADER_INSTALLED = False
+
+
+def install_memory_image_loader(model) -> bool:
     """
-    image_paths = []
-    pdf_doc = fitz.open(pdf_path)
+    让模型代码中的 load_image 能识别内存图片的伪路径
 
-    # 计算缩放比例
-    zoom = dpi / 72.0
-    mat = fitz.Matrix(zoom, zoom)
+    DeepSeek-OCR 的 infer() 通过模型模块里的 load_image(path) 读取图片，
+    这里把它包装一层：伪路径返回已登记的 PIL 图片，其他路径仍交给原函数。
 
-    # 为每一页创建图片
-    for page_num in range(pdf_doc.page_count):
-        page = pdf_doc[page_num]
-        pix = page.get_pixmap(matrix=mat, alpha=False)
+    Returns:
+        bool: 是否安装成功（模型代码中没有 load_image 时返回 False，内存图片会先写临时文件）
+    """
+    global _MEMORY_LOADER_INSTALLED
 
-        # 转换为 PIL Image
-        img_data = pix.tobytes("png")
-        img = Image.open(BytesIO(img_data))
+    module = sys.modules.get(type(model).__module__)
+    original = getattr(module, "load_image", None)
+    if original is None:
+        logger.warning("模型代码中未找到 load_image，内存图片将通过临时文件传给模型")
+        return False
 
-        # 保存图片
-        base_name = Path(pdf_path).stem
-        image_path = str(Path(pdf_path).parent / f"{base_name}_page_{page_num + 1}.png")
-        img.save(image_path)
-        image_paths.append(image_path)
+    if not getattr(original, "_memory_aware", False):
+        def load_image(image_path):
+            image = _MEMORY_IMAGES.get(str(image_path))
+            return image if image is not None else original(image_path)
 
-        logger.info(f"PDF 第 {page_num + 1}/{pdf_doc.page_count} 页已转换: {img.width}x{img.height}")
+        load_image._memory_aware = True
+        module.load_image = load_image
 
-    pdf_doc.close()
-    return image_paths
+    _MEMORY_LOADER_INSTALLED = True
+    return True
 
 
 @contextlib.contextmanager
-def capture_stdout():
-    """捕获标准输出"""
-    old_stdout = sys.stdout
-    sys.stdout = captured_output = StringIO()
-    try:
-        yield captured_output
-    finally:
-        sys.stdout = old_stdout
+def image_source(image: Union[str, Image.Image]):
+    """
+    把图片转换为可以传给 infer() 的路径
+
+    路径原样返回；PIL 图片登记为内存伪路径，未安装内存加载器时退回写临时 PNG。
+    """
+    if not isinstance(image, Image.Image):
+        yield str(image)
+        return
+
+    key = f"{MEMORY_IMAGE_SCHEME}{uuid.uuid4()}"
+    if _MEMORY_LOADER_INSTALLED:
+        _MEMORY_IMAGES[key] = image
+        try:
+            yield key
+        finally:
+            _MEMORY_IMAGES.pop(key, None)
+    else:
+        temp_path = UPLOAD_DIR / f"{uuid.uuid4()}.png"
+        image.save(temp_path)
+        try:
+            yield str(temp_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+
+# grounding 标记：<|ref|>标签<|/ref|><|det|>[[x1, y1, x2, y2], ...]<|/det|>，坐标归一化到 0-999
+GROUNDING_PATTERN = re.compile(r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)', re.DOTALL)
+# 可视化图片中标注框的颜色
+BOX_COLORS = [(220, 50, 47), (38, 139, 210), (133, 153, 0), (211, 54, 130), (42, 161, 152), (181, 137, 0), (108, 113, 196)]
+
+
+@dataclass
+class OCRResult:
+    """单页推理结果"""
+    text: str  # 模型原始输出（包含 grounding 标记）
+    image_size: tuple  # 输入图片尺寸 (width, height)
+    output_tokens: int = 0  # 输出文本的 token 数
+    vision_tokens: int = 0  # 视觉 token 数（按模式估算的名义值）
+    blocks: List[Dict[str, Any]] = field(default_factory=list)  # grounding 区块
+    timings: Dict[str, float] = field(default_factory=dict)  # 各阶段耗时（秒），不写入缓存
+
+    def to_dict(self) -> dict:
+        """序列化（用于结果缓存，grounding 区块可由文本重新解析）"""
+        return {
+            "text": self.text,
+            "image_size": list(self.image_size),
+            "output_tokens": self.output_tokens,
+            "vision_tokens": self.vision_tokens
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OCRResult":
+        return cls(
+            text=data["text"],
+            image_size=tuple(data["image_size"]),
+            output_tokens=data.get("output_tokens", 0),
+            vision_tokens=data.get("vision_tokens", 0),
+            blocks=parse_grounding(data["text"])
+        )
+
+    def to_markdown(self, image_prefix: str = "") -> str:
+        """去掉 grounding 标记，图片区块替换为 images/ 下的裁剪图"""
+        counter = itertools.count()
+
+        def replace(match):
+            if match.group(2) == "image":
+                return f"![](images/{image_prefix}{next(counter)}.jpg)\n"
+            return ""
+
+        markdown = GROUNDING_PATTERN.sub(replace, self.text)
+        return markdown.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+
+
+def parse_grounding(text: str) -> List[Dict[str, Any]]:
+    """
+    解析模型输出中的 grounding 区块
+
+    Returns:
+        List[dict]: [{"label": "title", "boxes": [[x1, y1, x2, y2], ...]}, ...]
+    """
+    blocks = []
+    for _, label, det in GROUNDING_PATTERN.findall(text):
+        try:
+            boxes = ast.literal_eval(det.strip())
+        except (ValueError, SyntaxError):
+            boxes = []
+        blocks.append({"label": label, "boxes": boxes})
+    return blocks
+
+
+def count_crop_tiles(width: int, height: int, image_size: int, min_num: int = 2, max_num: int = 9) -> int:
+    """按 DeepSeek-OCR 动态裁剪规则估算切片数（与 image_process.count_tiles 相同的网格选择）"""
+    if width <= image_size and height <= image_size:
+        return 1
+
+    aspect_ratio = width / height
+    target_ratios = sorted(
+        {(i, j) for n in range(min_num, max_num + 1)
+         for i in range(1, n + 1) for j in range(1, n + 1)
+         if min_num <= i * j <= max_num},
+        key=lambda x: x[0] * x[1]
+    )
+
+    best_ratio = (1, 1)
+    best_diff = float('inf')
+    area = width * height
+    for ratio in target_ratios:
+        diff = abs(aspect_ratio - ratio[0] / ratio[1])
+        if diff < best_diff:
+            best_diff = diff
+            best_ratio = ratio
+        elif diff == best_diff and area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+            best_ratio = ratio
+    return best_ratio[0] * best_ratio[1]
+
+
+def estimate_vision_tokens(width: int, height: int, settings: Dict[str, Any]) -> int:
+    """
+    估算单张图片的视觉 token 数
+
+    每个视图的 token 数为 (边长 / 64) 的平方（Tiny 64、Small 100、Base 256、Large 400）；
+    裁剪模式下为全局视图加上各切片。
+    """
+    base_tokens = (settings["base_size"] // 64) ** 2
+    if not settings["crop_mode"]:
+        return base_tokens
+
+    tiles = count_crop_tiles(width, height, settings["image_size"])
+    if tiles <= 1:
+        return base_tokens
+    return base_tokens + tiles * (settings["image_size"] // 64) ** 2
 
 
-def extract_ocr_result(output_path: str, captured_stdout: str = None):
+def save_page_artifacts(result: OCRResult, image: Union[str, Image.Image], output_path: str, boxes_name: str, image_prefix: str = "") -> str:
     """
-    从输出目录或捕获的 stdout 中提取 OCR 结果
+    写入单页的结果文件：带标注框的可视化图片，以及 images/ 下裁剪出的插图
 
     Args:
+        result: 单页推理结果
+        image: 原图路径或图片
         output_path: 输出目录路径
-        captured_stdout: 捕获的标准输出
+        boxes_name: 可视化图片的文件名
+        image_prefix: 插图文件名前缀（多页文档用于区分页码）
 
     Returns:
-        dict: 包含 text 和 files 的字典
+        str: 该页的 markdown 文本
     """
-    result = {
-        "text": "",
-        "output_files": [],
-        "images": []
-    }
-
-    output_dir = Path(output_path)
+    if isinstance(image, Image.Image):
+        image = image.convert("RGB")  # convert 返回副本，不修改原图
+    else:
+        image = Image.open(image).convert("RGB")
+    width, height = image.size
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    images_dir = Path(output_path) / "images"
 
-    # 1. 尝试从输出文件中读取结果
-    if output_dir.exists():
-        # 查找文本文件（.txt, .md）
-        text_files = list(output_dir.glob("*.txt")) + list(output_dir.glob("*.md"))
-        for text_file in text_files:
+    image_idx = 0
+    for block_idx, block in enumerate(result.blocks):
+        color = BOX_COLORS[block_idx % len(BOX_COLORS)]
+        for box in block["boxes"]:
             try:
-                with open(text_file, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    if content:
-                        result["text"] = content
-                        result["output_files"].append(str(text_file.name))
-                        logger.info(f"从文件 {text_file.name} 读取到 {len(content)} 字符")
-                        break
-            except Exception as e:
-                logger.warning(f"读取文件 {text_file} 失败: {e}")
-
-        # 查找图片文件
-        image_extensions = ['.png', '.jpg', '.jpeg', '.webp']
-        for ext in image_extensions:
-            image_files = list(output_dir.glob(f"*{ext}"))
-            for img_file in image_files:
-                result["images"].append(str(img_file.relative_to(output_dir)))
-
-    # 2. 如果文件中没有找到，尝试从捕获的 stdout 中提取
-    if not result["text"] and captured_stdout:
-        # 从 stdout 中提取实际的 OCR 输出
-        # 通常 OCR 输出在压缩率信息之后
-        lines = captured_stdout.split('\n')
-
-        # 寻找实际的文本输出（跳过调试信息）
-        text_lines = []
-        skip_patterns = ['=', 'image size:', 'valid image tokens:', 'output texts tokens', 'compression ratio:']
-
-        for line in lines:
-            # 跳过调试信息行
-            if any(pattern in line for pattern in skip_patterns):
-                continue
-            # 跳过空行
-            if not line.strip():
+                x1, y1, x2, y2 = box
+            except (TypeError, ValueError):
                 continue
-            text_lines.append(line)
+            x1, x2 = int(x1 / 999 * width), int(x2 / 999 * width)
+            y1, y2 = int(y1 / 999 * height), int(y2 / 999 * height)
 
-        if text_lines:
-            result["text"] = '\n'.join(text_lines).strip()
-            logger.info(f"从 stdout 提取到 {len(result['text'])} 字符")
+            if block["label"] == "image":
+                images_dir.mkdir(exist_ok=True)
+                try:
+                    image.crop((x1, y1, x2, y2)).save(images_dir / f"{image_prefix}{image_idx}.jpg")
+                except Exception as e:
+                    logger.warning(f"裁剪插图失败: {e}")
+                image_idx += 1
+
+            draw.rectangle([x1, y1, x2, y2], outline=color, width=4 if block["label"] == "title" else 2)
+            draw.text((x1, max(0, y1 - 15)), block["label"], font=font, fill=color)
+
+    image.save(Path(output_path) / boxes_name)
+    return result.to_markdown(image_prefix)
 
-    return result
+
+def _record_startup_phase(phase: str, start: float) -> float:
+    """记录启动阶段耗时，返回当前时间作为下一阶段的起点"""
+    now = time.perf_counter()
+    STARTUP_TIMINGS[phase] = round(now - start, 3)
+    return now
 
 
 def load_model():
-    """加载模型"""
-    global model, tokenizer, MODEL_LOADED
+    """
+    加载模型（只加载权重，推理工作线程启动后由 initialize_model 标记为已加载）
+
+    torch / transformers 在这里才导入，服务进程可以先开始监听。
+    快速加载（MODEL_FAST_LOAD）时权重从内存映射的 safetensors 按目标精度直接放到目标设备，
+    不再先在 CPU 上构造一份 fp32 模型再移动、转换，峰值内存接近最终占用。
+    """
+    global model, tokenizer
 
-    if MODEL_LOADED:
+    if model is not None:
         logger.info("模型已加载")
         return
 
     try:
         logger.info(f"开始加载模型: {MODEL_PATH}")
+        load_start = phase_start = time.perf_counter()
+
+        # 在导入 torch 之前设置可见设备
+        os.environ.setdefault("CUDA_VISIBLE_DEVICES", CUDA_DEVICE)
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        phase_start = _record_startup_phase("imports", phase_start)
+
+        # 检查 CUDA 是否可用
+        use_cuda = torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
+        dtype = torch.bfloat16 if use_cuda else torch.float32
+
+        if use_cuda:
+            logger.info(f"使用 CUDA 设备: {CUDA_DEVICE}")
+        else:
+            logger.info("CUDA 不可用，使用 CPU 模式")
+
+        # 加载 tokenizer
+        logger.info("加载 tokenizer...")
+        tokenizer = AutoTokenizer.from_pretrained(
+            MODEL_PATH,
+            trust_remote_code=True
+        )
+        phase_start = _record_startup_phase("tokenizer", phase_start)
+
+        # 加载模型
+        load_kwargs = dict(
+            trust_remote_code=True,
+            use_safetensors=True,
+            attn_implementation="eager"  # 禁用 FlashAttention，使用标准attention实现
+        )
+        loaded = None
+        if MODEL_FAST_LOAD:
+            logger.info(f"加载模型（{dtype}，直接加载到 {device}）...")
+            try:
+                loaded = AutoModel.from_pretrained(
+                    MODEL_PATH,
+                    torch_dtype=dtype,
+                    low_cpu_mem_usage=True,
+                    device_map={"": str(device)},
+                    **load_kwargs
+                )
+            except Exception as e:
+                logger.warning(f"快速加载失败，回退到逐步加载: {str(e)}")
+
+        if loaded is None:
+            logger.info("加载模型...")
+            loaded = AutoModel.from_pretrained(MODEL_PATH, **load_kwargs)
+            phase_start = _record_startup_phase("weights", phase_start)
+
+            # 移动到设备，如果使用 CUDA，转换为 bfloat16 以节省显存
+            logger.info(f"将模型移动到 {device}...")
+            loaded = loaded.to(device)
+            if use_cuda:
+                loaded = loaded.to(torch.bfloat16)
+        else:
+            phase_start = _record_startup_phase("weights", phase_start)
+
+        model = loaded.eval()
+        _record_startup_phase("device_move", phase_start)
+
+        # PDF 页面以内存图片直接传给模型
+        install_memory_image_loader(model)
+        install_generate_hooks(model)
+
+        STARTUP_TIMINGS["load_total"] = round(time.perf_counter() - load_start, 3)
+        logger.info(f"✅ 模型加载成功！（{STARTUP_TIMINGS['load_total']:.1f} 秒）")
+
+    except Exception as e:
+        logger.error(f"❌ 模型加载失败: {str(e)}")
+        raise
+
+
+# 当前线程最近一次 generate() 的耗时（由 install_generate_hooks 记录）
+_GENERATE_TIMER = threading.local()
+# 当前线程正在推理的页面是否已取消（infer_page 设置，每个解码步检查）
+_GENERATE_CANCEL = threading.local()
+# 当前线程正在推理的页面的增量文本回调（infer_page 设置，流式识别时使用）
+_GENERATE_STREAM = threading.local()
+# 只预处理不生成：截获 infer() 传给 generate() 的参数（prepare_generate_inputs 设置）
+_GENERATE_CAPTURE = threading.local()
+
+
+class TextDeltaStreamer:
+    """
+    generate() 的 streamer：把新生成的 token 解码成增量文本交给回调
+
+    与 transformers.TextStreamer 相同，按行缓存 token 重新解码，
+    末尾是不完整的多字节字符时等下一个 token 再输出。
+    """
+
+    def __init__(self, tokenizer, callback: Callable[[str], None]):
+        self.tokenizer = tokenizer
+        self.callback = callback
+        self.token_cache: List[int] = []
+        self.emitted = 0
+        self.prompt_skipped = False
+
+    def put(self, value):
+        # 第一次调用传入的是提示词
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        eos = getattr(self.tokenizer, "eos_token_id", None)
+        self.token_cache.extend(t for t in value.reshape(-1).tolist() if t != eos)
+        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=False)
+        if text.endswith("\n"):
+            delta = text[self.emitted:]
+            self.token_cache = []
+            self.emitted = 0
+        elif text.endswith("\ufffd"):
+            return
+        else:
+            delta = text[self.emitted:]
+            self.emitted = len(text)
+        if delta:
+            self.callback(delta)
+
+    def end(self):
+        if self.token_cache:
+            delta = self.tokenizer.decode(self.token_cache, skip_special_tokens=False)[self.emitted:]
+            self.token_cache = []
+            self.emitted = 0
+            if delta:
+                self.callback(delta)
+
+
+class InferenceCancelled(RuntimeError):
+    """页面在推理开始前或解码过程中被取消"""
+
+
+class BackendError(RuntimeError):
+    """推理后端无法处理请求；status_code 是接口返回的 HTTP 状态码"""
+
+    status_code = 500
+
+
+class UnsupportedSettings(BackendError):
+    """推理后端不支持请求的推理参数（模式）"""
+
+    status_code = 400
+
+
+class _GenerateCaptured(Exception):
+    """已截获 generate() 的参数，用来中止 infer()"""
+
+
+def install_generate_hooks(model):
+    """
+    包装 model.generate
+
+    - 记录每次生成的耗时，用于区分预处理和模型推理阶段
+    - 追加一个 StoppingCriteria，每个解码步检查当前页面（批量生成时为每一行）是否已取消，取消的行立即结束生成
+    - 流式识别时传入 TextDeltaStreamer，逐 token 输出增量文本
+    - 批量预处理时只记录参数并中止 infer()，不执行生成（见 prepare_generate_inputs）
+    """
+    generate = getattr(model, "generate", None)
+    if generate is None or getattr(generate, "_hooked", False):
+        return
+
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class CancelCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            rows = getattr(_GENERATE_CANCEL, "rows", None)
+            if rows is not None:
+                return torch.tensor([bool(c is not None and c()) for c in rows], dtype=torch.bool, device=input_ids.device)
+            cancelled = getattr(_GENERATE_CANCEL, "check", None)
+            stop = bool(cancelled is not None and cancelled())
+            return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+    def hooked_generate(*args, **kwargs):
+        if getattr(_GENERATE_CAPTURE, "active", False):
+            _GENERATE_CAPTURE.inputs = (args, kwargs)
+            raise _GenerateCaptured()
+        kwargs["stopping_criteria"] = StoppingCriteriaList(list(kwargs.get("stopping_criteria") or []) + [CancelCriteria()])
+        on_text = getattr(_GENERATE_STREAM, "callback", None)
+        if on_text is not None:
+            kwargs["streamer"] = TextDeltaStreamer(tokenizer, on_text)
+        start = time.perf_counter()
+        try:
+            return generate(*args, **kwargs)
+        finally:
+            _GENERATE_TIMER.seconds = time.perf_counter() - start
+
+    hooked_generate._hooked = True
+    model.generate = hooked_generate
+
+
+def _image_dimensions(image: Union[str, Image.Image]) -> Tuple[int, int]:
+    """图片的 (宽, 高)"""
+    if isinstance(image, Image.Image):
+        return image.size
+    with Image.open(image) as img:
+        return img.size
+
+
+def _run_model_infer(image: Union[str, Image.Image], settings: Dict[str, Any]) -> str:
+    """调用 model.infer()（eval_mode 直接返回解码文本，不写结果文件）"""
+    with image_source(image) as image_file:
+        return model.infer(
+            tokenizer,
+            prompt=settings["prompt"],
+            image_file=image_file,
+            output_path=str(INFER_SCRATCH_DIR),
+            base_size=settings["base_size"],
+            image_size=settings["image_size"],
+            crop_mode=settings["crop_mode"],
+            save_results=False,
+            test_compress=False,
+            eval_mode=True
+        ) or ""
+
+
+def _build_result(text: str, width: int, height: int, settings: Dict[str, Any], timings: Dict[str, float]) -> OCRResult:
+    """由解码文本构造 OCRResult（解析 grounding 标记，统计 token 数）"""
+    extract_start = time.perf_counter()
+    result = OCRResult(
+        text=text,
+        image_size=(width, height),
+        output_tokens=len(tokenizer.encode(text, add_special_tokens=False)) if text else 0,
+        vision_tokens=estimate_vision_tokens(width, height, settings),
+        blocks=parse_grounding(text)
+    )
+    timings["extract"] = time.perf_counter() - extract_start
+    result.timings = timings
+    return result
+
+
+def infer_page(image: Union[str, Image.Image], settings: Dict[str, Any],
+               cancelled: Optional[Callable[[], bool]] = None,
+               on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+    """
+    对单张图片执行 OCR（在推理工作线程中调用）
+
+    使用 infer() 的 eval_mode 直接取得解码文本，不捕获 stdout，也不写任何结果文件。
+
+    Args:
+        image: 图片路径或 PIL 图片（PDF 页面直接以内存图片传入）
+        settings: 推理参数（prompt/base_size/image_size/crop_mode）
+        cancelled: 返回 True 表示页面已取消；解码过程中每一步检查，取消后抛出 InferenceCancelled
+        on_text: 增量文本回调（在推理线程中调用），生成过程中逐 token 输出
+
+    Returns:
+        OCRResult: 单页推理结果
+    """
+    if cancelled is not None and cancelled():
+        raise InferenceCancelled("页面已取消")
+
+    width, height = _image_dimensions(image)
+
+    _GENERATE_TIMER.seconds = None
+    _GENERATE_CANCEL.check = cancelled
+    _GENERATE_STREAM.callback = on_text
+    infer_start = time.perf_counter()
+    try:
+        text = _run_model_infer(image, settings)
+    finally:
+        _GENERATE_CANCEL.check = None
+        _GENERATE_STREAM.callback = None
+    infer_seconds = time.perf_counter() - infer_start
+
+    # 解码被提前结束，文本不完整
+    if cancelled is not None and cancelled():
+        raise InferenceCancelled("页面已取消")
+
+    # infer() 内部先做图片预处理再调用 generate()；能取得 generate 耗时时拆分为两个阶段
+    timings = {}
+    if _GENERATE_TIMER.seconds is not None:
+        timings["preprocess"] = max(0.0, infer_seconds - _GENERATE_TIMER.seconds)
+        timings["inference"] = _GENERATE_TIMER.seconds
+    else:
+        timings["inference"] = infer_seconds
+
+    return _build_result(text, width, height, settings, timings)
+
+
+class BatchUnsupported(RuntimeError):
+    """模型代码不支持批量生成（无法截获 generate() 的参数，或参数与批量输入不兼容）"""
+
+
+def prepare_generate_inputs(image: Union[str, Image.Image], settings: Dict[str, Any]) -> Tuple[tuple, dict]:
+    """
+    单页预处理：让 model.infer() 完成读图、裁剪、归一化和图片 token 拼接，截获它传给 generate() 的参数后中止
+
+    预处理与 infer_page 完全一致，批量生成只需要把各页的参数拼在一起。可以在多个线程中同时调用。
+
+    Returns:
+        (args, kwargs): infer() 调用 generate() 的参数
+    """
+    _GENERATE_CAPTURE.active = True
+    _GENERATE_CAPTURE.inputs = None
+    try:
+        _run_model_infer(image, settings)
+    except _GenerateCaptured:
+        pass
+    finally:
+        _GENERATE_CAPTURE.active = False
+    inputs, _GENERATE_CAPTURE.inputs = _GENERATE_CAPTURE.inputs, None
+    if inputs is None:
+        raise BatchUnsupported("model.infer() 没有调用 generate()，无法批量生成")
+    return inputs
+
+
+def generate_batch(inputs: List[Tuple[tuple, dict]], cancelled: List[Optional[Callable[[], bool]]]) -> List[str]:
+    """
+    把多页的 generate() 参数拼成一批，一次 generate() 生成所有页面
+
+    input_ids 左填充到同一长度并给出 attention_mask，images_seq_mask 同样左填充，
+    images / images_spatial_crop 按页顺序拼接（模型按行逐页嵌入图片特征）。
+    每个解码步逐行检查取消，取消的行单独结束生成。
+
+    Returns:
+        List[str]: 与 inputs 一一对应的解码文本（与 infer() 的 eval_mode 输出相同）
+    """
+    import torch
+
+    ids = [args[0] if args else kwargs["input_ids"] for args, kwargs in inputs]
+    seq_masks = [kwargs["images_seq_mask"] for _, kwargs in inputs]
+    length = max(t.shape[-1] for t in ids)
+    device = ids[0].device
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    input_ids = torch.full((len(ids), length), pad_id, dtype=ids[0].dtype, device=device)
+    attention_mask = torch.zeros((len(ids), length), dtype=torch.long, device=device)
+    images_seq_mask = torch.zeros((len(ids), length), dtype=torch.bool, device=seq_masks[0].device)
+    for row, (page_ids, seq_mask) in enumerate(zip(ids, seq_masks)):
+        offset = length - page_ids.shape[-1]
+        input_ids[row, offset:] = page_ids.reshape(-1)
+        attention_mask[row, offset:] = 1
+        images_seq_mask[row, offset:] = seq_mask.reshape(-1)
+
+    kwargs = {k: v for k, v in inputs[0][1].items()
+              if k not in ("input_ids", "attention_mask", "images", "images_seq_mask", "images_spatial_crop", "streamer")}
+    kwargs["images"] = [image for _, page_kwargs in inputs for image in page_kwargs["images"]]
+    kwargs["images_spatial_crop"] = torch.cat([torch.as_tensor(k["images_spatial_crop"]).reshape(-1, 2)
+                                               for _, k in inputs])
+
+    _GENERATE_CANCEL.rows = cancelled
+    try:
+        with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=device.type == "cuda"):
+            output_ids = model.generate(input_ids, attention_mask=attention_mask, images_seq_mask=images_seq_mask,
+                                        **kwargs)
+    finally:
+        _GENERATE_CANCEL.rows = None
+
+    # 与 infer() 相同：去掉提示词部分，截到第一个 EOS（之后是已结束行的填充），去掉首尾空白
+    eos = tokenizer.eos_token_id
+    texts = []
+    for row in range(len(ids)):
+        tokens = output_ids[row, length:].tolist()
+        if eos in tokens:
+            tokens = tokens[:tokens.index(eos)]
+        texts.append(tokenizer.decode(tokens).strip())
+    return texts
+
+
+@dataclass
+class PageRequest:
+    """单页推理请求"""
+    image: Union[str, Image.Image]
+    settings: Dict[str, Any]
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    cancelled: threading.Event = field(default_factory=threading.Event)  # 等待结果的协程已取消
+    on_text: Optional[Callable[[str], None]] = None  # 流式识别的增量文本回调
+
+    @property
+    def batch_key(self) -> tuple:
+        """只有推理参数完全相同的请求才能合并到同一批"""
+        s = self.settings
+        return (s["prompt"], s["base_size"], s["image_size"], s["crop_mode"])
+
+
+class InferenceBackend(ABC):
+    """
+    推理后端接口（模型层）
+
+    - load(): 加载模型（启动时在线程中调用一次）
+    - supports(settings): 是否支持该推理参数；不支持的模式不预热，请求返回 400
+    - infer_page(image, settings, cancelled, on_text): 识别一页；cancelled 返回 True 时尽快抛出 InferenceCancelled，
+      给出 on_text 时生成过程中逐段回调增量文本。流式识别（/ocr/stream）就是这个回调，不单独提供 stream()：
+      回调可以经推理线程、推理进程的结果队列或 vLLM 的异步生成器转发，生成器无法跨进程传递
+    - infer_batch(requests): 识别一批推理参数相同的页面（默认逐页调用 infer_page）；
+      实际一次送进模型的页数记录在 ocr_batch_size
+    - warmup(settings): 用合成图片推理一次，返回耗时（推理进程领取任务前调用）
+    - revision(): 模型版本标识，参与结果缓存键
+    - 后端无法处理请求时抛出 BackendError，由接口按其 status_code 返回（不支持的模式为 400）
+
+    同步后端由 InferenceWorker（推理线程）或 InferencePool（fork 出的推理进程）调度；
+    vLLM 后端（VLLMEngine）由引擎自己调度，同时充当调度器。
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def load(self):
+        """加载模型"""
+
+    def supports(self, settings: Dict[str, Any]) -> bool:
+        return True
+
+    def revision(self) -> str:
+        return MODEL_PATH
+
+    def fork_safe(self) -> bool:
+        """能否由进程池的宿主进程加载后 fork 出推理进程共享（InferencePool）"""
+        return True
+
+    def init_worker_process(self, num_threads: int):
+        """fork 出的推理进程启动时调用（限制计算线程数等）"""
+
+    @abstractmethod
+    def infer_page(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                   cancelled: Optional[Callable[[], bool]] = None,
+                   on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        """识别一页"""
+
+    def warmup(self, settings: Dict[str, Any]) -> float:
+        """用合成的文档图片推理一次，返回耗时（秒）"""
+        start = time.perf_counter()
+        self.infer_page(make_warmup_image(), settings)
+        return time.perf_counter() - start
+
+    def infer_batch(self, requests: List[PageRequest]) -> List[Any]:
+        """
+        执行一批推理参数相同的单页请求（单页失败不影响同批其他页面）
+
+        Returns:
+            List: 与 requests 一一对应，元素为 OCRResult 或异常
+        """
+        results = []
+        for request in requests:
+            BATCH_SIZE.observe(1)
+            try:
+                results.append(self.infer_page(request.image, request.settings, request.cancelled.is_set, request.on_text))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class HFBackend(InferenceBackend):
+    """
+    transformers 后端（model.infer）
+
+    同一批页面先在多个线程中并行预处理（prepare_generate_inputs），再拼成一批左填充的输入，
+    一次 generate() 生成所有页面（generate_batch）。流式识别的页面需要逐 token 回调，单独生成。
+    批量生成出错时本批改为逐页推理；模型代码不支持批量生成（无法截获 generate() 的参数、参数不兼容），
+    或连续 MAX_BATCH_FAILURES 批出错时，之后不再尝试批量生成。
+    """
+
+    name = "hf"
+    MAX_BATCH_FAILURES = 3
+
+    def __init__(self):
+        self.batch_generate = True
+        self._batch_failures = 0  # 连续出错的批数
+        self._preprocess_executor: Optional[ThreadPoolExecutor] = None
+
+    def load(self):
+        load_model()
+
+    def revision(self) -> str:
+        config = getattr(model, "config", None)
+        commit_hash = getattr(config, "_commit_hash", None)
+        return f"{MODEL_PATH}@{commit_hash}" if commit_hash else MODEL_PATH
+
+    def fork_safe(self) -> bool:
+        # CUDA 上下文无法跨 fork 使用
+        os.environ.setdefault("CUDA_VISIBLE_DEVICES", CUDA_DEVICE)
+        import torch
+        return not torch.cuda.is_available()
+
+    def init_worker_process(self, num_threads: int):
+        import torch
+        torch.set_num_threads(num_threads)
+
+    def infer_page(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                   cancelled: Optional[Callable[[], bool]] = None,
+                   on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        return infer_page(image, settings, cancelled, on_text)
+
+    def infer_batch(self, requests: List[PageRequest]) -> List[Any]:
+        batched = [r for r in requests if r.on_text is None and not r.cancelled.is_set()]
+        if not self.batch_generate or len(batched) < 2:
+            return super().infer_batch(requests)
+
+        results: Dict[int, Any] = {}
+        try:
+            results.update(zip(map(id, batched), self._generate(batched)))
+        except Exception as e:
+            # 参数类型或个数不符（TypeError / KeyError）说明 generate() 的签名与批量输入不兼容
+            unsupported = isinstance(e, (BatchUnsupported, TypeError, KeyError))
+            self._batch_failures += 1
+            BATCH_FALLBACKS.labels("unsupported" if unsupported else "error").inc()
+            if unsupported or self._batch_failures >= self.MAX_BATCH_FAILURES:
+                self.batch_generate = False
+                logger.warning(f"批量生成失败，之后改为逐页推理（可设置 BATCH_MAX_SIZE=1 关闭微批）: {str(e)}")
+            else:
+                logger.warning(f"批量生成失败，本批改为逐页推理（连续 {self._batch_failures} 批）: {str(e)}")
+            return super().infer_batch(requests)
+        self._batch_failures = 0
+
+        rest = [r for r in requests if id(r) not in results]
+        results.update(zip(map(id, rest), super().infer_batch(rest)))
+        return [results[id(r)] for r in requests]
+
+    def _generate(self, requests: List[PageRequest]) -> List[Any]:
+        """并行预处理后一次生成整批页面；单页预处理失败只影响该页"""
+        if self._preprocess_executor is None:
+            self._preprocess_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_SIZE, thread_name_prefix="ocr-preprocess")
+
+        def preprocess(request: PageRequest):
+            start = time.perf_counter()
+            inputs = prepare_generate_inputs(request.image, request.settings)
+            return inputs, _image_dimensions(request.image), time.perf_counter() - start
+
+        results: List[Any] = [None] * len(requests)
+        prepared = []
+        for i, future in enumerate([self._preprocess_executor.submit(preprocess, r) for r in requests]):
+            try:
+                prepared.append((i, *future.result()))
+            except BatchUnsupported:
+                raise
+            except Exception as e:
+                results[i] = e
+        if not prepared:
+            return results
+
+        BATCH_SIZE.observe(len(prepared))
+        _GENERATE_TIMER.seconds = None
+        inference_start = time.perf_counter()
+        texts = generate_batch([inputs for _, inputs, _, _ in prepared],
+                               [requests[i].cancelled.is_set for i, *_ in prepared])
+        inference_seconds = _GENERATE_TIMER.seconds or time.perf_counter() - inference_start
+
+        for (i, _, (width, height), preprocess_seconds), text in zip(prepared, texts):
+            request = requests[i]
+            if request.cancelled.is_set():
+                results[i] = InferenceCancelled("页面已取消")
+                continue
+            results[i] = _build_result(text, width, height, request.settings,
+                                       {"preprocess": preprocess_seconds, "inference": inference_seconds})
+        return results
+
+
+class FakeBackend(InferenceBackend):
+    """
+    确定性的 CPU 假模型（不需要权重，用于压测和剖析服务本身的开销）
+
+    输出由图片内容和推理参数决定的 grounding 标记 markdown（标题、插图和若干段落），同一输入总是得到同样的文本。
+    耗时按 token 数模拟：先预填充（视觉 token 数 × vision_token_ms），之后每个解码步 output_token_ms 输出一个 token；
+    同一批页面共享解码步，与加速器上的批量解码一样，批越大每页越便宜。
+    上传、PDF 渲染、结果提取、文件写入等模型之外的开销都是真实的，可以单独测量。
+    """
+
+    name = "fake"
+    WORDS = ("the", "document", "model", "page", "table", "figure", "result", "section", "value", "total",
+             "report", "data", "image", "text", "line", "summary", "analysis", "method", "sample", "index")
+
+    def __init__(self, vision_token_ms: float, output_token_ms: float, output_tokens: int):
+        self.vision_token_seconds = max(0.0, vision_token_ms) / 1000.0
+        self.output_token_seconds = max(0.0, output_token_ms) / 1000.0
+        self.output_tokens = max(1, output_tokens)
+
+    def load(self):
+        logger.info(f"使用 fake 推理后端（每视觉 token {self.vision_token_seconds * 1000:g} ms，"
+                    f"每输出 token {self.output_token_seconds * 1000:g} ms，每页 {self.output_tokens} 个 token）")
+
+    def revision(self) -> str:
+        return f"fake:{self.output_tokens}"
+
+    def _compose(self, image: Image.Image, settings: Dict[str, Any]) -> List[str]:
+        """按图片内容和推理参数生成输出 token 序列（grounding 标记整体算一个 token）"""
+        digest = hashlib.sha256(image.convert("L").resize((32, 32)).tobytes())
+        digest.update(repr((image.size, sorted(settings.items()))).encode())
+        rng = random.Random(digest.digest())
+
+        def ref(label: str) -> str:
+            x1, y1 = rng.randrange(0, 800), rng.randrange(0, 900)
+            box = [x1, y1, x1 + rng.randrange(50, 199), y1 + rng.randrange(20, 99)]
+            return f"<|ref|>{label}<|/ref|><|det|>[{box}]<|/det|>\n"
+
+        tokens = [ref("title"), "#"] + [" " + rng.choice(self.WORDS).capitalize() for _ in range(4)] + ["\n\n"]
+        tokens += [ref("image"), "\n"]
+        while len(tokens) < self.output_tokens:
+            words = [rng.choice(self.WORDS) for _ in range(rng.randrange(20, 60))]
+            tokens += [ref("text"), words[0].capitalize()] + [" " + w for w in words[1:]] + [".\n\n"]
+        return tokens[:self.output_tokens]
+
+    def infer_page(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                   cancelled: Optional[Callable[[], bool]] = None,
+                   on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        result = self._generate([(image, settings, cancelled, on_text)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def infer_batch(self, requests: List[PageRequest]) -> List[Any]:
+        return self._generate([(r.image, r.settings, r.cancelled.is_set, r.on_text) for r in requests])
+
+    def _generate(self, pages: list) -> List[Any]:
+        results: List[Any] = [None] * len(pages)
+        active = []
+        preprocess_start = time.perf_counter()
+        for i, (image, settings, cancelled, on_text) in enumerate(pages):
+            if cancelled is not None and cancelled():
+                results[i] = InferenceCancelled("页面已取消")
+                continue
+            try:
+                if isinstance(image, Image.Image):
+                    tokens = self._compose(image, settings)
+                    width, height = image.size
+                else:
+                    with Image.open(image) as img:
+                        tokens = self._compose(img, settings)
+                        width, height = img.size
+            except Exception as e:
+                results[i] = e
+                continue
+            active.append((i, tokens, width, height, settings, cancelled, on_text))
+        preprocess_seconds = time.perf_counter() - preprocess_start
+
+        # 预填充：整批视觉 token 一起计算
+        if active:
+            BATCH_SIZE.observe(len(active))
+        inference_start = time.perf_counter()
+        time.sleep(self.vision_token_seconds * sum(estimate_vision_tokens(w, h, s) for _, _, w, h, s, _, _ in active))
+
+        # 解码：每一步为批内每个未结束的页面输出一个 token
+        for step in range(max((len(tokens) for _, tokens, *_ in active), default=0)):
+            if all(results[i] is not None for i, *_ in active):
+                break
+            time.sleep(self.output_token_seconds)
+            for i, tokens, _, _, _, cancelled, on_text in active:
+                if results[i] is not None or step >= len(tokens):
+                    continue
+                if cancelled is not None and cancelled():
+                    results[i] = InferenceCancelled("页面已取消")
+                elif on_text is not None:
+                    on_text(tokens[step])
+        inference_seconds = time.perf_counter() - inference_start
+
+        for i, tokens, width, height, settings, _, _ in active:
+            if results[i] is not None:
+                continue
+            extract_start = time.perf_counter()
+            text = "".join(tokens)
+            result = OCRResult(
+                text=text,
+                image_size=(width, height),
+                output_tokens=len(tokens),
+                vision_tokens=estimate_vision_tokens(width, height, settings),
+                blocks=parse_grounding(text)
+            )
+            result.timings = {
+                "preprocess": preprocess_seconds,
+                "inference": inference_seconds,
+                "extract": time.perf_counter() - extract_start
+            }
+            results[i] = result
+        return results
+
+
+class InferenceWorker:
+    """
+    推理工作线程（跨请求动态微批）
+
+    模型推理是同步且长时间占用加速器的操作。所有请求的页面统一提交到一个专用线程，
+    事件循环只负责等待结果，因此推理期间 /health、/download、/jobs 等接口仍可正常响应。
+
+    工作线程取出一个请求后，会在 max_wait_ms 窗口内继续收集推理参数相同的请求，
+    最多 max_batch_size 个，合并为一批交给推理后端的 infer_batch；参数不同的请求保持原顺序留待下一批。
+    """
+
+    def __init__(self, backend: InferenceBackend, max_batch_size: int = 8, max_wait_ms: float = 0,
+                 name: str = "ocr-inference"):
+        self.backend = backend
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.name = name
+        self._queue: "queue.Queue[Optional[PageRequest]]" = queue.Queue()
+        # 已取出但与当前批次参数不同、留待后续批次的请求
+        self._deferred: "deque[PageRequest]" = deque()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        # 每页推理耗时的指数移动平均（秒），用于估算排队时间
+        self.seconds_per_page: Optional[float] = None
+        # 单个文档同时提交的页数：页面在同一线程中依次推理，多提交只会让后到的请求排在整篇文档之后
+        self.page_concurrency = 1
+
+    def start(self):
+        """启动工作线程（已在运行时不做任何操作）"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info(f"推理工作线程已启动: {self.name}（max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1000:.0f}）")
+
+    def stop(self):
+        """停止工作线程（当前批次执行完后退出，未执行的请求以失败结束）"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+
+    @property
+    def pending(self) -> int:
+        """排队中的推理请求数"""
+        return self._queue.qsize() + len(self._deferred)
+
+    def submit(self, image: Union[str, Image.Image], settings: Dict[str, Any]) -> Future:
+        """提交单页推理请求（图片路径或 PIL 图片），返回 concurrent.futures.Future"""
+        return self._enqueue(image, settings).future
+
+    async def infer(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                    on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        """
+        提交单页推理请求并异步等待结果
+
+        等待的协程被取消时：尚未开始的页面不再推理，正在推理的页面在下一个解码步停止。
+        给出 on_text 时，生成过程中在推理线程中以增量文本回调。
+        """
+        request = self._enqueue(image, settings, on_text)
+        try:
+            return await asyncio.wrap_future(request.future)
+        except asyncio.CancelledError:
+            request.cancelled.set()
+            raise
+
+    def _enqueue(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                 on_text: Optional[Callable[[str], None]] = None) -> PageRequest:
+        request = PageRequest(image=image, settings=settings, on_text=on_text)
+        self._queue.put(request)
+        return request
+
+    def _next_request(self, timeout: Optional[float]) -> Optional[PageRequest]:
+        """从队列取下一个请求；超时返回 None，收到停止信号时设置 _stopping"""
+        try:
+            if timeout is None:
+                request = self._queue.get()
+            elif timeout > 0:
+                request = self._queue.get(timeout=timeout)
+            else:
+                request = self._queue.get_nowait()
+        except queue.Empty:
+            return None
+        if request is None:
+            self._stopping = True
+        return request
+
+    def _collect_batch(self) -> List[PageRequest]:
+        """收集一批推理参数相同的请求"""
+        if self._deferred:
+            first = self._deferred.popleft()
+        else:
+            first = self._next_request(timeout=None)
+            if first is None:
+                return []
+
+        batch = [first]
+        key = first.batch_key
+
+        # 先从留存的请求中取参数相同的
+        for request in list(self._deferred):
+            if len(batch) >= self.max_batch_size:
+                break
+            if request.batch_key == key:
+                self._deferred.remove(request)
+                batch.append(request)
+
+        # 再在等待窗口内从队列中收集
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size and not self._stopping:
+            request = self._next_request(timeout=deadline - time.monotonic())
+            if request is None:
+                break
+            if request.batch_key == key:
+                batch.append(request)
+            else:
+                self._deferred.append(request)
+
+        return batch
+
+    def _run_batch(self, batch: List[PageRequest]):
+        """执行一批请求并把结果分发给各自的 Future"""
+        now = time.monotonic()
+        for request in batch:
+            BATCH_QUEUE_WAIT_SECONDS.observe(now - request.enqueued_at)
+
+        batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        start = time.perf_counter()
+        try:
+            results = self.backend.infer_batch(batch)
+        except BaseException as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        finally:
+            self._record_throughput(len(batch), time.perf_counter() - start)
+
+        for request, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                request.future.set_exception(result)
+            else:
+                request.future.set_result(result)
+
+    def _record_throughput(self, pages: int, seconds: float, alpha: float = 0.2):
+        per_page = seconds / pages
+        if self.seconds_per_page is None:
+            self.seconds_per_page = per_page
+        else:
+            self.seconds_per_page = alpha * per_page + (1 - alpha) * self.seconds_per_page
+
+    def _loop(self):
+        while True:
+            batch = self._collect_batch()
+            if batch:
+                self._run_batch(batch)
+            if self._stopping:
+                break
+
+        # 停止后仍未执行的请求以失败结束
+        remaining = list(self._deferred)
+        self._deferred.clear()
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                remaining.append(request)
+        for request in remaining:
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(RuntimeError("服务正在关闭"))
+
+
+def _pool_worker_main(backend: InferenceBackend, index: int, tasks, results, cancel_flags, cancelled, num_threads: int,
+                      warmup: List[Tuple[str, Dict[str, Any]]], parent_pid: int):
+    """
+    推理进程入口（由宿主进程 fork，模型权重与宿主进程和其他推理进程写时复制共享）
+
+    每个进程只使用 num_threads 个计算线程，避免多个进程争抢 CPU 核。
+    开始领取任务前先对 warmup 中的每个模式各推理一次合成图片，结果以 warmed 消息报告（重新 fork 的进程同样先预热）。
+    API 进程把正在推理中取消的 request_id 写入 cancel_flags[index]，解码过程中每一步检查；
+    排队中取消的 request_id 写入 cancelled（最近取消的请求），取出任务时先检查，已取消的页面直接跳过。
+    """
+    # 信号由 API 进程处理，子进程收到 SIGTERM 直接退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+    backend.init_worker_process(num_threads)
+
+    for name, settings in warmup:
+        try:
+            results.put(("warmed", index, name, backend.warmup(settings), None))
+        except Exception as e:
+            results.put(("warmed", index, name, None, f"{type(e).__name__}: {e}"))
+
+    while True:
+        try:
+            item = tasks.get(timeout=1.0)
+        except queue.Empty:
+            # 宿主进程已退出
+            if os.getppid() != parent_pid:
+                return
+            continue
+        if item is None:
+            return
+
+        request_id, image, settings, stream = item
+        if request_id in cancelled:
+            results.put(("skipped", request_id))
+            continue
+        results.put(("started", request_id, index, time.time()))
+        on_text = (lambda delta: results.put(("delta", request_id, delta))) if stream else None
+        start = time.perf_counter()
+        try:
+            result = backend.infer_page(image, settings, lambda: cancel_flags[index] == request_id, on_text)
+            results.put(("done", request_id, True, result, time.perf_counter() - start))
+        except Exception as e:
+            results.put(("done", request_id, False, f"{type(e).__name__}: {e}", time.perf_counter() - start))
+
+
+def _pool_host_main(backend: InferenceBackend, workers: int, tasks, results, control, cancel_flags, cancelled,
+                    num_threads: int, warmup: List[Tuple[str, Dict[str, Any]]], stopping, parent_pid: int):
+    """
+    推理进程池的宿主进程（spawn 启动的全新解释器）
+
+    API 进程里已经有事件循环、to_thread 线程池、日志锁和 PDF 渲染线程，从那里 fork 的子进程可能继承一把
+    被其他线程持有的锁而死锁。宿主进程在单线程中加载模型后再 fork 出推理进程，各推理进程仍写时复制共享权重；
+    推理进程异常退出时由宿主进程重新 fork，并通知 API 进程让其手上的请求失败。
+
+    宿主进程自己的消息（ready / failed / exited）通过 control 管道发送：在宿主进程中使用 results 队列
+    会启动它的后台写线程，之后 fork 出的推理进程写入 results 的消息会丢失。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        backend.load()
+    except Exception as e:
+        control.send(("failed", f"{type(e).__name__}: {e}"))
+        return
+    control.send(("ready", backend.revision(), dict(STARTUP_TIMINGS)))
+
+    # 冻结现有对象，避免推理进程中的垃圾回收改写对象头导致共享页被复制
+    gc.freeze()
+    context = multiprocessing.get_context("fork")
+
+    def spawn(index: int):
+        process = context.Process(
+            target=_pool_worker_main,
+            args=(backend, index, tasks, results, cancel_flags, cancelled, num_threads, warmup, os.getpid()),
+            name=f"ocr-inference-{index}",
+            daemon=True
+        )
+        process.start()
+        return process
+
+    processes = [spawn(index) for index in range(workers)]
+    # stopping 是共享内存标志（Event 的等待者被 SIGKILL 后 set() 会永久阻塞）
+    while not stopping.value:
+        time.sleep(1.0)
+        # API 进程已退出
+        if os.getppid() != parent_pid:
+            break
+        for index, process in enumerate(processes):
+            # 正常退出（exitcode 0）是收到了停止信号
+            if not process.is_alive() and process.exitcode != 0:
+                control.send(("exited", index, process.exitcode))
+                processes[index] = spawn(index)
+
+    for process in processes:
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+
+
+class InferencePool:
+    """
+    多进程推理（与 InferenceWorker 接口相同）
+
+    spawn 出一个宿主进程加载模型，再由它 fork 出 workers 个推理进程，模型权重由各进程写时复制共享，
+    内存占用接近单份权重；API 进程本身不加载模型。页面放入共享任务队列，空闲的进程先取，自然实现负载均衡。
+    每个推理进程在领取任务前各自预热 warmup 中的模式（共享队列无法保证预热请求分到每个进程）。
+    CUDA 上下文无法跨 fork 使用，因此只用于 CPU 推理。
+    """
+
+    # 记录最近取消的 request_id 的槽数（排队中的页面取出时检查）
+    CANCELLED_SLOTS = 1024
+
+    def __init__(self, backend: InferenceBackend, workers: int, threads_per_worker: int,
+                 warmup: Optional[List[Tuple[str, Dict[str, Any]]]] = None):
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker
+        # 每个推理进程启动时预热的 (模式名, 推理参数)
+        self.warmup = list(warmup or [])
+        # 模式名 -> 各推理进程的预热耗时（秒），全部进程报告后置位 _warmed
+        self._warmup_seconds: Dict[str, List[float]] = {}
+        self._warmup_reports = 0
+        self._warmed = threading.Event()
+        # 整个池的等效每页耗时（单进程耗时 / 进程数），供准入控制估算排队时间
+        self.seconds_per_page: Optional[float] = None
+        # 宿主进程加载的模型版本（backend.revision()）
+        self.backend_revision: Optional[str] = None
+        self._context = multiprocessing.get_context("spawn")
+        self._tasks = None
+        self._results = None
+        # 进程序号 -> 该进程需要中止的 request_id（共享内存，-1 表示无）
+        self._cancel_flags = None
+        # 最近取消的 request_id（共享内存环形缓冲）
+        self._cancelled = None
+        self._cancelled_cursor = 0
+        # 共享的停止标志（宿主进程每秒检查）
+        self._stop_flag = None
+        self._host = None
+        # 宿主进程发来的消息（ready / failed / exited）
+        self._control = None
+        # request_id -> (Future, 提交时间)
+        self._futures: Dict[int, tuple] = {}
+        # 进程序号 -> 正在处理的 request_id
+        self._running: Dict[int, int] = {}
+        # request_id -> 流式识别的增量文本回调
+        self._streams: Dict[int, Callable[[str], None]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._collector: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def start(self):
+        """启动宿主进程并等待模型加载完成，之后启动结果收集线程；模型加载失败时抛出 RuntimeError"""
+        if self._host is not None:
+            return
+        self._stopping = False
+        self._warmup_seconds, self._warmup_reports = {}, 0
+        self._warmed.clear()
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._cancel_flags = self._context.Array("q", [-1] * self.workers, lock=False)
+        self._cancelled = self._context.Array("q", [-1] * self.CANCELLED_SLOTS, lock=False)
+        self._stop_flag = self._context.RawValue("b", 0)
+        self._host = self._spawn_host()
+        atexit.register(self.stop)
+
+        while True:
+            if self._control.poll(1.0):
+                message = self._control.recv()
+            elif not self._host.is_alive():
+                message = ("failed", f"宿主进程异常退出（exitcode={self._host.exitcode}）")
+            else:
+                continue
+            if message[0] == "ready":
+                _, self.backend_revision, timings = message
+                STARTUP_TIMINGS.update(timings)
+                break
+            if message[0] == "failed":
+                self.stop()
+                logger.error(f"❌ 推理进程池启动失败: {message[1]}")
+                raise RuntimeError(message[1])
+
+        self._collector = threading.Thread(target=self._collect, name="ocr-pool-collector", daemon=True)
+        self._collector.start()
+        logger.info(f"推理进程池已启动: {self.workers} 个进程，每个 {self.threads_per_worker} 个线程")
+
+    def stop(self):
+        """停止宿主进程和推理进程，未完成的请求以失败结束"""
+        if self._host is None:
+            return
+        self._stopping = True
+        for _ in range(self.workers):
+            self._tasks.put(None)
+        # 未被取走的页面不再写入管道，避免退出时等待写线程
+        self._tasks.cancel_join_thread()
+        self._stop_flag.value = 1
+        self._host.join(timeout=15)
+        if self._host.is_alive():
+            self._host.terminate()
+        self._host = None
+        self._results.put(None)
+        if self._collector is not None:
+            self._collector.join(timeout=5)
+        with self._lock:
+            futures, self._futures = self._futures, {}
+            self._streams.clear()
+        for future, _ in futures.values():
+            if not future.done():
+                future.set_exception(RuntimeError("服务正在关闭"))
+        self._warmed.set()
+
+    def wait_warmup(self) -> Dict[str, float]:
+        """等待所有推理进程完成预热，返回各模式最慢进程的预热耗时（秒）；全部进程都预热失败的模式不包含在内"""
+        if self.warmup:
+            self._warmed.wait()
+        return {name: max(seconds) for name, seconds in self._warmup_seconds.items() if seconds}
+
+    @property
+    def pending(self) -> int:
+        """已提交、尚未开始推理的请求数"""
+        with self._lock:
+            return len(self._futures) - len(self._running)
+
+    @property
+    def page_concurrency(self) -> int:
+        """单个文档同时提交的页数：每个推理进程各处理一页"""
+        return self.workers
+
+    def submit(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+               on_text: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        提交单页推理请求（图片路径或 PIL 图片），返回 concurrent.futures.Future
+
+        Future 被取消时（等待的协程被取消），正在推理的进程在下一个解码步停止，尚未开始的页面不再推理。
+        给出 on_text 时，推理进程把增量文本发回 API 进程，由结果收集线程回调。
+        """
+        future = Future()
+        request_id = next(self._ids)
+        with self._lock:
+            self._futures[request_id] = (future, time.time())
+            if on_text is not None:
+                self._streams[request_id] = on_text
+        future.add_done_callback(lambda f: f.cancelled() and self._cancel_request(request_id))
+        self._tasks.put((request_id, image, settings, on_text is not None))
+        return future
+
+    async def infer(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                    on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        """提交单页推理请求并异步等待结果"""
+        return await asyncio.wrap_future(self.submit(image, settings, on_text))
+
+    def _cancel_request(self, request_id: int):
+        """记录已取消的请求（排队中的不再开始），并通知正在处理它的进程中止"""
+        with self._lock:
+            self._cancelled[self._cancelled_cursor % self.CANCELLED_SLOTS] = request_id
+            self._cancelled_cursor += 1
+            for index, running_id in self._running.items():
+                if running_id == request_id:
+                    self._cancel_flags[index] = request_id
+
+    def _spawn_host(self):
+        self._control, control = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_pool_host_main,
+            args=(self.backend, self.workers, self._tasks, self._results, control, self._cancel_flags,
+                  self._cancelled, self.threads_per_worker, self.warmup, self._stop_flag, os.getpid()),
+            name="ocr-inference-host"
+        )
+        process.start()
+        control.close()
+        return process
+
+    def _fail_running(self, index: int, reason: str):
+        """推理进程退出时，让它正在处理的请求失败"""
+        with self._lock:
+            request_id = self._running.pop(index, None)
+            entry = self._futures.pop(request_id, None) if request_id is not None else None
+            self._streams.pop(request_id, None)
+        if entry is not None and not entry[0].done():
+            entry[0].set_exception(RuntimeError(reason))
+
+    def _collect(self):
+        """收集推理结果并分发给 Future；推理进程或宿主进程异常退出时让相应的请求失败"""
+        while True:
+            self._handle_control()
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                self._check_host()
+                continue
+            if message is None:
+                return
+
+            if message[0] == "started":
+                _, request_id, index, started_at = message
+                with self._lock:
+                    self._running[index] = request_id
+                    entry = self._futures.get(request_id)
+                    if entry is not None and entry[0].cancelled():
+                        self._cancel_flags[index] = request_id
+                if entry is not None:
+                    BATCH_QUEUE_WAIT_SECONDS.observe(max(0.0, started_at - entry[1]))
+                    BATCH_SIZE.observe(1)
+                continue
+
+            if message[0] == "delta":
+                _, request_id, delta = message
+                with self._lock:
+                    on_text = self._streams.get(request_id)
+                if on_text is not None:
+                    on_text(delta)
+                continue
+
+            if message[0] == "skipped":
+                with self._lock:
+                    self._futures.pop(message[1], None)
+                    self._streams.pop(message[1], None)
+                continue
+
+            if message[0] == "warmed":
+                self._record_warmup(*message[1:])
+                continue
+
+            _, request_id, ok, payload, seconds = message
+            with self._lock:
+                entry = self._futures.pop(request_id, None)
+                self._streams.pop(request_id, None)
+                for index, running_id in list(self._running.items()):
+                    if running_id == request_id:
+                        del self._running[index]
+            self._record_throughput(seconds)
+            if entry is None or entry[0].done():
+                continue
+            if ok:
+                entry[0].set_result(payload)
+            else:
+                entry[0].set_exception(RuntimeError(payload))
+
+    def _handle_control(self):
+        """处理宿主进程发来的消息"""
+        try:
+            while self._control.poll():
+                message = self._control.recv()
+                if message[0] == "exited":
+                    _, index, exitcode = message
+                    logger.error(f"推理进程 ocr-inference-{index} 异常退出（exitcode={exitcode}），已重新启动")
+                    self._fail_running(index, f"推理进程异常退出（exitcode={exitcode}）")
+                elif message[0] == "ready":
+                    self.backend_revision = message[1]
+                    logger.info("推理进程池宿主进程已重新启动")
+                elif message[0] == "failed":
+                    logger.error(f"❌ 推理进程池宿主进程重新启动失败: {message[1]}")
+        except (EOFError, OSError):
+            # 宿主进程已退出，由 _check_host 处理
+            pass
+
+    def _check_host(self):
+        """宿主进程异常退出时（推理进程随之退出），让正在推理的请求失败并重新启动（重新加载模型）"""
+        if self._stopping or self._host is None or self._host.is_alive():
+            return
+        logger.error(f"推理进程池宿主进程异常退出（exitcode={self._host.exitcode}），重新启动")
+        for index in list(self._running):
+            self._fail_running(index, f"推理进程池宿主进程异常退出（exitcode={self._host.exitcode}）")
+        self._host = self._spawn_host()
+
+    def _record_warmup(self, index: int, name: str, seconds: Optional[float], error: Optional[str]):
+        """记录一个推理进程一个模式的预热结果；启动时的全部进程都报告后唤醒 wait_warmup"""
+        if error is not None:
+            logger.error(f"❌ 推理进程 ocr-inference-{index} 预热 {name} 模式失败: {error}")
+        else:
+            logger.info(f"推理进程 ocr-inference-{index} 预热 {name} 模式完成: {seconds:.2f} 秒")
+        self._warmup_seconds.setdefault(name, [])
+        if seconds is not None:
+            self._warmup_seconds[name].append(seconds)
+        self._warmup_reports += 1
+        if self._warmup_reports >= self.workers * len(self.warmup):
+            self._warmed.set()
+
+    def _record_throughput(self, seconds: float, alpha: float = 0.2):
+        per_page = seconds / self.workers
+        if self.seconds_per_page is None:
+            self.seconds_per_page = per_page
+        else:
+            self.seconds_per_page = alpha * per_page + (1 - alpha) * self.seconds_per_page
+
+
+# skip_special_tokens=False 时输出文本末尾的结束符
+VLLM_EOS_TEXT = "<｜end▁of▁sentence｜>"
+
+
+class VLLMEngine(InferenceBackend):
+    """
+    vLLM 推理后端（AsyncLLMEngine 连续批处理，自带调度，同时提供与 InferenceWorker 相同的接口）
+
+    每一页作为一个独立的引擎请求提交，引擎在每个解码步把所有并发请求、所有页面交织调度：
+    新页面随时加入正在解码的批次，先结束的页面立即让出位置，不必等整批完成。
+    各页结果由调用方（iter_ocr_job）按页码重新组装。
+
+    仓库中的 vLLM 实现在导入时从 config 模块读取识别模式，因此一个进程只服务 VLLM_MODE 一种模式，
+    其他模式的请求返回 400。
+    """
+
+    name = "vllm"
+
+    def __init__(self, mode: str, max_num_seqs: int, gpu_memory_utilization: float, max_model_len: int):
+        self.mode = mode
+        # 模式对应的推理参数，load() 时确定
+        self.base_size = self.image_size = self.crop_mode = None
+        self.max_num_seqs = max(1, max_num_seqs)
+        self.gpu_memory_utilization = gpu_memory_utilization
+        self.max_model_len = max_model_len
+        # 等效每页耗时（单页耗时 / 同时解码的页数），供准入控制估算排队时间
+        self.seconds_per_page: Optional[float] = None
+        self.engine = None
+        self._processor = None
+        self._sampling_params = None
+        self._ids = itertools.count()
+        # 已提交、尚未结束的页面数
+        self._active = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def load(self):
+        """导入 vLLM 并创建引擎（在线程中调用，替代 load_model）"""
+        try:
+            self._create_engine()
+        except Exception as e:
+            logger.error(f"❌ vLLM 引擎创建失败: {str(e)}")
+            raise
+
+    def _create_engine(self):
+        global tokenizer
+
+        modes = {name.lower(): key for key, name in MODES.items()}
+        if self.mode.lower() not in modes:
+            raise ValueError(f"未知的 VLLM_MODE: {self.mode}（可选: {', '.join(MODES.values())}）")
+        self.base_size, self.image_size, self.crop_mode = modes[self.mode.lower()]
+        self.mode = MODES[(self.base_size, self.image_size, self.crop_mode)]
+
+        os.environ.setdefault("CUDA_VISIBLE_DEVICES", CUDA_DEVICE)
+        # 仓库中的 DeepseekOCRForCausalLM 基于 vLLM V0 引擎实现
+        os.environ["VLLM_USE_V1"] = "0"
+        load_start = phase_start = time.perf_counter()
+        from transformers import AutoTokenizer
+        phase_start = _record_startup_phase("imports", phase_start)
+
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+        phase_start = _record_startup_phase("tokenizer", phase_start)
+
+        # deepseek_ocr.py 和 image_process.py 在导入时从 config 读取模式、提示词和 tokenizer；
+        # 用服务自己的配置代替 config.py（其中的 MODEL_PATH 指向 Hugging Face Hub，导入时就会下载 tokenizer）
+        config = types.ModuleType("config")
+        config.__dict__.update(
+            BASE_SIZE=self.base_size, IMAGE_SIZE=self.image_size, CROP_MODE=self.crop_mode,
+            MIN_CROPS=2, MAX_CROPS=VLLM_MAX_CROPS, MAX_CONCURRENCY=self.max_num_seqs, NUM_WORKERS=1,
+            PRINT_NUM_VIS_TOKENS=False, SKIP_REPEAT=True, MODEL_PATH=MODEL_PATH, PROMPT=DEFAULT_PROMPT,
+            TOKENIZER=tokenizer
+        )
+        sys.modules["config"] = config
+        if str(VLLM_CODE_DIR) not in sys.path:
+            sys.path.insert(0, str(VLLM_CODE_DIR))
+
+        from vllm import AsyncLLMEngine, SamplingParams
+        from vllm.engine.arg_utils import AsyncEngineArgs
+        from vllm.model_executor.models.registry import ModelRegistry
+        from deepseek_ocr import DeepseekOCRForCausalLM
+        from process.image_process import DeepseekOCRProcessor
+        from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+        phase_start = _record_startup_phase("vllm_imports", phase_start)
+
+        logger.info(f"创建 vLLM 引擎: {MODEL_PATH}（{self.mode} 模式，max_num_seqs={self.max_num_seqs}）")
+        ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+        self.engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+            model=MODEL_PATH,
+            hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+            block_size=256,
+            max_model_len=self.max_model_len,
+            max_num_seqs=self.max_num_seqs,
+            enforce_eager=False,
+            trust_remote_code=True,
+            tensor_parallel_size=1,
+            gpu_memory_utilization=self.gpu_memory_utilization
+        ))
+        self._processor = DeepseekOCRProcessor()
+        self._sampling_params = SamplingParams(
+            temperature=0.0,
+            max_tokens=self.max_model_len,
+            # 抑制重复的 n-gram（表格的 <td>、</td> 除外）
+            logits_processors=[NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90,
+                                                            whitelist_token_ids={128821, 128822})],
+            skip_special_tokens=False
+        )
+        _record_startup_phase("weights", phase_start)
+        STARTUP_TIMINGS["load_total"] = round(time.perf_counter() - load_start, 3)
+        logger.info(f"✅ vLLM 引擎创建成功！（{STARTUP_TIMINGS['load_total']:.1f} 秒）")
+
+    def revision(self) -> str:
+        # 解码设置（重复 n-gram 抑制等）与 HF 后端不同，结果分开缓存
+        return f"{MODEL_PATH}+vllm"
+
+    def fork_safe(self) -> bool:
+        return False
+
+    def infer_page(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                   cancelled: Optional[Callable[[], bool]] = None,
+                   on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        """在其他线程中同步识别一页（提交到事件循环中的引擎）"""
+        if cancelled is not None and cancelled():
+            raise InferenceCancelled("页面已取消")
+        return asyncio.run_coroutine_threadsafe(self.infer(image, settings, on_text), self._loop).result()
+
+    def start(self):
+        """记录事件循环；引擎的后台调度循环在第一次提交请求时启动"""
+        self._loop = asyncio.get_running_loop()
+
+    def stop(self):
+        """停止引擎的后台调度循环"""
+        if self.engine is not None and self.engine.is_running:
+            self.engine.shutdown_background_loop()
+
+    @property
+    def pending(self) -> int:
+        """超出同时解码上限、在引擎中排队的页面数"""
+        return max(0, self._active - self.max_num_seqs)
+
+    @property
+    def page_concurrency(self) -> int:
+        """单个文档同时提交的页数：引擎能同时解码的序列数"""
+        return self.max_num_seqs
+
+    def supports(self, settings: Dict[str, Any]) -> bool:
+        """推理参数是否属于引擎服务的模式"""
+        return (settings["base_size"], settings["image_size"], settings["crop_mode"]) == \
+            (self.base_size, self.image_size, self.crop_mode)
+
+    def _preprocess(self, image: Union[str, Image.Image]) -> tuple:
+        """读取图片并切片、归一化（CPU 密集，在线程中执行）"""
+        if isinstance(image, Image.Image):
+            image = image.convert("RGB")
+        else:
+            with Image.open(image) as img:
+                image = ImageOps.exif_transpose(img).convert("RGB")
+        features = self._processor.tokenize_with_images(images=[image], bos=True, eos=True, cropping=self.crop_mode)
+        return image.size, features
+
+    async def infer(self, image: Union[str, Image.Image], settings: Dict[str, Any],
+                    on_text: Optional[Callable[[str], None]] = None) -> OCRResult:
+        """
+        提交单页推理请求并异步等待结果
+
+        等待的协程被取消时中止引擎请求，立即释放其解码槽位和 KV cache。
+        给出 on_text 时，每个解码步以增量文本回调（在事件循环中调用）。
+        """
+        if not self.supports(settings):
+            raise UnsupportedSettings(
+                f"vLLM 后端只支持 {self.mode} 模式（base_size={self.base_size}, "
+                f"image_size={self.image_size}, crop_mode={self.crop_mode}）"
+            )
+
+        request_id = f"ocr-{next(self._ids)}"
+        self._active += 1
+        start = time.perf_counter()
+        try:
+            (width, height), features = await asyncio.to_thread(self._preprocess, image)
+            preprocess_seconds = time.perf_counter() - start
+
+            text, token_ids = "", ()
+            request = {"prompt": settings["prompt"], "multi_modal_data": {"image": features}}
+            try:
+                async for output in self.engine.generate(request, self._sampling_params, request_id):
+                    if not output.outputs:
+                        continue
+                    completion = output.outputs[0]
+                    current = completion.text.replace(VLLM_EOS_TEXT, "")
+                    if on_text is not None and len(current) > len(text):
+                        on_text(current[len(text):])
+                    text, token_ids = current, completion.token_ids
+            except asyncio.CancelledError:
+                await self.engine.abort(request_id)
+                raise
+            infer_seconds = time.perf_counter() - start - preprocess_seconds
+            self._record_throughput(time.perf_counter() - start, self._active)
+        finally:
+            self._active -= 1
+
+        extract_start = time.perf_counter()
+        result = OCRResult(
+            text=text,
+            image_size=(width, height),
+            output_tokens=len(token_ids),
+            vision_tokens=estimate_vision_tokens(width, height, settings),
+            blocks=parse_grounding(text)
+        )
+        result.timings = {
+            "preprocess": preprocess_seconds,
+            "inference": infer_seconds,
+            "extract": time.perf_counter() - extract_start
+        }
+        return result
+
+    def _record_throughput(self, seconds: float, active: int, alpha: float = 0.2):
+        """按完成时同时解码的页数（含本页）折算单页耗时"""
+        per_page = seconds / max(1, min(active, self.max_num_seqs))
+        if self.seconds_per_page is None:
+            self.seconds_per_page = per_page
+        else:
+            self.seconds_per_page = alpha * per_page + (1 - alpha) * self.seconds_per_page
+
+
+def create_backend(name: str) -> InferenceBackend:
+    """按 INFERENCE_BACKEND 创建推理后端"""
+    if name == "vllm":
+        return VLLMEngine(VLLM_MODE, VLLM_MAX_NUM_SEQS, VLLM_GPU_MEMORY_UTILIZATION, VLLM_MAX_MODEL_LEN)
+    if name == "fake":
+        return FakeBackend(FAKE_VISION_TOKEN_MS, FAKE_OUTPUT_TOKEN_MS, FAKE_OUTPUT_TOKENS)
+    if name != "hf":
+        logger.warning(f"未知的推理后端: {name}（可选: hf, vllm, fake），使用 hf")
+    return HFBackend()
+
+
+backend = create_backend(INFERENCE_BACKEND)
+inference_worker = InferenceWorker(backend, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+
+
+@dataclass
+class AdmissionTicket:
+    """已准入请求占用的队列额度"""
+    pages: int = 1  # 尚未识别完的页数
+    released: bool = False
+    counts_request: bool = True  # False 为多文件请求中一项的额度（见 AdmissionController.split），不另计请求数
+
+
+class AdmissionController:
+    """
+    准入控制（有界工作队列）
+
+    限制同时处理（含排队）的请求数和待识别的总页数。队列已满时立即返回 429，
+    并根据待识别页数和实测的每页推理耗时给出 Retry-After，避免请求在模型前无限堆积直到客户端超时。
+
+    只在事件循环中调用，不需要加锁。
+    """
+
+    # 尚无实测数据时假定的每页推理耗时（秒）
+    DEFAULT_SECONDS_PER_PAGE = 5.0
+    MAX_RETRY_AFTER = 600
+
+    def __init__(self, max_requests: int, max_pages: int):
+        self.max_requests = max_requests
+        self.max_pages = max_pages
+        self.requests = 0
+        self.pages = 0
+
+    def retry_after(self) -> int:
+        """按待识别页数和每页耗时估算队列清空所需的秒数"""
+        seconds_per_page = inference_worker.seconds_per_page or self.DEFAULT_SECONDS_PER_PAGE
+        return max(1, min(self.MAX_RETRY_AFTER, math.ceil(self.pages * seconds_per_page)))
+
+    def check(self) -> Optional[str]:
+        """队列是否已满：返回拒绝原因（requests / pages），未满时返回 None"""
+        if self.max_requests and self.requests >= self.max_requests:
+            return "requests"
+        if self.max_pages and self.pages >= self.max_pages:
+            return "pages"
+        return None
+
+    def rejection(self, reason: str) -> HTTPException:
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        retry_after = self.retry_after()
+        logger.warning(f"队列已满（{self.requests} 个请求，{self.pages} 页待识别），拒绝请求，Retry-After={retry_after}")
+        return HTTPException(
+            status_code=429,
+            detail=f"服务繁忙：队列中有 {self.requests} 个请求、{self.pages} 页待识别，请 {retry_after} 秒后重试",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def acquire(self, pages: int = 1) -> AdmissionTicket:
+        """准入一个请求（先按 pages 页占用额度），队列已满时抛出 429"""
+        reason = self.check()
+        if reason is not None:
+            raise self.rejection(reason)
+        ticket = AdmissionTicket(pages=pages)
+        self.requests += 1
+        self.pages += pages
+        self._update_metrics()
+        return ticket
+
+    def reserve(self, ticket: AdmissionTicket, pages: int):
+        """
+        页数确定后（如 PDF 打开后）调整占用的页数
+
+        超出页数上限时抛出 429；队列中只有这一个请求时总是放行，避免超长文档永远无法处理。
+        """
+        if pages > ticket.pages and self.max_pages and self.requests > 1 \
+                and self.pages - ticket.pages + pages > self.max_pages:
+            raise self.rejection("pages")
+        self.pages += pages - ticket.pages
+        ticket.pages = pages
+        self._update_metrics()
+
+    def split(self, ticket: AdmissionTicket) -> AdmissionTicket:
+        """
+        从多文件请求的额度中分出一项：该项预占的 1 页转给新的额度，之后像单个请求一样按实际页数 reserve
+
+        分出的额度不另计请求数，release 时只归还它剩余的页数。
+        """
+        moved = 1 if ticket.pages > 0 and not ticket.released else 0
+        ticket.pages -= moved
+        if not moved:
+            self.pages += 1
+            self._update_metrics()
+        return AdmissionTicket(pages=1, counts_request=False)
+
+    def page_done(self, ticket: AdmissionTicket):
+        """一页识别完成，释放该页的额度"""
+        if ticket.pages > 0 and not ticket.released:
+            ticket.pages -= 1
+            self.pages -= 1
+            self._update_metrics()
+
+    def release(self, ticket: AdmissionTicket):
+        """请求结束，释放全部额度（可重复调用）"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.counts_request:
+            self.requests -= 1
+        self.pages -= ticket.pages
+        ticket.pages = 0
+        self._update_metrics()
+
+    def _update_metrics(self):
+        ADMISSION_QUEUE_REQUESTS.set(self.requests)
+        ADMISSION_QUEUE_PAGES.set(self.pages)
+
+
+admission_controller = AdmissionController(ADMISSION_MAX_REQUESTS, ADMISSION_MAX_PAGES)
+
+
+class ResultCache:
+    """
+    OCR 结果缓存（按内容寻址）
+
+    键为内容哈希（整个上传文件，或 PDF 单页渲染结果）加推理参数和模型版本，值为各页的 OCRResult（JSON）。
+    两级存储：内存中的 LRU（按条目数淘汰），以及磁盘目录（按总大小淘汰最久未访问的条目）；
+    磁盘命中会提升到内存。所有方法线程安全，异步代码中应通过 asyncio.to_thread 调用。
+    """
+
+    def __init__(self, cache_dir: Path, memory_entries: int = 256, disk_bytes: int = 1024 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_usage = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for path in self.cache_dir.glob("*.json"):
+            self._disk_usage += path.stat().st_size
+        RESULT_CACHE_DISK_BYTES.set(self._disk_usage)
+
+    @staticmethod
+    def make_key(content_hash: str, settings: Dict[str, Any], revision: str) -> str:
+        """由内容哈希、推理参数和模型版本生成缓存键"""
+        payload = json.dumps({"content": content_hash, "settings": settings, "revision": revision}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str, level: str = "document") -> Optional[List[OCRResult]]:
+        """查询缓存，未命中返回 None（level 只用于监控指标：document 整个文件 / page 单页）"""
+        with self._lock:
+            pages = self._memory.get(key)
+            if pages is not None:
+                self._memory.move_to_end(key)
+                RESULT_CACHE_REQUESTS.labels(level=level, result="hit_memory").inc()
+                return [OCRResult.from_dict(p) for p in pages]
+
+        path = self._path(key)
+        try:
+            pages = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)  # 记录访问时间，供磁盘淘汰使用
+        except (OSError, ValueError):
+            RESULT_CACHE_REQUESTS.labels(level=level, result="miss").inc()
+            return None
+
+        with self._lock:
+            self._remember(key, pages)
+        RESULT_CACHE_REQUESTS.labels(level=level, result="hit_disk").inc()
+        return [OCRResult.from_dict(p) for p in pages]
+
+    def put(self, key: str, results: List[OCRResult]):
+        """写入缓存（内存和磁盘）"""
+        pages = [r.to_dict() for r in results]
+        data = json.dumps(pages, ensure_ascii=False).encode("utf-8")
+
+        with self._lock:
+            self._remember(key, pages)
+
+            path = self._path(key)
+            old_size = path.stat().st_size if path.exists() else 0
+            temp_path = path.with_suffix(".tmp")
+            temp_path.write_bytes(data)
+            temp_path.replace(path)
+            self._disk_usage += len(data) - old_size
+            self._evict_disk()
+
+    def _remember(self, key: str, pages: list):
+        self._memory[key] = pages
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            RESULT_CACHE_EVICTIONS.labels(tier="memory").inc()
+
+    def _evict_disk(self):
+        """磁盘占用超出上限时，按访问时间从旧到新删除"""
+        if self._disk_usage > self.disk_bytes:
+            entries = []
+            for path in self.cache_dir.glob("*.json"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+
+            for _, size, path in entries:
+                if self._disk_usage <= self.disk_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                self._disk_usage -= size
+                RESULT_CACHE_EVICTIONS.labels(tier="disk").inc()
+
+        RESULT_CACHE_DISK_BYTES.set(self._disk_usage)
+
+
+result_cache = ResultCache(
+    RESULT_CACHE_DIR,
+    memory_entries=RESULT_CACHE_MEMORY_ENTRIES,
+    disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024
+) if RESULT_CACHE_ENABLED else None
+
+
+def model_revision() -> str:
+    """模型版本标识（参与缓存键计算，换模型后旧缓存自动失效）"""
+    if MODEL_REVISION:
+        return MODEL_REVISION
+    # 多进程推理时模型只在宿主进程中加载
+    if isinstance(inference_worker, InferencePool) and inference_worker.backend_revision:
+        return inference_worker.backend_revision
+    return backend.revision()
+
+
+class RetentionManager:
+    """
+    uploads/ 与 outputs/ 的保留期和容量管理
+
+    后台定期清理（不在请求路径上执行）：
+    - 超过保留期（TTL）的任务输出目录和上传文件
+    - 总大小超过配额时，从最旧的条目开始删除
+    - 启动时清理遗留的 PDF 页面图片和推理临时文件
+    未结束任务的文件不会被删除；输出目录被删除的任务同时从任务表移除（查询和下载返回 404）。
+    """
+
+    # 早期版本转换 PDF 时在 uploads/ 中留下的页面图片：{task_id}_page_{n}.png
+    ORPHAN_PAGE_PATTERN = re.compile(r".+_page_\d+\.png$")
+
+    def __init__(self, upload_dir: Path, output_dir: Path, ttl_hours: float, max_gb: float, interval_seconds: float):
+        self.upload_dir = Path(upload_dir)
+        self.output_dir = Path(output_dir)
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.interval = max(1.0, interval_seconds)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """启动后台清理任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"文件保留管理已启动（TTL {self.ttl / 3600:g} 小时，配额 {self.max_bytes / 1024 ** 3:g} GB，间隔 {self.interval:g} 秒）")
+
+    async def stop(self):
+        """停止后台清理任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        try:
+            await asyncio.to_thread(self.sweep_orphans)
+        except Exception as e:
+            logger.warning(f"清理遗留文件失败: {e}")
+
+        while True:
+            try:
+                active = {job.task_id for job in JOBS.values() if not job.finished}
+                expired = await asyncio.to_thread(self.sweep, active)
+                for task_id in expired:
+                    job = JOBS.get(task_id)
+                    if job is not None and job.finished:
+                        forget_job(job)
+            except Exception as e:
+                logger.warning(f"文件保留清理失败: {e}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def _measure(path: Path) -> tuple:
+        """返回 (大小, 最后修改时间)，目录取其中所有文件的合计和最新时间"""
+        stat = path.stat()
+        if not path.is_dir():
+            return stat.st_size, stat.st_mtime
+
+        size, mtime = 0, stat.st_mtime
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    file_stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                size += file_stat.st_size
+                mtime = max(mtime, file_stat.st_mtime)
+        return size, mtime
+
+    def _remove(self, path: Path, size: int, reason: str):
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        RETENTION_RECLAIMED_BYTES.labels(reason=reason).inc(size)
+        RETENTION_RECLAIMED_ENTRIES.labels(reason=reason).inc()
+
+    def sweep_orphans(self):
+        """清理遗留的 PDF 页面图片和推理临时目录中的文件"""
+        candidates = [p for p in self.upload_dir.glob("*.png") if self.ORPHAN_PAGE_PATTERN.match(p.name)]
+        candidates += [p for p in INFER_SCRATCH_DIR.glob("**/*") if p.is_file()]
+
+        reclaimed = 0
+        for path in candidates:
+            try:
+                size = path.stat().st_size
+            except OSError:
+                continue
+            self._remove(path, size, "orphan")
+            reclaimed += size
+
+        if candidates:
+            logger.info(f"已清理遗留文件 {len(candidates)} 个，共 {reclaimed / 1024 ** 2:.1f} MB")
+
+    def sweep(self, active_task_ids: set) -> set:
+        """按 TTL 和配额清理一次，返回输出目录被删除的 task_id"""
+        entries = []
+        usage = {}
+        for directory in (self.upload_dir, self.output_dir):
+            usage[directory.name] = 0
+            for path in directory.iterdir():
+                if path.name.startswith("."):
+                    continue
+                try:
+                    size, mtime = self._measure(path)
+                except OSError:
+                    continue
+                usage[directory.name] += size
+                task_id = path.name.split(".")[0] if directory == self.upload_dir else path.name
+                if task_id not in active_task_ids:
+                    entries.append((mtime, size, path))
+
+        entries.sort(key=lambda e: e[0])
+        now = time.time()
+        removed = []
+        index = 0
+
+        # 1. 超过保留期
+        if self.ttl > 0:
+            while index < len(entries) and now - entries[index][0] > self.ttl:
+                removed.append((entries[index], "ttl"))
+                index += 1
+
+        # 2. 超出总配额时从最旧的开始删除
+        if self.max_bytes > 0:
+            total = sum(usage.values()) - sum(entry[1] for entry, _ in removed)
+            while index < len(entries) and total > self.max_bytes:
+                entry = entries[index]
+                removed.append((entry, "quota"))
+                total -= entry[1]
+                index += 1
+
+        expired = set()
+        for (_, size, path), reason in removed:
+            self._remove(path, size, reason)
+            usage[path.parent.name] -= size
+            if path.parent == self.output_dir:
+                expired.add(path.name)
+
+        for name, value in usage.items():
+            STORAGE_BYTES.labels(dir=name).set(value)
+
+        if removed:
+            logger.info(f"文件保留清理：删除 {len(removed)} 个条目，共 {sum(e[1] for e, _ in removed) / 1024 ** 2:.1f} MB")
+        return expired
+
+
+retention_manager = RetentionManager(
+    UPLOAD_DIR,
+    OUTPUT_DIR,
+    ttl_hours=RETENTION_TTL_HOURS,
+    max_gb=RETENTION_MAX_GB,
+    interval_seconds=RETENTION_INTERVAL_SECONDS
+)
+
+
+def build_settings(prompt: Optional[str], base_size: int, image_size: int, crop_mode: bool) -> Dict[str, Any]:
+    """整理推理参数（未指定 prompt 时使用默认提示词）"""
+    return {
+        "prompt": prompt if prompt is not None else DEFAULT_PROMPT,
+        "base_size": base_size,
+        "image_size": image_size,
+        "crop_mode": crop_mode
+    }
+
+
+# 支持的模式：(base_size, image_size, crop_mode) -> 模式名
+MODES = {
+    (512, 512, False): "Tiny",
+    (640, 640, False): "Small",
+    (1024, 1024, False): "Base",
+    (1280, 1280, False): "Large",
+    (1024, 640, True): "Gundam"
+}
+
+
+def mode_name(settings: Dict[str, Any]) -> str:
+    """推理参数对应的模式名（不属于预设模式时为 Custom）"""
+    return MODES.get((settings["base_size"], settings["image_size"], settings["crop_mode"]), "Custom")
+
+
+def build_result_files(task_id: str, output_path: str, total_pages: int = 1) -> Dict[str, Any]:
+    """构建结果文件的下载路径（相对路径）"""
+    files = {
+        "text": f"/download/{task_id}/result.txt",
+        "markdown": f"/download/{task_id}/result.mmd" if Path(output_path, "result.mmd").exists() else None,
+        "image_with_boxes": f"/download/{task_id}/result_with_boxes.jpg" if Path(output_path, "result_with_boxes.jpg").exists() else None
+    }
+    if total_pages > 1:
+        files["pages_with_boxes"] = [
+            f"/download/{task_id}/{name}"
+            for name in (page_boxes_name(idx) for idx in range(1, total_pages + 1))
+            if Path(output_path, name).exists()
+        ] or None
+    return files
+
+
+def page_boxes_name(page: int) -> str:
+    """多页文档中单页可视化图片的文件名"""
+    return f"page_{page}_with_boxes.jpg"
+
+
+@dataclass
+class Job:
+    """OCR 任务"""
+    task_id: str
+    filename: str
+    settings: Dict[str, Any]
+    status: str = "queued"  # queued / running / success / failed / cancelled
+    cache_key: Optional[str] = None  # 结果缓存键（None 表示不使用缓存）
+    bypass_cache: bool = False  # 跳过缓存查询（结果仍会写入缓存）
+    cache_hit: bool = False
+    pages_from_cache: int = 0  # 直接使用缓存结果、未经推理的页数
+    upload_seconds: Optional[float] = None  # 接收并保存上传文件的耗时
+    page_spec: Optional[str] = None  # 页码范围（如 "1-3,10,-1"），None 表示全部页面
+    admission: Optional[AdmissionTicket] = None  # 准入额度，任务结束时释放
+    request_key: Optional[str] = None  # 内容哈希 + 推理参数 + 页码范围 + save_results，相同即为重复请求
+    idempotency_key: Optional[str] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)  # 任务结束（成功或失败）时置位
+    file_type: Optional[str] = None
+    total_pages: int = 0  # 文档总页数
+    selected_pages: Optional[List[int]] = None  # 实际处理的页码
+    completed_pages: int = 0
+    pages: List[Dict[str, Any]] = field(default_factory=list)
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    error_status: Optional[int] = None  # 失败时的 HTTP 状态码，合并进来的请求返回相同的错误
+    deadline: Optional[float] = None  # 任务自身的截止时刻（time.monotonic，流式、/jobs 和批量中的文件），超过后取消剩余页面
+    cancel_reason: Optional[str] = None  # disconnect / deadline
+    task: Optional[asyncio.Task] = field(default=None, repr=False)  # 执行任务的后台协程
+    watchers: int = 0  # 正在等待结果的请求数，全部断开时取消任务
+    detached: bool = False  # /jobs 提交的任务由客户端轮询结果，不因请求断开而取消
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("success", "failed", "cancelled")
+
+    def to_dict(self) -> dict:
+        """任务状态（GET /jobs/{task_id} 的响应）"""
+        target = len(self.selected_pages) if self.selected_pages is not None else self.total_pages
+        percent = round(self.completed_pages / target * 100, 1) if target else 0.0
+        return {
+            "task_id": self.task_id,
+            "status": self.status,
+            "filename": self.filename,
+            "file_type": self.file_type,
+            "progress": {
+                "completed_pages": self.completed_pages,
+                "total_pages": self.total_pages,
+                "selected_pages": self.selected_pages,
+                "percent": percent
+            },
+            "pages": self.pages,
+            "cache_hit": self.cache_hit,
+            "pages_from_cache": self.pages_from_cache,
+            "files": self.result["files"] if self.result else None,
+            "result": self.result,
+            "error": self.error,
+            "cancel_reason": self.cancel_reason,
+            "settings": self.settings,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+# 任务表：task_id -> Job
+JOBS: Dict[str, Job] = {}
+# 进行中、可被相同请求合并的任务：request_key -> Job
+INFLIGHT_JOBS: Dict[str, Job] = {}
+# Idempotency-Key -> task_id（随任务一起从任务表淘汰或被文件保留清理移除）
+IDEMPOTENCY_KEYS: Dict[str, str] = {}
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# 后台任务引用，防止 asyncio.Task 被垃圾回收
+_BACKGROUND_TASKS: set = set()
+
+
+def create_job(task_id: str, filename: str, settings: Dict[str, Any],
+               content_hash: Optional[str] = None, bypass_cache: bool = False,
+               page_spec: Optional[str] = None, request_key: Optional[str] = None,
+               idempotency_key: Optional[str] = None) -> Job:
+    """
+    登记新任务，并淘汰超出上限的已结束任务
+
+    给出 request_key 时任务登记为进行中，之后的相同请求合并到该任务（见 find_duplicate_job）。
+    bypass_cache 的任务要求重新识别，不登记为进行中，也不会被其他请求合并（Idempotency-Key 仍然有效）。
+    """
+    job = Job(task_id=task_id, filename=filename, settings=settings, bypass_cache=bypass_cache, page_spec=page_spec,
+              request_key=request_key, idempotency_key=idempotency_key)
+    # 只处理部分页面时不使用文档级缓存（PDF 仍可按页命中页面级缓存）
+    if content_hash is not None and page_spec is None:
+        job.cache_key = ResultCache.make_key(content_hash, settings, model_revision())
+    JOBS[task_id] = job
+    if request_key is not None and not bypass_cache:
+        INFLIGHT_JOBS[request_key] = job
+    if idempotency_key is not None:
+        IDEMPOTENCY_KEYS[idempotency_key] = task_id
+
+    finished = [j for j in JOBS.values() if j.finished]
+    if len(finished) > JOB_HISTORY_LIMIT:
+        finished.sort(key=lambda j: j.finished_at or 0)
+        for old_job in finished[:len(finished) - JOB_HISTORY_LIMIT]:
+            forget_job(old_job)
+
+    return job
+
+
+def forget_job(job: Job):
+    """从任务表移除已结束的任务及其 Idempotency-Key"""
+    JOBS.pop(job.task_id, None)
+    if job.idempotency_key and IDEMPOTENCY_KEYS.get(job.idempotency_key) == job.task_id:
+        IDEMPOTENCY_KEYS.pop(job.idempotency_key)
+
+
+def make_request_key(content_hash: str, settings: Dict[str, Any], page_spec: Optional[str], save_results: bool,
+                     bypass_cache: bool) -> str:
+    """请求的去重键：内容、推理参数、页码范围、save_results 和 bypass_cache 都相同的请求结果相同"""
+    payload = json.dumps({"content": content_hash, "settings": settings, "pages": page_spec,
+                          "save_results": save_results, "bypass_cache": bypass_cache,
+                          "revision": model_revision()}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def validate_idempotency_key(idempotency_key: Optional[str]) -> Optional[str]:
+    """校验 Idempotency-Key 请求头，空值视为未提供"""
+    if idempotency_key is None or not idempotency_key.strip():
+        return None
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key 不能超过 {IDEMPOTENCY_KEY_MAX_LENGTH} 个字符")
+    return idempotency_key.strip()
+
+
+def find_duplicate_job(request_key: str, idempotency_key: Optional[str], deadline: Optional[float] = None,
+                       detached: bool = False) -> Optional[Tuple[Job, str]]:
+    """
+    查找可以直接复用的任务
+
+    1. 相同 Idempotency-Key 的原任务（失败或已取消的任务不复用，重试会重新识别）；
+       同一个 Key 用于内容或参数不同的请求时返回 422
+    2. 进行中的相同请求（single-flight），新请求等待它的结果而不是再识别一遍。
+       任务自身的截止时间早于新请求时不合并（否则新请求会随它一起超时）；
+       带截止时间的 /jobs 请求（detached）由任务自身的截止时间控制，也不合并
+
+    Returns:
+        (任务, 原因 idempotency / inflight)，没有可复用的任务时返回 None
+    """
+    if idempotency_key is not None:
+        job = JOBS.get(IDEMPOTENCY_KEYS.get(idempotency_key, ""))
+        if job is not None and job.status not in ("failed", "cancelled"):
+            if job.request_key != request_key:
+                raise HTTPException(status_code=422, detail="Idempotency-Key 已用于内容或参数不同的请求")
+            REQUESTS_COALESCED.labels("idempotency").inc()
+            logger.info(f"Idempotency-Key 重复，返回原任务: {job.task_id}")
+            return job, "idempotency"
+
+    job = INFLIGHT_JOBS.get(request_key)
+    if job is not None and job.deadline is not None and (deadline is None or job.deadline < deadline):
+        job = None
+    if job is not None and detached and deadline is not None:
+        job = None
+    if job is not None:
+        REQUESTS_COALESCED.labels("inflight").inc()
+        logger.info(f"合并到进行中的相同请求: {job.task_id}")
+        return job, "inflight"
+    return None
+
+
+def request_deadline(deadline_ms: Optional[int], request_timeout: Optional[str]) -> Optional[float]:
+    """
+    请求的截止时刻（time.monotonic），从收到请求开始计算
+
+    Args:
+        deadline_ms: deadline_ms 参数（毫秒）
+        request_timeout: X-Request-Timeout 请求头（秒，可以是小数）；两者都提供时取较早者
+    """
+    timeouts = []
+    if deadline_ms is not None:
+        if deadline_ms <= 0:
+            raise HTTPException(status_code=400, detail="deadline_ms 必须大于 0")
+        timeouts.append(deadline_ms / 1000)
+    if request_timeout is not None and request_timeout.strip():
+        try:
+            seconds = float(request_timeout)
+        except ValueError:
+            seconds = 0.0
+        if not seconds > 0:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout 必须是大于 0 的秒数")
+        timeouts.append(seconds)
+    return time.monotonic() + min(timeouts) if timeouts else None
+
+
+def start_job(job: Job, source: Union[Path, bytes], save_results: bool) -> asyncio.Task:
+    """在后台协程中执行任务，请求处理协程只等待结果（客户端断开时可以取消任务）"""
+    task = asyncio.create_task(_run_job_in_background(job, source, save_results))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    job.task = task
+    return task
+
+
+def cancel_job(job: Job, reason: str):
+    """取消执行中的任务：剩余页面不再识别，正在推理的页面在下一个解码步停止"""
+    if job.task is None or job.task.done() or job.detached:
+        return
+    logger.info(f"取消任务 {job.task_id}（{reason}）")
+    job.cancel_reason = reason
+    job.task.cancel()
+
+
+async def wait_for_job(job: Job, request: Optional[Request] = None, deadline: Optional[float] = None,
+                       coalesced: bool = True) -> dict:
+    """
+    等待任务结束，返回 /ocr 接口的响应数据；任务失败时返回与原请求相同的错误
+
+    等待期间每 DISCONNECT_POLL_SECONDS 秒检查一次客户端是否已断开。客户端断开（499）或超过本请求的
+    截止时间（504）时停止等待；等待同一任务的请求都已离开时取消任务（/jobs 提交或合并过的任务除外）。
+    截止时间按等待的请求各自计算，一个请求超时不影响等待同一任务的其他请求。
+
+    Args:
+        request: 当前请求，用于检测客户端断开
+        deadline: 本请求的截止时刻（time.monotonic）
+        coalesced: 响应中的 coalesced 字段
+    """
+    job.watchers += 1
+    reason = None
+    try:
+        while not job.done.is_set():
+            timeout = DISCONNECT_POLL_SECONDS
+            if deadline is not None:
+                timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if job.done.is_set():
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                reason = "deadline"
+            elif request is not None and await request.is_disconnected():
+                reason = "disconnect"
+            if reason is not None:
+                break
+    except asyncio.CancelledError:
+        reason = "disconnect"
+        raise
+    finally:
+        job.watchers -= 1
+        if reason is not None and job.watchers == 0:
+            cancel_job(job, reason)
+
+    if reason == "deadline":
+        if job.cancel_reason == "deadline" and job.task is not None:
+            # 本请求取消了任务：等它记录已识别的页数，返回与任务相同的错误
+            await asyncio.wait({job.task}, timeout=DISCONNECT_POLL_SECONDS)
+        if job.status == "cancelled" and job.cancel_reason == "deadline":
+            raise HTTPException(status_code=504, detail=job.error)
+        raise HTTPException(status_code=504, detail=f"超过请求截止时间，任务 {job.task_id} 未完成")
+    if reason == "disconnect":
+        raise HTTPException(status_code=499, detail="客户端已断开")
+    if job.status != "success":
+        detail = job.error or "任务未完成"
+        if job.error_status in (None, 500):
+            detail = f"OCR 处理失败: {detail}"
+        raise HTTPException(status_code=job.error_status or 500, detail=detail)
+    return {**job.result, "coalesced": coalesced}
+
+
+class DeadlineExceeded(Exception):
+    """任务超过截止时间"""
+
+
+async def _infer_before_deadline(job: Job, image: Union[str, Image.Image]) -> OCRResult:
+    """推理一页；任务设置了截止时间时，到时取消推理（正在解码的页面在下一步停止）"""
+    if job.deadline is None:
+        return await inference_worker.infer(image, job.settings)
+    remaining = job.deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(inference_worker.infer(image, job.settings), remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
+
+
+def record_cancellation(job: Job, reason: str, page_results: List[OCRResult], output_path: str, labels: tuple):
+    """
+    记录被取消的任务
+
+    统计取消的页数（含正在推理的页面）和按每页平均推理耗时估算节省的时间；
+    已完成的页面仍写入 result.txt，可通过 GET /jobs/{task_id} 和下载接口取得。
+    """
+    target = len(job.selected_pages) if job.selected_pages is not None else job.total_pages
+    cancelled_pages = max(0, target - len(page_results))
+    PAGES_CANCELLED.labels(*labels, reason).inc(cancelled_pages)
+    CANCELLED_COMPUTE_SECONDS.labels(*labels, reason).inc(cancelled_pages * (inference_worker.seconds_per_page or 0.0))
+
+    job.status = "cancelled"
+    job.cancel_reason = reason
+    job.error = f"{'超过请求截止时间' if reason == 'deadline' else '客户端已断开'}，" \
+                f"已识别 {len(page_results)}/{target} 页，其余页面已取消"
+    job.error_status = 504 if reason == "deadline" else 499
+
+    files = None
+    if page_results:
+        with open(Path(output_path) / "result.txt", "w", encoding="utf-8") as f:
+            f.write(PAGE_SPLIT.join(r.text for r in page_results))
+        files = {"text": f"/download/{job.task_id}/result.txt"}
+    job.result = {
+        "task_id": job.task_id,
+        "status": "cancelled",
+        "cancel_reason": reason,
+        "file_type": job.file_type,
+        "total_pages": job.total_pages,
+        "selected_pages": job.selected_pages,
+        "pages": list(job.pages),
+        "files": files,
+        "settings": job.settings
+    }
+    logger.warning(f"任务 {job.task_id} 已取消: {job.error}")
+
+
+async def _single_page(image: Union[str, Image.Image]):
+    """单张图片作为只有一页的文档"""
+    yield 1, image
+
+
+async def _page_numbers(total_pages: int):
+    """只产出页码（缓存命中、无需原图时使用）"""
+    for idx in range(1, total_pages + 1):
+        yield idx, None
+
+
+def page_concurrency() -> int:
+    """单个文档同时提交推理的页数（PAGE_CONCURRENCY，未设置时由推理后端决定）"""
+    if PAGE_CONCURRENCY > 0:
+        return PAGE_CONCURRENCY
+    return max(1, getattr(inference_worker, "page_concurrency", 1))
+
+
+async def _recognize_page(job: Job, idx: int, image: Union[str, Image.Image, None],
+                          cached_results: Optional[List[OCRResult]], page_stream: Optional[PdfPageStream],
+                          labels: tuple) -> Tuple[OCRResult, bool]:
+    """
+    识别一页：依次查询文档级缓存、页面级缓存，都未命中时交给推理后端
+
+    Returns:
+        (OCRResult, 是否来自缓存)
+    """
+    if cached_results is not None and idx <= len(cached_results):
+        return cached_results[idx - 1], True
+
+    page_key = None
+    if page_stream is not None and result_cache is not None and page_stream.page_hashes.get(idx):
+        # 页面级缓存：修订后重新上传的 PDF 只识别新增或改动的页面
+        page_key = ResultCache.make_key(page_stream.page_hashes[idx], job.settings, model_revision())
+        if not job.bypass_cache:
+            cached_page = await asyncio.to_thread(result_cache.get, page_key, "page")
+            if cached_page:
+                return cached_page[0], True
+
+    page_result = await _infer_before_deadline(job, image)
+    for stage, seconds in page_result.timings.items():
+        STAGE_SECONDS.labels(stage, *labels).observe(seconds)
+    if page_key is not None:
+        await asyncio.to_thread(result_cache.put, page_key, [page_result])
+    return page_result, False
+
+
+def _discard_page_task(task: asyncio.Task):
+    """取消不再需要的页面任务，并取走其异常（避免 "exception was never retrieved" 警告）"""
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def iter_ocr_job(job: Job, source: Union[Path, bytes], save_results: bool):
+    """
+    执行 OCR 任务：PDF 转换、逐页识别、合并结果
+
+    PDF 由后台线程边渲染边送入有界预取队列，模型推理交给推理后端，事件循环只等待结果。
+    同一文档最多 page_concurrency() 页同时在识别中，结果按页码顺序汇总。
+    每完成一页就更新 job 的进度并产出该页结果；全部完成后 job.result 为 /ocr 接口的响应数据。
+
+    Args:
+        job: 任务
+        source: 上传文件的保存路径，或内存中的文件内容（不落盘）
+        save_results: 是否保留上传文件（仅对保存到磁盘的上传文件有效）
+
+    Yields:
+        dict: 单页结果（page/total_pages/text/text_length/output_tokens/vision_tokens/blocks/elapsed_ms）
+    """
+    task_id = job.task_id
+    settings = job.settings
+    in_memory = isinstance(source, bytes)
+    file_is_pdf = sniff_file_type(source) == ".pdf" if in_memory else is_pdf(str(source))
+    page_stream = None
+
+    job.status = "running"
+    job.started_at = time.time()
+    job.file_type = "pdf" if file_is_pdf else "image"
+
+    labels = (mode_name(settings), job.file_type)
+    INFLIGHT_REQUESTS.labels(*labels).inc()
+    if job.upload_seconds is not None:
+        STAGE_SECONDS.labels("upload", *labels).observe(job.upload_seconds)
+
+    output_path = str(OUTPUT_DIR / task_id)
+    page_results = []
+    # 已提交、尚未汇总的页面：(页码, 图片, 提交时间, 识别任务)
+    in_flight: "deque[tuple]" = deque()
+
+    try:
+        # 图片只有一页，页码范围只需校验
+        if job.page_spec and not file_is_pdf:
+            try:
+                job.selected_pages = select_pages(job.page_spec, 1)
+            except PageRangeError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+        # 设置输出路径
+        os.makedirs(output_path, exist_ok=True)
+
+        # 查询结果缓存
+        cached_results = None
+        if job.cache_key and result_cache is not None and not job.bypass_cache:
+            cached_results = await asyncio.to_thread(result_cache.get, job.cache_key)
+            job.cache_hit = cached_results is not None
+            if job.cache_hit:
+                logger.info(f"结果缓存命中: {task_id}（{len(cached_results)} 页）")
+
+        # 缓存命中且不需要生成结果文件时，无需读取原文件
+        if cached_results is not None and not save_results:
+            total_pages = len(cached_results)
+            page_iter = _page_numbers(total_pages)
+        # 检查是否为 PDF，如果是则由后台线程边渲染边识别
+        elif file_is_pdf:
+            logger.info(f"检测到 PDF 文件，开始转换...")
+            save_dir = str(Path(output_path) / "pages") if SAVE_PDF_PAGES else None
+            page_stream = PdfPageStream(source if in_memory else str(source), save_dir=save_dir,
+                                        prefetch=PDF_PREFETCH_PAGES, page_spec=job.page_spec)
+            try:
+                total_pages = await page_stream.open()
+                if job.page_spec:
+                    job.selected_pages = page_stream.selected_pages
+                logger.info(f"PDF 共 {total_pages} 页，处理 {len(page_stream.selected_pages)} 页"
+                            f"（预取 {PDF_PREFETCH_PAGES} 页）")
+            except PageRangeError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except Exception as e:
+                logger.error(f"PDF 转换失败: {e}")
+                raise HTTPException(status_code=400, detail=f"PDF 转换失败: {str(e)}")
+            page_iter = page_stream.pages()
+        elif in_memory:
+            # 内存中的图片直接解码交给模型
+            try:
+                image = Image.open(io.BytesIO(source))
+                image.load()
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"图片解码失败: {str(e)}")
+            total_pages = 1
+            page_iter = _single_page(image)
+        else:
+            # 普通图片文件
+            total_pages = 1
+            page_iter = _single_page(str(source))
+
+        job.total_pages = total_pages
+        if job.admission is not None:
+            admission_controller.reserve(
+                job.admission, len(page_stream.selected_pages) if page_stream is not None else total_pages
+            )
+
+        logger.info(f"开始 OCR 识别...")
+        logger.info(f"  - 文件数: {total_pages}")
+        logger.info(f"  - prompt: {settings['prompt']}")
+        logger.info(f"  - base_size: {settings['base_size']}")
+        logger.info(f"  - image_size: {settings['image_size']}")
+        logger.info(f"  - crop_mode: {settings['crop_mode']}")
+
+        # 处理所有图片（单图片或 PDF 的多页）
+        # 最多同时提交 window 页（连续批处理的后端可以把它们交织在一起解码），结果仍按页码顺序汇总
+        all_markdowns = []
+        window = page_concurrency()
+        pages_exhausted = False
+        while True:
+            while not pages_exhausted and len(in_flight) < window:
+                try:
+                    idx, image = await page_iter.__anext__()
+                except StopAsyncIteration:
+                    pages_exhausted = True
+                    break
+                if job.deadline is not None and time.monotonic() >= job.deadline:
+                    raise DeadlineExceeded()
+                logger.info(f"处理第 {idx}/{total_pages} 页...")
+                if page_stream is not None and idx in page_stream.render_seconds:
+                    STAGE_SECONDS.labels("rasterize", *labels).observe(page_stream.render_seconds[idx])
+                task = asyncio.create_task(_recognize_page(job, idx, image, cached_results, page_stream, labels))
+                in_flight.append((idx, image, time.time(), task))
+            if not in_flight:
+                break
+
+            idx, image, page_start, task = in_flight[0]
+            page_result, page_cached = await task
+            in_flight.popleft()
+            if page_cached:
+                job.pages_from_cache += 1
+            page_results.append(page_result)
+            PAGES_TOTAL.labels(*labels, "cache" if page_cached else "model").inc()
+            CHARACTERS_TOTAL.labels(*labels).inc(len(page_result.text))
+
+            # 只有客户端要求保存结果时才写可视化图片、插图和 markdown
+            if save_results:
+                boxes_name = "result_with_boxes.jpg" if total_pages == 1 else page_boxes_name(idx)
+                image_prefix = "" if total_pages == 1 else f"page_{idx}_"
+                write_start = time.perf_counter()
+                all_markdowns.append(await asyncio.to_thread(
+                    save_page_artifacts, page_result, image, output_path, boxes_name, image_prefix
+                ))
+                STAGE_SECONDS.labels("write", *labels).observe(time.perf_counter() - write_start)
+
+            page_info = {
+                "page": idx,
+                "text_length": len(page_result.text),
+                "output_tokens": page_result.output_tokens,
+                "vision_tokens": page_result.vision_tokens,
+                "cached": page_cached
+            }
+            job.pages.append(page_info)
+            job.completed_pages = len(job.pages)
+            if job.admission is not None:
+                admission_controller.page_done(job.admission)
+
+            logger.info(f"第 {idx} 页识别完成，文本长度: {len(page_result.text)}")
+
+            yield {
+                **page_info,
+                "total_pages": total_pages,
+                "text": page_result.text,
+                "blocks": page_result.blocks,
+                "elapsed_ms": round((time.time() - page_start) * 1000, 1)
+            }
+
+        logger.info(f"✅ OCR 识别完成: {task_id}（{job.pages_from_cache}/{len(page_results)} 页来自缓存）")
+
+        if job.cache_key and result_cache is not None and not job.cache_hit:
+            await asyncio.to_thread(result_cache.put, job.cache_key, page_results)
+
+        # 合并所有页面的结果并保存到文件
+        combined_text = PAGE_SPLIT.join(r.text for r in page_results)
+
+        # 保存合并后的文本到文件
+        write_start = time.perf_counter()
+        result_file = Path(output_path) / "result.txt"
+        with open(result_file, 'w', encoding='utf-8') as f:
+            f.write(combined_text)
+
+        if all_markdowns:
+            with open(Path(output_path) / "result.mmd", 'w', encoding='utf-8') as f:
+                f.write(PAGE_SPLIT.join(all_markdowns))
+
+        # 生成预压缩副本，下载时按 Accept-Encoding 直接返回
+        await asyncio.to_thread(write_compressed_sidecars, Path(output_path))
+        STAGE_SECONDS.labels("write", *labels).observe(time.perf_counter() - write_start)
+
+        logger.info(f"结果已保存到: {result_file}")
+
+        # 准备响应（不包含大量文本内容）
+        response_data = {
+            "task_id": task_id,
+            "status": "success",
+            "file_type": job.file_type,
+            "total_pages": total_pages,
+            "selected_pages": job.selected_pages,
+            "total_characters": len(combined_text),
+            "pages": list(job.pages),
+            "cache_hit": job.cache_hit,
+            "pages_from_cache": job.pages_from_cache,
+            "coalesced": False,
+            "files": build_result_files(task_id, output_path, total_pages),
+            "output_path": output_path if save_results else None,
+            "settings": settings
+        }
+
+        job.result = response_data
+        job.status = "success"
+
+    except (DeadlineExceeded, asyncio.CancelledError, GeneratorExit) as e:
+        # 超过截止时间，或客户端断开（请求协程被取消 / 流式响应被关闭）
+        reason = "deadline" if isinstance(e, DeadlineExceeded) else job.cancel_reason or "disconnect"
+        record_cancellation(job, reason, page_results, output_path, labels)
+        if isinstance(e, DeadlineExceeded):
+            raise HTTPException(status_code=504, detail=job.error) from None
+        raise
+
+    except Exception as e:
+        job.status = "failed"
+        job.error = e.detail if isinstance(e, HTTPException) else str(e)
+        job.error_status = e.status_code if isinstance(e, (HTTPException, BackendError)) else 500
+        # 请求本身有误（4xx，如页码超出范围、不支持的模式、队列已满）不计入处理失败
+        if job.error_status >= 500:
+            ERRORS_TOTAL.labels(*labels).inc()
+        raise
+
+    finally:
+        job.finished_at = time.time()
+        if job.request_key is not None and INFLIGHT_JOBS.get(job.request_key) is job:
+            del INFLIGHT_JOBS[job.request_key]
+        job.done.set()
+        INFLIGHT_REQUESTS.labels(*labels).dec()
+        if job.admission is not None:
+            admission_controller.release(job.admission)
+
+        # 提前结束（失败、取消、超时）时还在识别的页面不再需要
+        for *_, task in in_flight:
+            _discard_page_task(task)
+
+        # 流式响应被取消时 finally 中的 await 也可能被打断，清理上传文件放在内层 finally
+        try:
+            if page_stream is not None:
+                await page_stream.close()
+        finally:
+            # 清理上传的文件（可选）
+            if not in_memory and (not save_results or job.status in ("failed", "cancelled")) and source.exists():
+                source.unlink()
+
+
+async def run_ocr_job(job: Job, source: Union[Path, bytes], save_results: bool) -> dict:
+    """执行 OCR 任务并返回 /ocr 接口的响应数据"""
+    async for _ in iter_ocr_job(job, source, save_results):
+        pass
+    return job.result
+
+
+async def stream_ocr_job(job: Job, source: Union[Path, bytes], save_results: bool, sse: bool):
+    """
+    以流的形式输出 OCR 任务结果
+
+    每页识别完成后立即输出一条 page 记录，最后输出 summary 记录（与 /ocr 的响应相同，
+    包含下载路径）；失败时输出 error 记录。
+
+    Args:
+        sse: True 输出 Server-Sent Events，False 输出 NDJSON
+    """
+    def encode(event: str, data: dict) -> str:
+        payload = json.dumps({"event": event, **data}, ensure_ascii=False)
+        if sse:
+            return f"event: {event}\ndata: {payload}\n\n"
+        return payload + "\n"
+
+    try:
+        async for page in iter_ocr_job(job, source, save_results):
+            yield encode("page", page)
+        yield encode("summary", job.result)
+    except Exception as e:
+        log_job_failure(job, e)
+        yield encode("error", {"task_id": job.task_id, "detail": job.error or str(e)})
+
+
+async def _run_job_in_background(job: Job, source: Union[Path, bytes], save_results: bool):
+    """后台执行任务，失败信息记录在 job 中"""
+    try:
+        await run_ocr_job(job, source, save_results)
+    except Exception as e:
+        # 取消已在 record_cancellation 中记录
+        if job.status != "cancelled":
+            log_job_failure(job, e)
+
+
+def log_job_failure(job: Job, error: Exception):
+    """记录任务失败：请求本身有误（4xx）时只记警告"""
+    if job.error_status is not None and job.error_status < 500:
+        logger.warning(f"任务 {job.task_id} 未完成（{job.error_status}）: {job.error or str(error)}")
+    else:
+        logger.error(f"❌ 任务 {job.task_id} 失败: {job.error or str(error)}")
+
+
+def validate_page_spec(pages: Optional[str]) -> Optional[str]:
+    """校验 pages 参数的语法（上传前即可返回 400），空字符串视为全部页面"""
+    if pages is None or not pages.strip():
+        return None
+    try:
+        parse_page_spec(pages)
+    except PageRangeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return pages.strip()
+
+
+def upload_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"上传内容超过大小限制（{UPLOAD_MAX_MB:g} MB）")
+
+
+class RequestBodyMiddleware:
+    """
+    请求体大小限制与解压（ASGI 中间件）
+
+    - Content-Length 超过 UPLOAD_MAX_MB 时不读取请求体，直接返回 413
+    - Content-Encoding 为 gzip / zstd 时边接收边解压，后续的 multipart 解析看到的是解压后的内容
+    - 实际接收（解压后）的字节数超过上限时立即中止并返回 413，不必等整个请求体传完
+
+    multipart 中的文件由 Starlette 先写入临时文件（超过 1 MB 即落盘），因此大文件不会整体驻留内存。
+    """
+
+    ENCODINGS = ("gzip", "zstd")
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        encoding = headers.get("content-encoding", "identity").strip().lower()
+
+        if encoding not in ("", "identity") + self.ENCODINGS:
+            await JSONResponse(status_code=415, content={"detail": f"不支持的 Content-Encoding: {encoding}"})(
+                scope, receive, send)
+            return
+        if encoding == "zstd" and zstandard is None:
+            await JSONResponse(status_code=415, content={"detail": "服务端未安装 zstandard，不支持 zstd 压缩的请求体"})(
+                scope, receive, send)
+            return
+
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await JSONResponse(status_code=413, content={"detail": upload_too_large().detail})(scope, receive, send)
+            return
+
+        decompressor = None
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "zstd":
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        if decompressor is not None:
+            # 下游看到的是解压后的请求体，原始的长度和编码头不再适用
+            scope = dict(scope)
+            scope["headers"] = [
+                (name, value) for name, value in scope["headers"]
+                if name.lower() not in (b"content-encoding", b"content-length")
+            ]
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+
+            body = message.get("body", b"")
+            if decompressor is not None:
+                try:
+                    body = decompressor.decompress(body)
+                    if not message.get("more_body", False) and encoding == "gzip":
+                        body += decompressor.flush()
+                        if not decompressor.eof:
+                            raise ValueError("数据不完整")
+                except Exception as e:
+                    raise HTTPException(status_code=400, detail=f"请求体解压失败（{encoding}）: {e}")
+
+            received += len(body)
+            if received > self.max_bytes:
+                raise upload_too_large()
+            return {**message, "body": body}
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(RequestBodyMiddleware, max_bytes=UPLOAD_MAX_BYTES)
+
+
+class AdmissionMiddleware:
+    """
+    队列已满时在读取请求体之前拒绝 OCR 请求（ASGI 中间件）
+
+    接口内部仍会在处理前正式准入；这里只是提前返回 429，免得先接收完整个上传文件再被拒绝。
+    """
+
+    PATHS = ("/ocr", "/ocr/base64", "/ocr/json", "/ocr/binary", "/ocr/batch", "/jobs")
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in self.PATHS:
+            reason = admission_controller.check()
+            if reason is not None:
+                error = admission_controller.rejection(reason)
+                await JSONResponse(status_code=error.status_code, content={"detail": error.detail},
+                                   headers=error.headers)(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(AdmissionMiddleware)
+
+# 配置 CORS（最后注册的中间件在最外层，上面两个中间件直接返回的 413 / 415 / 429 也带 CORS 响应头）
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+async def save_upload(file: UploadFile, task_id: str) -> tuple:
+    """
+    分块保存上传的文件
+
+    每次只读取 UPLOAD_CHUNK_SIZE 字节写入磁盘并同时计算哈希，单个上传占用的内存不超过一个分块；
+    超过 UPLOAD_MAX_MB 时删除已写入的部分并返回 413。
+
+    Returns:
+        tuple: (保存路径, 内容的 SHA-256)
+    """
+    file_ext = Path(file.filename).suffix
+    upload_path = UPLOAD_DIR / f"{task_id}{file_ext}"
+    hasher = hashlib.sha256()
+    size = 0
+
+    try:
+        async with aiofiles.open(upload_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise upload_too_large()
+                hasher.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        upload_path.unlink(missing_ok=True)
+        raise
+
+    logger.info(f"文件已保存: {upload_path}（{size} 字节）")
+    return upload_path, hasher.hexdigest()
+
+
+def warmup_modes() -> List[Tuple[str, Dict[str, Any]]]:
+    """WARMUP_MODES 对应的 (模式名, 推理参数) 列表"""
+    names = {name.lower(): name for name in MODES.values()}
+    value = WARMUP_MODES.strip().lower()
+    if value in ("", "none"):
+        return []
+    selected = list(names) if value == "all" else [m.strip() for m in value.split(",") if m.strip()]
+
+    modes = []
+    for key in selected:
+        if key not in names:
+            logger.warning(f"未知的预热模式: {key}（可选: {', '.join(MODES.values())}）")
+            continue
+        base_size, image_size, crop_mode = next(k for k, v in MODES.items() if v == names[key])
+        modes.append((names[key], build_settings(None, base_size, image_size, crop_mode)))
+    return modes
+
+
+def supported_warmup_modes() -> List[Tuple[str, Dict[str, Any]]]:
+    """推理后端支持的预热模式（vLLM 后端只服务一种模式）"""
+    return [(name, settings) for name, settings in warmup_modes() if backend.supports(settings)]
+
+
+def make_warmup_image() -> Image.Image:
+    """预热用的合成文档图片"""
+    image = Image.new("RGB", (1024, 1024), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(8):
+        draw.text((64, 64 + row * 112), f"DeepSeek-OCR warmup line {row + 1}", fill="black")
+    return image
+
+
+async def warmup_model():
+    """
+    对每个启用的模式执行一次合成图片推理
+
+    首次推理要承担内存分配器扩容、算子选择、tokenizer 缓存等一次性开销，
+    预热把这段延迟放到启动阶段，而不是由第一个真实请求承担。
+    多进程模式下每个推理进程在领取任务前各自预热（见 _pool_worker_main），这里只等待并汇总耗时。
+    """
+    if isinstance(inference_worker, InferencePool):
+        timings = await asyncio.to_thread(inference_worker.wait_warmup)
+        for name, seconds in timings.items():
+            WARMUP_SECONDS[name] = round(seconds, 3)
+            WARMUP_SECONDS_GAUGE.labels(name).set(seconds)
+            logger.info(f"预热 {name} 模式完成: {inference_worker.workers} 个推理进程，最慢 {seconds:.2f} 秒")
+        return
 
-        # 检查 CUDA 是否可用
-        use_cuda = torch.cuda.is_available()
-        device = torch.device("cuda" if use_cuda else "cpu")
+    image = make_warmup_image()
+    for name, settings in supported_warmup_modes():
+        start = time.perf_counter()
+        try:
+            await inference_worker.infer(image, settings)
+        except Exception as e:
+            logger.error(f"❌ 预热 {name} 模式失败: {str(e)}")
+            continue
+        seconds = time.perf_counter() - start
+        WARMUP_SECONDS[name] = round(seconds, 3)
+        WARMUP_SECONDS_GAUGE.labels(name).set(seconds)
+        logger.info(f"预热 {name} 模式完成: {seconds:.2f} 秒")
 
-        if use_cuda:
-            logger.info(f"使用 CUDA 设备: {CUDA_DEVICE}")
-            os.environ["CUDA_VISIBLE_DEVICES"] = CUDA_DEVICE
-        else:
-            logger.info("CUDA 不可用，使用 CPU 模式")
 
-        # 加载 tokenizer
-        logger.info("加载 tokenizer...")
-        tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_PATH,
-            trust_remote_code=True
-        )
+async def initialize_model():
+    """后台加载模型、启动推理、预热，依次更新 MODEL_STATE"""
+    global inference_worker, MODEL_LOADED, MODEL_STATE
 
-        # 加载模型
-        logger.info("加载模型...")
-        model = AutoModel.from_pretrained(
-            MODEL_PATH,
-            trust_remote_code=True,
-            use_safetensors=True,
-            attn_implementation="eager"  # 禁用 FlashAttention，使用标准attention实现
-        )
+    init_start = time.perf_counter()
+    if isinstance(backend, VLLMEngine):
+        # vLLM 引擎自己调度所有页面
+        inference_worker = backend
+    elif INFERENCE_WORKERS > 1:
+        if not await asyncio.to_thread(backend.fork_safe):
+            logger.warning("CUDA 上下文无法在 fork 后共享，INFERENCE_WORKERS 只在 CPU 模式下生效，使用单个推理线程")
+        else:
+            inference_worker = InferencePool(backend, INFERENCE_WORKERS, INFERENCE_THREADS_PER_WORKER,
+                                             warmup=supported_warmup_modes())
 
-        # 移动到设备并设置为 eval 模式
-        logger.info(f"将模型移动到 {device}...")
-        model = model.eval().to(device)
+    try:
+        if isinstance(inference_worker, InferencePool):
+            # 模型在进程池的宿主进程中加载，API 进程不持有权重
+            await asyncio.to_thread(inference_worker.start)
+        else:
+            await asyncio.to_thread(backend.load)
+            inference_worker.start()
+    except Exception:
+        MODEL_STATE = "failed"
+        return
 
-        # 如果使用 CUDA，转换为 bfloat16 以节省显存
-        if use_cuda:
-            model = model.to(torch.bfloat16)
+    MODEL_LOADED = True
+    MODEL_LOADED_GAUGE.set(1)
 
-        MODEL_LOADED = True
-        logger.info("✅ 模型加载成功！")
+    MODEL_STATE = "warming"
+    warmup_start = time.perf_counter()
+    await warmup_model()
+    _record_startup_phase("warmup", warmup_start)
+    STARTUP_TIMINGS["total"] = round(time.perf_counter() - init_start, 3)
+    MODEL_STATE = "ready"
 
-    except Exception as e:
-        logger.error(f"❌ 模型加载失败: {str(e)}")
-        raise
+    report = " | ".join(f"{phase} {seconds:.2f}s" for phase, seconds in STARTUP_TIMINGS.items())
+    logger.info(f"✅ 服务已就绪，启动耗时: {report}")
 
 
 @app.on_event("startup")
 async def startup_event():
-    """启动时加载模型"""
+    """启动时在后台加载并预热模型，服务先开始监听，/health 反映当前状态"""
     logger.info("=" * 50)
     logger.info("DeepSeek-OCR API 服务启动中...")
     logger.info("=" * 50)
-    load_model()
+    retention_manager.start()
+
+    task = asyncio.create_task(initialize_model())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭时停止推理工作线程和后台清理"""
+    inference_worker.stop()
+    await retention_manager.stop()
 
 
 @app.get("/")
@@ -258,21 +3590,40 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """健康检查"""
-    return {
-        "status": "healthy" if MODEL_LOADED else "loading",
-        "model_loaded": MODEL_LOADED
-    }
+    """
+    健康检查
+
+    status 为 loading / warming / ready / failed；只有 ready 时返回 200，其他状态返回 503，
+    负载均衡器据此只把流量分配给已预热的实例。
+    """
+    return JSONResponse(status_code=200 if MODEL_STATE == "ready" else 503, content={
+        "status": MODEL_STATE,
+        "model_loaded": MODEL_LOADED,
+        "warmup_seconds": WARMUP_SECONDS,
+        "queue": {
+            "requests": admission_controller.requests,
+            "pages": admission_controller.pages,
+            "full": admission_controller.check() is not None
+        }
+    })
 
 
 @app.post("/ocr")
 async def ocr_image(
+    request: Request,
     file: UploadFile = File(...),
     prompt: Optional[str] = Form(None),
     base_size: int = Form(1024),
     image_size: int = Form(640),
     crop_mode: bool = Form(True),
-    save_results: bool = Form(False)
+    save_results: bool = Form(False),
+    stream: bool = Form(False),
+    bypass_cache: bool = Form(False),
+    pages: Optional[str] = Form(None),
+    deadline_ms: Optional[int] = Form(None),
+    accept: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None)
 ):
     """
     OCR 图片识别
@@ -283,7 +3634,15 @@ async def ocr_image(
     - base_size: 基础尺寸 (512/640/1024/1280)
     - image_size: 图像尺寸 (512/640/1024/1280)
     - crop_mode: 是否使用裁剪模式
-    - save_results: 是否保存结果文件
+    - save_results: 是否保存结果文件（markdown、带标注框的图片、裁剪出的插图）
+    - stream: 是否逐页流式返回（请求头 Accept: text/event-stream 时输出 SSE，否则输出 NDJSON）
+    - bypass_cache: 跳过结果缓存重新识别（新结果仍会写入缓存）
+    - pages: 只识别指定页面，如 "1-3,10,-1"（负数表示倒数第几页，默认全部页面）
+    - Idempotency-Key 请求头: 重试时返回原任务的结果，不再重新识别（流式请求不支持）
+    - deadline_ms / X-Request-Timeout 请求头（秒）: 截止时间，到时取消剩余页面并返回 504
+
+    与进行中的请求内容和参数完全相同时，直接等待那次识别的结果（响应中 coalesced 为 true）。
+    客户端断开时取消剩余页面，已完成的页面写入 result.txt。
 
     支持的模式:
     - Tiny: base_size=512, image_size=512, crop_mode=False
@@ -299,252 +3658,846 @@ async def ocr_image(
     # 生成唯一ID
     task_id = str(uuid.uuid4())
 
+    logger.info(f"开始处理任务: {task_id}")
+    logger.info(f"文件名: {file.filename}")
+
+    page_spec = validate_page_spec(pages)
+    idempotency_key = None if stream else validate_idempotency_key(idempotency_key)
+    deadline = request_deadline(deadline_ms, x_request_timeout)
+    ticket = admission_controller.acquire()
+
+    upload_start = time.perf_counter()
     try:
-        # 保存上传的文件
-        file_ext = Path(file.filename).suffix
-        upload_path = UPLOAD_DIR / f"{task_id}{file_ext}"
+        upload_path, content_hash = await save_upload(file, task_id)
+    except BaseException:
+        admission_controller.release(ticket)
+        raise
+    settings = build_settings(prompt, base_size, image_size, crop_mode)
 
-        logger.info(f"开始处理任务: {task_id}")
-        logger.info(f"文件名: {file.filename}")
+    # 流式请求逐页输出，不与其他请求合并
+    request_key = None
+    if not stream:
+        request_key = make_request_key(content_hash, settings, page_spec, save_results, bypass_cache)
+        try:
+            duplicate = find_duplicate_job(request_key, idempotency_key, deadline)
+        except HTTPException:
+            admission_controller.release(ticket)
+            upload_path.unlink(missing_ok=True)
+            raise
+        if duplicate is not None:
+            admission_controller.release(ticket)
+            upload_path.unlink(missing_ok=True)
+            return JSONResponse(content=await wait_for_job(duplicate[0], request, deadline))
 
-        # 保存文件
-        with open(upload_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+    job = create_job(task_id, file.filename, settings, content_hash=content_hash, bypass_cache=bypass_cache,
+                     page_spec=page_spec, request_key=request_key, idempotency_key=idempotency_key)
+    job.upload_seconds = time.perf_counter() - upload_start
+    job.admission = ticket
 
-        logger.info(f"文件已保存: {upload_path}")
+    if stream:
+        # 流式响应没有其他等待者，截止时间由任务自身控制
+        job.deadline = deadline
+        sse = accept is not None and "text/event-stream" in accept
+        return StreamingResponse(
+            stream_ocr_job(job, upload_path, save_results, sse),
+            media_type="text/event-stream" if sse else "application/x-ndjson",
+            headers={"X-Task-Id": task_id, "Cache-Control": "no-cache"}
+        )
 
-        # 检查是否为 PDF，如果是则转换为图片
-        image_files = []
-        if is_pdf(str(upload_path)):
-            logger.info(f"检测到 PDF 文件，开始转换...")
-            try:
-                image_files = pdf_to_images(str(upload_path))
-                logger.info(f"PDF 转换完成，共 {len(image_files)} 页")
-            except Exception as e:
-                logger.error(f"PDF 转换失败: {e}")
-                raise HTTPException(status_code=400, detail=f"PDF 转换失败: {str(e)}")
-        else:
-            # 普通图片文件
-            image_files = [str(upload_path)]
+    start_job(job, upload_path, save_results)
+    return JSONResponse(content=await wait_for_job(job, request, deadline, coalesced=False))
 
-        # 设置提示词
-        if prompt is None:
-            prompt = "<image>\n<|grounding|>Convert the document to markdown."
 
-        # 设置输出路径
-        output_path = str(OUTPUT_DIR / task_id)
-        os.makedirs(output_path, exist_ok=True)
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    file: UploadFile = File(...),
+    prompt: Optional[str] = Form(None),
+    base_size: int = Form(1024),
+    image_size: int = Form(640),
+    crop_mode: bool = Form(True),
+    save_results: bool = Form(False),
+    bypass_cache: bool = Form(False),
+    pages: Optional[str] = Form(None),
+    deadline_ms: Optional[int] = Form(None),
+    idempotency_key: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None)
+):
+    """
+    提交异步 OCR 任务
 
-        logger.info(f"开始 OCR 识别...")
-        logger.info(f"  - 文件数: {len(image_files)}")
-        logger.info(f"  - prompt: {prompt}")
-        logger.info(f"  - base_size: {base_size}")
-        logger.info(f"  - image_size: {image_size}")
-        logger.info(f"  - crop_mode: {crop_mode}")
+    参数与 /ocr 相同。立即返回 task_id，识别在后台执行，
+    通过 GET /jobs/{task_id} 查询进度和结果。
 
-        # 处理所有图片（单图片或 PDF 的多页）
-        all_results = []
-        for idx, image_file in enumerate(image_files, 1):
-            logger.info(f"处理第 {idx}/{len(image_files)} 页...")
-
-            # 执行 OCR - 捕获 stdout 输出
-            with capture_stdout() as captured:
-                infer_result = model.infer(
-                    tokenizer,
-                    prompt=prompt,
-                    image_file=str(image_file),
-                    output_path=output_path,
-                    base_size=base_size,
-                    image_size=image_size,
-                    crop_mode=crop_mode,
-                    save_results=True,  # 强制保存结果以便提取
-                    test_compress=True
-                )
+    带相同 Idempotency-Key 重试、或与进行中的任务内容和参数完全相同时，返回原任务的 task_id。
+    任务不因提交请求断开而取消；设置了 deadline_ms / X-Request-Timeout 时，从提交时起计算截止时间。
+    """
+
+    if not MODEL_LOADED:
+        raise HTTPException(status_code=503, detail="模型正在加载中，请稍后再试")
 
-            # 获取捕获的输出
-            stdout_content = captured.getvalue()
+    task_id = str(uuid.uuid4())
 
-            # 从输出目录或 stdout 中提取结果
-            page_result = extract_ocr_result(output_path, stdout_content)
-            all_results.append({
-                "page": idx,
-                "text": page_result["text"],
-                "text_length": len(page_result["text"])
-            })
+    logger.info(f"提交异步任务: {task_id}")
+    logger.info(f"文件名: {file.filename}")
 
-            logger.info(f"第 {idx} 页识别完成，文本长度: {len(page_result['text'])}")
+    page_spec = validate_page_spec(pages)
+    idempotency_key = validate_idempotency_key(idempotency_key)
+    deadline = request_deadline(deadline_ms, x_request_timeout)
+    ticket = admission_controller.acquire()
 
-        # 清理转换的图片文件
-        if is_pdf(str(upload_path)):
-            for img_file in image_files:
-                try:
-                    Path(img_file).unlink()
-                except:
-                    pass
+    upload_start = time.perf_counter()
+    try:
+        upload_path, content_hash = await save_upload(file, task_id)
+    except BaseException:
+        admission_controller.release(ticket)
+        raise
+    settings = build_settings(prompt, base_size, image_size, crop_mode)
+    request_key = make_request_key(content_hash, settings, page_spec, save_results, bypass_cache)
 
-        logger.info(f"✅ OCR 识别完成: {task_id}")
+    try:
+        duplicate = find_duplicate_job(request_key, idempotency_key, deadline, detached=True)
+    except HTTPException:
+        admission_controller.release(ticket)
+        upload_path.unlink(missing_ok=True)
+        raise
+    if duplicate is not None:
+        admission_controller.release(ticket)
+        upload_path.unlink(missing_ok=True)
+        job = duplicate[0]
+        # 结果会被轮询，不再因原请求断开而取消
+        job.detached = True
+        return JSONResponse(status_code=202, content={
+            "task_id": job.task_id,
+            "status": job.status,
+            "status_url": f"/jobs/{job.task_id}",
+            "coalesced": True
+        })
 
-        # 合并所有页面的结果并保存到文件
-        combined_text = "\n\n<--- Page Split --->\n\n".join([r["text"] for r in all_results])
+    job = create_job(task_id, file.filename, settings, content_hash=content_hash, bypass_cache=bypass_cache,
+                     page_spec=page_spec, request_key=request_key, idempotency_key=idempotency_key)
+    job.upload_seconds = time.perf_counter() - upload_start
+    job.admission = ticket
+    job.deadline = deadline
+    job.detached = True
 
-        # 保存合并后的文本到文件
-        result_file = Path(output_path) / "result.txt"
-        with open(result_file, 'w', encoding='utf-8') as f:
-            f.write(combined_text)
+    start_job(job, upload_path, save_results)
 
-        logger.info(f"结果已保存到: {result_file}")
+    return JSONResponse(status_code=202, content={
+        "task_id": task_id,
+        "status": job.status,
+        "status_url": f"/jobs/{task_id}",
+        "coalesced": False
+    })
 
-        # 获取最终结果文件列表
-        final_result = extract_ocr_result(output_path, None)
 
-        # 构建文件路径（相对路径）
-        result_files = {
-            "text": f"/download/{task_id}/result.txt",
-            "markdown": f"/download/{task_id}/result.mmd" if Path(output_path, "result.mmd").exists() else None,
-            "image_with_boxes": f"/download/{task_id}/result_with_boxes.jpg" if Path(output_path, "result_with_boxes.jpg").exists() else None
-        }
+@app.get("/jobs/{task_id}")
+async def get_job(task_id: str):
+    """
+    查询 OCR 任务状态
 
-        # 准备响应（不包含大量文本内容）
-        response_data = {
-            "task_id": task_id,
-            "status": "success",
-            "file_type": "pdf" if is_pdf(str(upload_path)) else "image",
-            "total_pages": len(image_files),
-            "total_characters": len(combined_text),
-            "pages": [
-                {
-                    "page": r["page"],
-                    "text_length": r["text_length"]
-                } for r in all_results
-            ],
-            "files": result_files,
-            "output_path": output_path if save_results else None,
-            "settings": {
-                "prompt": prompt,
-                "base_size": base_size,
-                "image_size": image_size,
-                "crop_mode": crop_mode
-            }
-        }
+    返回任务状态（queued/running/success/failed）、逐页进度，
+    任务成功后包含结果文件的下载路径。
+    """
+    job = JOBS.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"任务不存在: {task_id}")
+    return job.to_dict()
 
-        # 清理上传的文件（可选）
-        if not save_results:
-            upload_path.unlink()
 
-        return JSONResponse(content=response_data)
+def decode_base64_data(data: str) -> bytes:
+    """解码 Base64 内容（允许 data URL 前缀，如 "data:image/png;base64,..."）"""
+    if data.startswith("data:") and "," in data:
+        data = data.split(",", 1)[1]
+    try:
+        return base64.b64decode("".join(data.split()), validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Base64 解码失败: {str(e)}")
+
+
+def check_memory_file(data: bytes) -> str:
+    """识别内存中文件的类型，无法识别时返回 415"""
+    file_ext = sniff_file_type(data)
+    if file_ext is None:
+        raise HTTPException(status_code=415, detail="无法识别的文件类型（支持 PDF、PNG、JPEG、GIF、BMP、TIFF、WebP）")
+    return file_ext
 
-    except Exception as e:
-        logger.error(f"❌ OCR 处理失败: {str(e)}")
 
-        # 清理文件
-        if upload_path.exists():
-            upload_path.unlink()
+def create_memory_job(data: bytes, filename: Optional[str], settings: Dict[str, Any], bypass_cache: bool,
+                      content_hash: Optional[str] = None, request_key: Optional[str] = None,
+                      idempotency_key: Optional[str] = None) -> Job:
+    """为内存中的文件登记任务，文件类型无法识别时返回 415"""
+    file_ext = check_memory_file(data)
 
-        raise HTTPException(status_code=500, detail=f"OCR 处理失败: {str(e)}")
+    task_id = str(uuid.uuid4())
+    logger.info(f"处理内存文件: {task_id}（{file_ext}，{len(data)} 字节）")
+
+    return create_job(task_id, filename or f"{task_id}{file_ext}", settings,
+                      content_hash=content_hash or hashlib.sha256(data).hexdigest(), bypass_cache=bypass_cache,
+                      request_key=request_key, idempotency_key=idempotency_key)
+
+
+async def ocr_bytes(data: bytes, filename: Optional[str], settings: Dict[str, Any],
+                    save_results: bool, bypass_cache: bool, admission: Optional[AdmissionTicket] = None,
+                    idempotency_key: Optional[str] = None, request: Optional[Request] = None,
+                    deadline: Optional[float] = None) -> dict:
+    """
+    识别内存中的文件（图片或 PDF），不写入 uploads/
+
+    与进行中的相同请求合并，带 Idempotency-Key 的重试直接返回原任务的结果。
+    客户端断开或超过截止时间时取消剩余页面（见 wait_for_job）。
+
+    Args:
+        admission: 多文件请求中该项的额度（AdmissionController.split 分出），None 时单独经过准入控制
+        idempotency_key: Idempotency-Key 请求头
+        request: 当前请求，用于检测客户端断开
+        deadline: 截止时刻（time.monotonic）
+
+    Returns:
+        dict: 与 /ocr 相同的响应数据
+    """
+    check_memory_file(data)
+    content_hash = hashlib.sha256(data).hexdigest()
+    request_key = make_request_key(content_hash, settings, None, save_results, bypass_cache)
+    duplicate = find_duplicate_job(request_key, idempotency_key, deadline)
+    if duplicate is not None:
+        return await wait_for_job(duplicate[0], request, deadline)
+
+    ticket = admission if admission is not None else admission_controller.acquire()
+    try:
+        job = create_memory_job(data, filename, settings, bypass_cache, content_hash=content_hash,
+                                request_key=request_key, idempotency_key=idempotency_key)
+    except BaseException:
+        admission_controller.release(ticket)
+        raise
+    job.admission = ticket
+    start_job(job, data, save_results)
+    return await wait_for_job(job, request, deadline, coalesced=False)
 
 
 @app.post("/ocr/base64")
 async def ocr_base64(
+    request: Request,
     image_base64: str = Form(...),
     prompt: Optional[str] = Form(None),
     base_size: int = Form(1024),
     image_size: int = Form(640),
-    crop_mode: bool = Form(True)
+    crop_mode: bool = Form(True),
+    save_results: bool = Form(False),
+    bypass_cache: bool = Form(False),
+    deadline_ms: Optional[int] = Form(None),
+    idempotency_key: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None)
 ):
     """
-    OCR 图片识别（Base64 输入）
+    OCR 图片识别（Base64 输入，表单字段）
+
+    新的客户端建议使用 /ocr/json（支持多张图片）或 /ocr/binary（原始二进制，无 Base64 开销）。
 
     参数:
-    - image_base64: Base64 编码的图片
+    - image_base64: Base64 编码的图片或 PDF
     - prompt: 自定义提示词
     - base_size: 基础尺寸
     - image_size: 图像尺寸
     - crop_mode: 是否使用裁剪模式
+    - save_results: 是否保存结果文件（markdown、带标注框的图片、裁剪出的插图）
+    - bypass_cache: 跳过结果缓存重新识别（新结果仍会写入缓存）
+    - Idempotency-Key 请求头、deadline_ms / X-Request-Timeout 请求头: 同 /ocr
     """
 
     if not MODEL_LOADED:
         raise HTTPException(status_code=503, detail="模型正在加载中，请稍后再试")
 
-    task_id = str(uuid.uuid4())
+    settings = build_settings(prompt, base_size, image_size, crop_mode)
+    idempotency_key = validate_idempotency_key(idempotency_key)
+    deadline = request_deadline(deadline_ms, x_request_timeout)
+    data = decode_base64_data(image_base64)
+
+    return JSONResponse(content=await ocr_bytes(data, None, settings, save_results, bypass_cache,
+                                                idempotency_key=idempotency_key, request=request, deadline=deadline))
+
+
+class OCRJsonRequest(BaseModel):
+    """/ocr/json 的请求体"""
+    image: Optional[str] = None  # 单张 Base64 图片
+    images: Optional[List[str]] = None  # 多张 Base64 图片
+    prompt: Optional[str] = None
+    base_size: int = 1024
+    image_size: int = 640
+    crop_mode: bool = True
+    save_results: bool = False
+    bypass_cache: bool = False
+    deadline_ms: Optional[int] = None
+
+
+@app.post("/ocr/json")
+async def ocr_json(request: OCRJsonRequest, http_request: Request, idempotency_key: Optional[str] = Header(None),
+                   x_request_timeout: Optional[str] = Header(None)):
+    """
+    OCR 识别（JSON 输入，一张或多张 Base64 图片）
+
+    图片在内存中解码后直接交给模型，不写入 uploads/。多张图片并发提交，由推理工作线程合并成批。
+
+    请求体:
+    - image: 单张 Base64 图片或 PDF（允许 data URL 前缀），响应与 /ocr 相同
+    - images: 多张 Base64 图片，响应为逐项结果列表，单项失败不影响其他项
+    - prompt / base_size / image_size / crop_mode / save_results / bypass_cache: 同 /ocr
+    - Idempotency-Key 请求头: 同 /ocr（只对单张 image 生效；images 中的每张图片仍会合并进行中的相同识别）
+    - deadline_ms / X-Request-Timeout 请求头: 同 /ocr，对所有图片生效
+    """
+
+    if not MODEL_LOADED:
+        raise HTTPException(status_code=503, detail="模型正在加载中，请稍后再试")
+
+    if (request.image is None) == (request.images is None):
+        raise HTTPException(status_code=400, detail="image 和 images 必须且只能提供一个")
+
+    settings = build_settings(request.prompt, request.base_size, request.image_size, request.crop_mode)
+    deadline = request_deadline(request.deadline_ms, x_request_timeout)
+
+    if request.image is not None:
+        idempotency_key = validate_idempotency_key(idempotency_key)
+        data = decode_base64_data(request.image)
+        return JSONResponse(content=await ocr_bytes(data, None, settings, request.save_results, request.bypass_cache,
+                                                    idempotency_key=idempotency_key, request=http_request,
+                                                    deadline=deadline))
 
+    if not request.images:
+        raise HTTPException(status_code=400, detail="images 不能为空")
+
+    async def run_item(index: int, encoded: str) -> dict:
+        item_ticket = admission_controller.split(ticket)
+        try:
+            data = decode_base64_data(encoded)
+            result = await ocr_bytes(data, None, settings, request.save_results, request.bypass_cache,
+                                     admission=item_ticket, request=http_request, deadline=deadline)
+            return {"index": index, **result}
+        except HTTPException as e:
+            return {"index": index, "status": "failed", "detail": e.detail}
+        finally:
+            admission_controller.release(item_ticket)
+
+    # 整个请求一次准入，先按图片数占用页数额度，每张图片（或 PDF）开始识别后按实际页数占用
+    ticket = admission_controller.acquire(len(request.images))
     try:
-        # 解码 base64 图片
-        image_data = base64.b64decode(image_base64)
-        upload_path = UPLOAD_DIR / f"{task_id}.jpg"
+        results = await asyncio.gather(*(run_item(i, encoded) for i, encoded in enumerate(request.images)))
+    finally:
+        admission_controller.release(ticket)
+    succeeded = sum(1 for r in results if r["status"] == "success")
 
-        with open(upload_path, "wb") as f:
-            f.write(image_data)
+    return JSONResponse(content={
+        "status": "success" if succeeded == len(results) else "partial" if succeeded else "failed",
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    })
 
-        logger.info(f"处理 Base64 图片: {task_id}")
 
-        # 设置提示词
-        if prompt is None:
-            prompt = "<image>\n<|grounding|>Convert the document to markdown."
+@app.post("/ocr/binary")
+async def ocr_binary(
+    request: Request,
+    prompt: Optional[str] = None,
+    base_size: int = 1024,
+    image_size: int = 640,
+    crop_mode: bool = True,
+    save_results: bool = False,
+    bypass_cache: bool = False,
+    deadline_ms: Optional[int] = None,
+    x_filename: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None)
+):
+    """
+    OCR 识别（原始二进制输入）
 
-        # 设置输出路径
-        output_path = str(OUTPUT_DIR / task_id)
-        os.makedirs(output_path, exist_ok=True)
+    请求体为文件内容本身（Content-Type: application/octet-stream），参数通过查询字符串传递；
+    文件类型根据文件头识别，内容在内存中直接交给模型，不写入 uploads/。
 
-        # 执行 OCR - 捕获 stdout 输出
-        with capture_stdout() as captured:
-            infer_result = model.infer(
-                tokenizer,
-                prompt=prompt,
-                image_file=str(upload_path),
-                output_path=output_path,
-                base_size=base_size,
-                image_size=image_size,
-                crop_mode=crop_mode,
-                save_results=True,  # 强制保存结果以便提取
-                test_compress=True
-            )
+    参数:
+    - prompt / base_size / image_size / crop_mode / save_results / bypass_cache: 同 /ocr
+    - X-Filename 请求头: 原始文件名（可选，仅用于记录）
+    - Idempotency-Key 请求头、deadline_ms / X-Request-Timeout 请求头: 同 /ocr
+    """
 
-        # 获取捕获的输出
-        stdout_content = captured.getvalue()
-        logger.info(f"捕获的 stdout 长度: {len(stdout_content)}")
+    if not MODEL_LOADED:
+        raise HTTPException(status_code=503, detail="模型正在加载中，请稍后再试")
 
-        logger.info(f"✅ OCR 识别完成: {task_id}")
+    idempotency_key = validate_idempotency_key(idempotency_key)
+    deadline = request_deadline(deadline_ms, x_request_timeout)
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="请求体为空")
 
-        # 从输出目录或 stdout 中提取结果
-        ocr_result = extract_ocr_result(output_path, stdout_content)
+    settings = build_settings(prompt, base_size, image_size, crop_mode)
+    return JSONResponse(content=await ocr_bytes(data, x_filename, settings, save_results, bypass_cache,
+                                                idempotency_key=idempotency_key, request=request, deadline=deadline))
 
-        # 保存文本结果到文件
-        result_file = Path(output_path) / "result.txt"
-        with open(result_file, 'w', encoding='utf-8') as f:
-            f.write(ocr_result["text"])
 
-        logger.info(f"结果已保存到: {result_file}")
+class OCRStreamRequest(BaseModel):
+    """/ocr/stream 的请求消息（文本帧）"""
+    image: str  # Base64 图片（允许 data URL 前缀）
+    prompt: Optional[str] = None
+    base_size: int = 1024
+    image_size: int = 640
+    crop_mode: bool = True
+    bypass_cache: bool = False
 
-        # 构建文件路径（相对路径）
-        result_files = {
-            "text": f"/download/{task_id}/result.txt",
-            "markdown": f"/download/{task_id}/result.mmd" if Path(output_path, "result.mmd").exists() else None,
-            "image_with_boxes": f"/download/{task_id}/result_with_boxes.jpg" if Path(output_path, "result_with_boxes.jpg").exists() else None
-        }
 
-        # 清理文件
-        upload_path.unlink()
+async def stream_page(websocket: WebSocket, data: bytes, settings: Dict[str, Any], bypass_cache: bool):
+    """
+    识别一张图片并通过 WebSocket 推送增量文本
 
-        return JSONResponse(content={
-            "task_id": task_id,
-            "status": "success",
-            "file_type": "image",
-            "total_pages": 1,
-            "total_characters": len(ocr_result["text"]),
-            "files": result_files,
-            "output_path": output_path
-        })
+    推理线程每解码出一段文本就经事件循环转发给客户端；识别过程中客户端断开或发来任何消息时取消识别
+    （正在推理的页面在下一个解码步停止）。WebSocket 不经过 AdmissionMiddleware，每张需要推理的图片
+    在这里准入并占用一页额度，队列已满时抛出 429。
 
+    Returns:
+        bool: 连接是否仍然可用
+    """
+    if check_memory_file(data) == ".pdf":
+        raise HTTPException(status_code=415, detail="/ocr/stream 只支持单张图片，PDF 请使用 /ocr")
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
     except Exception as e:
-        logger.error(f"❌ OCR 处理失败: {str(e)}")
-        if upload_path.exists():
-            upload_path.unlink()
-        raise HTTPException(status_code=500, detail=f"OCR 处理失败: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"图片解码失败: {str(e)}")
+
+    labels = (mode_name(settings), "image")
+    start = time.perf_counter()
+    cache_key = ResultCache.make_key(hashlib.sha256(data).hexdigest(), settings, model_revision())
+    if result_cache is not None and not bypass_cache:
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached:
+            result = cached[0]
+            PAGES_TOTAL.labels(*labels, "cache").inc()
+            CHARACTERS_TOTAL.labels(*labels).inc(len(result.text))
+            await websocket.send_json({"event": "delta", "text": result.text})
+            await websocket.send_json({
+                "event": "done", "text": result.text, "output_tokens": result.output_tokens,
+                "vision_tokens": result.vision_tokens, "blocks": result.blocks, "cached": True,
+                "first_token_ms": round((time.perf_counter() - start) * 1000, 1),
+                "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)
+            })
+            return True
+
+    loop = asyncio.get_running_loop()
+    deltas: asyncio.Queue = asyncio.Queue()
+    first_token_seconds = None
+
+    async def forward():
+        nonlocal first_token_seconds
+        while (delta := await deltas.get()) is not None:
+            if first_token_seconds is None:
+                first_token_seconds = time.perf_counter() - start
+                STREAM_FIRST_TOKEN_SECONDS.labels(labels[0]).observe(first_token_seconds)
+            await websocket.send_json({"event": "delta", "text": delta})
+
+    ticket = admission_controller.acquire(pages=1)
+    INFLIGHT_REQUESTS.labels(*labels).inc()
+    infer_task = asyncio.create_task(inference_worker.infer(
+        image, settings, on_text=lambda delta: loop.call_soon_threadsafe(deltas.put_nowait, delta)
+    ))
+    forward_task = asyncio.create_task(forward())
+    receive_task = asyncio.create_task(websocket.receive())
+    try:
+        await asyncio.wait({infer_task, receive_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not infer_task.done():
+            infer_task.cancel()
+            message = receive_task.result()
+            PAGES_CANCELLED.labels(*labels, "disconnect").inc()
+            CANCELLED_COMPUTE_SECONDS.labels(*labels, "disconnect").inc(inference_worker.seconds_per_page or 0.0)
+            if message["type"] == "websocket.disconnect":
+                return False
+            await websocket.send_json({"event": "cancelled"})
+            return True
+
+        try:
+            result = infer_task.result()
+        except HTTPException:
+            raise
+        except BackendError as e:
+            if e.status_code >= 500:
+                ERRORS_TOTAL.labels(*labels).inc()
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        except Exception as e:
+            ERRORS_TOTAL.labels(*labels).inc()
+            raise HTTPException(status_code=500, detail=f"OCR 处理失败: {str(e)}")
+        # 推理线程的回调先于结果到达事件循环，结束标记之前的增量文本都已入队
+        deltas.put_nowait(None)
+        await forward_task
+    finally:
+        for task in (infer_task, forward_task, receive_task):
+            task.cancel()
+        INFLIGHT_REQUESTS.labels(*labels).dec()
+        admission_controller.release(ticket)
+
+    for stage, seconds in result.timings.items():
+        STAGE_SECONDS.labels(stage, *labels).observe(seconds)
+    PAGES_TOTAL.labels(*labels, "model").inc()
+    CHARACTERS_TOTAL.labels(*labels).inc(len(result.text))
+    if result_cache is not None:
+        await asyncio.to_thread(result_cache.put, cache_key, [result])
+
+    elapsed = time.perf_counter() - start
+    await websocket.send_json({
+        "event": "done",
+        "text": result.text,
+        "output_tokens": result.output_tokens,
+        "vision_tokens": result.vision_tokens,
+        "blocks": result.blocks,
+        "cached": False,
+        "first_token_ms": round((first_token_seconds if first_token_seconds is not None else elapsed) * 1000, 1),
+        "elapsed_ms": round(elapsed * 1000, 1)
+    })
+    return True
+
+
+@app.websocket("/ocr/stream")
+async def ocr_stream(websocket: WebSocket):
+    """
+    交互式单图 OCR（WebSocket，逐 token 推送识别文本）
+
+    一个连接可以依次识别多张图片。每张图片发送一条消息：
+    - 文本帧: JSON，字段同 OCRStreamRequest（image 为 Base64 图片）
+    - 二进制帧: 图片内容本身，推理参数取连接 URL 的查询字符串（prompt/base_size/image_size/crop_mode/bypass_cache）
+
+    服务端推送:
+    - {"event": "delta", "text": "..."}: 新解码出的文本
+    - {"event": "done", "text", "output_tokens", "vision_tokens", "blocks", "cached", "first_token_ms", "elapsed_ms"}
+    - {"event": "error", "status": 4xx/5xx, "detail": "..."}: 该图片失败，连接保持可用（429 时带 retry_after 秒数）
+    - {"event": "cancelled"}: 识别过程中客户端发来任何消息，当前识别已取消
+    """
+    await websocket.accept()
+    query = websocket.query_params
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            try:
+                if not MODEL_LOADED:
+                    raise HTTPException(status_code=503, detail="模型正在加载中，请稍后再试")
+                if message.get("bytes") is not None:
+                    data = message["bytes"]
+                    params = OCRStreamRequest(image="", **{k: v for k, v in query.items()
+                                                           if k in OCRStreamRequest.model_fields})
+                else:
+                    params = OCRStreamRequest.model_validate_json(message.get("text") or "")
+                    data = decode_base64_data(params.image)
+                if not data:
+                    raise HTTPException(status_code=400, detail="图片内容为空")
+                settings = build_settings(params.prompt, params.base_size, params.image_size, params.crop_mode)
+                if not await stream_page(websocket, data, settings, params.bypass_cache):
+                    return
+            except ValidationError as e:
+                errors = "; ".join(".".join(map(str, err["loc"] + (err["msg"],))) for err in e.errors())
+                await websocket.send_json({"event": "error", "status": 400, "detail": f"请求格式错误: {errors}"})
+            except HTTPException as e:
+                error = {"event": "error", "status": e.status_code, "detail": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    error["retry_after"] = int(e.headers["Retry-After"])
+                await websocket.send_json(error)
+    except WebSocketDisconnect:
+        return
+
+
+def is_zip_upload(file: UploadFile) -> bool:
+    """上传文件是否为 ZIP 压缩包"""
+    head = file.file.read(4)
+    file.file.seek(0)
+    return head == b"PK\x03\x04" or (not head and Path(file.filename or "").suffix.lower() == ".zip")
+
+
+def read_zip_entry(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    """读取 ZIP 中的单个条目，解压后超过 UPLOAD_MAX_MB 时拒绝（防止压缩炸弹）"""
+    if info.file_size > UPLOAD_MAX_BYTES:
+        raise upload_too_large()
+    with archive.open(info) as f:
+        data = f.read(UPLOAD_MAX_BYTES + 1)
+    if len(data) > UPLOAD_MAX_BYTES:
+        raise upload_too_large()
+    return data
+
+
+def list_batch_items(files: List[UploadFile]) -> list:
+    """
+    展开批量上传中的文件：普通文件为一项，ZIP 内的每个文件为一项（跳过目录和隐藏文件）
+
+    只读取 ZIP 的目录，条目内容在识别时才逐个解压。
+
+    Returns:
+        list: [(文件名, 读取内容的函数)]
+    """
+    items = []
+    for file in files:
+        if is_zip_upload(file):
+            try:
+                archive = zipfile.ZipFile(file.file)
+            except zipfile.BadZipFile as e:
+                raise HTTPException(status_code=400, detail=f"ZIP 文件损坏: {file.filename}: {str(e)}")
+            for info in archive.infolist():
+                name = Path(info.filename).name
+                if info.is_dir() or info.filename.startswith("__MACOSX/") or name.startswith("."):
+                    continue
+                items.append((info.filename, lambda archive=archive, info=info: read_zip_entry(archive, info)))
+        else:
+            items.append((file.filename, file.file.read))
+
+        if len(items) > OCR_BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"文件数超过上限（{OCR_BATCH_MAX_ITEMS}）")
+    return items
+
+
+@app.post("/ocr/batch")
+async def ocr_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    prompt: Optional[str] = Form(None),
+    base_size: int = Form(1024),
+    image_size: int = Form(640),
+    crop_mode: bool = Form(True),
+    save_results: bool = Form(False),
+    bypass_cache: bool = Form(False),
+    deadline_ms: Optional[int] = Form(None),
+    x_request_timeout: Optional[str] = Header(None)
+):
+    """
+    批量 OCR 识别（多个文件或 ZIP 压缩包）
+
+    ZIP 中的条目在识别时逐个解压，最多 OCR_BATCH_CONCURRENCY 个文件同时在解压/识别，
+    推理工作线程把同时提交的页面合并成批。每个文件是一个独立的子任务，单项失败不影响其他项。
+
+    参数:
+    - files: 图片、PDF 或包含它们的 ZIP 文件（可多个）
+    - prompt / base_size / image_size / crop_mode / save_results / bypass_cache: 同 /ocr，对所有文件生效
+    - deadline_ms / X-Request-Timeout 请求头: 整个批次的截止时间，到时未完成的文件以 504 失败
+
+    客户端断开时取消所有未完成的文件。
+
+    返回:
+    批次 task_id 和逐项结果（含识别文本）；全部结果同时写入 /download/{task_id}/results.jsonl
+    """
+
+    if not MODEL_LOADED:
+        raise HTTPException(status_code=503, detail="模型正在加载中，请稍后再试")
+
+    batch_id = str(uuid.uuid4())
+    settings = build_settings(prompt, base_size, image_size, crop_mode)
+    deadline = request_deadline(deadline_ms, x_request_timeout)
+    items = await asyncio.to_thread(list_batch_items, files)
+    if not items:
+        raise HTTPException(status_code=400, detail="没有可识别的文件")
+
+    # 整个批次一次准入，先按文件数占用页数额度，每个文件打开后按实际页数占用（PDF 按选中的页数）
+    ticket = admission_controller.acquire(len(items))
+
+    logger.info(f"开始批量任务: {batch_id}（{len(items)} 个文件）")
+    batch_start = time.time()
+    slots = asyncio.Semaphore(max(1, OCR_BATCH_CONCURRENCY))
+
+    async def run_item(index: int, filename: str, read) -> dict:
+        item = {"index": index, "filename": filename}
+        async with slots:
+            item_ticket = admission_controller.split(ticket)
+            try:
+                data = await asyncio.to_thread(read)
+                job = create_memory_job(data, filename, settings, bypass_cache)
+                job.admission = item_ticket
+                job.deadline = deadline
+                texts = [page["text"] async for page in iter_ocr_job(job, data, save_results)]
+            except HTTPException as e:
+                return {**item, "status": "failed", "detail": e.detail}
+            except Exception as e:
+                logger.error(f"❌ 批量任务 {batch_id} 第 {index} 项失败: {str(e)}")
+                return {**item, "status": "failed", "detail": str(e)}
+            finally:
+                admission_controller.release(item_ticket)
+
+        return {
+            **item,
+            "status": "success",
+            "task_id": job.task_id,
+            "file_type": job.file_type,
+            "total_pages": job.total_pages,
+            "cache_hit": job.cache_hit,
+            "text": PAGE_SPLIT.join(texts),
+            "files": job.result["files"]
+        }
+
+    gathered = asyncio.gather(*(run_item(i, name, read) for i, (name, read) in enumerate(items)))
+    try:
+        # 等待期间检查客户端是否断开，断开时取消所有未完成的文件
+        while not gathered.done():
+            await asyncio.wait({gathered}, timeout=DISCONNECT_POLL_SECONDS)
+            if not gathered.done() and await request.is_disconnected():
+                gathered.cancel()
+                logger.info(f"批量任务 {batch_id} 的客户端已断开，取消未完成的文件")
+                raise HTTPException(status_code=499, detail="客户端已断开")
+        results = gathered.result()
+    except asyncio.CancelledError:
+        gathered.cancel()
+        raise
+    finally:
+        admission_controller.release(ticket)
+    succeeded = sum(1 for r in results if r["status"] == "success")
+
+    # 逐项结果写入 results.jsonl，便于之后下载
+    output_path = OUTPUT_DIR / batch_id
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(output_path / "results.jsonl", "w", encoding="utf-8") as f:
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    await asyncio.to_thread(write_compressed_sidecars, output_path)
+
+    logger.info(f"✅ 批量任务完成: {batch_id}（成功 {succeeded}/{len(results)}，"
+                f"耗时 {time.time() - batch_start:.1f} 秒）")
+
+    return JSONResponse(content={
+        "task_id": batch_id,
+        "status": "success" if succeeded == len(results) else "partial" if succeeded else "failed",
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results,
+        "files": {"results": f"/download/{batch_id}/results.jsonl"},
+        "settings": settings
+    })
+
+
+# 结果文件的 Content-Type（其他文件按扩展名猜测）
+DOWNLOAD_MEDIA_TYPES = {
+    ".txt": "text/plain; charset=utf-8",
+    ".mmd": "text/markdown; charset=utf-8",
+    ".md": "text/markdown; charset=utf-8",
+    ".jsonl": "application/x-ndjson; charset=utf-8",
+    ".json": "application/json"
+}
+# 生成预压缩副本的文件类型
+COMPRESSIBLE_SUFFIXES = (".txt", ".mmd", ".md", ".jsonl", ".json")
+# Content-Encoding -> 预压缩副本的后缀（按优先级排列）
+SIDECAR_ENCODINGS = (("zstd", ".zst"), ("gzip", ".gz"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def write_compressed_sidecars(directory: Path):
+    """
+    为目录中的文本结果生成 .gz / .zst 预压缩副本（zstd 需安装 zstandard）
+
+    只在任务完成时执行一次，下载时直接返回副本，不必每次请求都压缩。副本先写入临时文件再改名，
+    不会被读到写了一半的内容。
+    """
+    for path in directory.iterdir():
+        if path.suffix not in COMPRESSIBLE_SUFFIXES or not path.is_file():
+            continue
+        if path.stat().st_size < DOWNLOAD_COMPRESS_MIN_BYTES:
+            continue
+        for encoding, suffix in SIDECAR_ENCODINGS:
+            if encoding == "zstd" and zstandard is None:
+                continue
+            sidecar = path.with_name(path.name + suffix)
+            tmp = path.with_name(path.name + suffix + ".tmp")
+            with open(path, "rb") as src, open(tmp, "wb") as dst:
+                if encoding == "gzip":
+                    with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=6, mtime=0) as gz:
+                        shutil.copyfileobj(src, gz)
+                else:
+                    zstandard.ZstdCompressor(level=10).copy_stream(src, dst)
+            os.replace(tmp, sidecar)
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """由修改时间和大小计算 ETag"""
+    return hashlib.blake2b(f"{stat.st_mtime_ns}-{stat.st_size}".encode(), digest_size=16).hexdigest()
+
+
+def accepted_encodings(header: Optional[str]) -> set:
+    """解析 Accept-Encoding，返回 q > 0 的编码"""
+    encodings = set()
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单个字节范围（bytes=a-b / bytes=a- / bytes=-n），返回 [start, end]（含 end）
+
+    格式无法识别或包含多个范围时返回 None（按完整内容返回）；范围无法满足时抛出 416。
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) \
+            or (last and not last.isdigit()):
+        return None
+
+    if not first:
+        # 最后 n 个字节
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="请求的范围无法满足",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+    """条件请求：If-None-Match 优先，其次 If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or f'"{etag}"' in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat.st_mtime) <= since
+    return False
+
+
+def if_range_matches(if_range: Optional[str], etag: str, stat: os.stat_result) -> bool:
+    """If-Range：未给出，或与当前 ETag（强比较）/ Last-Modified 一致时按范围返回"""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        return if_range == f'"{etag}"'
+    try:
+        since = email.utils.parsedate_to_datetime(if_range).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(stat.st_mtime) == int(since)
+
+
+async def _read_file_range(path: Path, start: int, end: int):
+    """分块读取文件的 [start, end] 字节"""
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
 
 @app.get("/download/{task_id}/{filename}")
-async def download_file(task_id: str, filename: str):
+async def download_file(task_id: str, filename: str, request: Request):
     """
     下载 OCR 结果文件
 
@@ -552,6 +4505,11 @@ async def download_file(task_id: str, filename: str):
     - task_id: 任务 ID
     - filename: 文件名（result.txt, result.mmd, result_with_boxes.jpg 等）
 
+    支持:
+    - ETag / Last-Modified 条件请求（未变化时返回 304）
+    - Range 单范围读取（返回 206）
+    - 按 Accept-Encoding 返回任务完成时生成的 zstd / gzip 预压缩副本
+
     返回:
     文件内容
     """
@@ -570,21 +4528,80 @@ async def download_file(task_id: str, filename: str):
     if not file_path.is_file():
         raise HTTPException(status_code=400, detail="请求的不是一个文件")
 
+    stat = file_path.stat()
+    etag = file_etag(stat)
+    media_type = DOWNLOAD_MEDIA_TYPES.get(file_path.suffix.lower()) \
+        or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers = {
+        "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache",
+        "Accept-Ranges": "bytes"
+    }
+
+    # 范围请求按原始内容计算（If-Range 与当前 ETag / Last-Modified 不一致时返回完整内容）
+    range_header = request.headers.get("range")
+    ranged = bool(range_header) and if_range_matches(request.headers.get("if-range"), etag, stat)
+
+    # 内容协商：客户端接受且存在预压缩副本时返回副本（范围请求始终使用原始内容）
+    serve_path, encoding = file_path, None
+    if file_path.suffix in COMPRESSIBLE_SUFFIXES:
+        headers["Vary"] = "Accept-Encoding"
+        accepted = set() if ranged else accepted_encodings(request.headers.get("accept-encoding"))
+        for candidate, suffix in SIDECAR_ENCODINGS:
+            sidecar = file_path.with_name(filename + suffix)
+            if candidate in accepted and sidecar.is_file() and sidecar.stat().st_mtime_ns >= stat.st_mtime_ns:
+                serve_path, encoding = sidecar, candidate
+                break
+    if encoding is not None:
+        etag = f"{etag}-{encoding}"
+        headers["Content-Encoding"] = encoding
+    headers["ETag"] = f'"{etag}"'
+
+    # 条件请求先于 Range 判断：未变化时即使带 Range 也返回 304
+    if not_modified(request, etag, stat):
+        return Response(status_code=304, headers=headers)
+
+    if ranged:
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is not None:
+            start, end = byte_range
+            return StreamingResponse(
+                _read_file_range(file_path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers={
+                    **headers,
+                    "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                    "Content-Length": str(end - start + 1)
+                }
+            )
+
     # 返回文件
     return FileResponse(
-        path=str(file_path),
+        path=str(serve_path),
         filename=filename,
-        media_type="application/octet-stream"
+        media_type=media_type,
+        headers=headers
     )
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 监控指标"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/models/info")
 async def model_info():
     """获取模型信息"""
     return {
         "model_path": MODEL_PATH,
         "model_loaded": MODEL_LOADED,
+        "state": MODEL_STATE,
+        "startup_timings": STARTUP_TIMINGS,
+        "warmup_seconds": WARMUP_SECONDS,
         "cuda_device": CUDA_DEVICE,
+        "backend": backend.name,
         "supported_modes": {
             "Tiny": {"base_size": 512, "image_size": 512, "crop_mode": False, "tokens": 64},
             "Small": {"base_size": 640, "image_size": 640, "crop_mode": False, "tokens": 100},
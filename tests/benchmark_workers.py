@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+多进程推理基准测试（INFERENCE_WORKERS）
+
+依次以不同的推理进程数启动服务，并发提交同一批页面，统计吞吐量（页/秒）以及服务进程树的内存占用。
+RSS 会重复计算写时复制共享的模型权重，PSS 按共享进程数平摊，更接近真实占用。
+
+需要在 Linux CPU 主机上运行（读取 /proc 统计内存），可以从任意目录启动。
+不指定 --image 时使用合成的文档页面；--server-env 可传入额外的环境变量（如 fake 推理后端）:
+    python tests/benchmark_workers.py
+    python tests/benchmark_workers.py --image page.png --workers 1,2,4,8
+    python tests/benchmark_workers.py --server-env INFERENCE_BACKEND=fake
+"""
+
+import argparse
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from PIL import Image, ImageDraw
+
+# 基准配置（均可通过命令行参数覆盖）
+REPO_ROOT = Path(__file__).resolve().parent.parent
+WORKER_COUNTS = [1, 2, 4]  # 依次测试的推理进程数
+PORT = 3031
+TOTAL_PAGES = 16  # 每轮提交的页数
+CONCURRENCY = 8  # 并发请求数
+PARAMS = {"base_size": 640, "image_size": 640, "crop_mode": "false", "bypass_cache": "true"}
+STARTUP_TIMEOUT = 900  # 等待模型加载和预热的最长时间（秒）
+
+
+def synthesize_page(seed=0):
+    """合成一页 A4（150 dpi）文档图片：标题和若干行文字"""
+    width, height = 1240, 1754
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(seed)
+    draw.text((width // 10, height // 20), f"Benchmark document {seed}", fill="black")
+    for row in range(40):
+        words = " ".join(rng.choice(("total", "amount", "date", "item", "value", "report", "page", "data"))
+                         for _ in range(rng.randrange(3, 12)))
+        draw.text((width // 10, height // 10 + row * 28), words, fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def process_tree(root_pid):
+    """服务进程及其所有子进程的 pid"""
+    parents = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # stat 格式: pid (comm) state ppid ...
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        parents.setdefault(ppid, []).append(int(entry.name))
+
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(parents.get(pid, []))
+    return pids
+
+
+def memory_mb(root_pid):
+    """进程树的 (RSS, PSS)，单位 MB"""
+    rss = pss = 0
+    for pid in process_tree(root_pid):
+        try:
+            for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+                if line.startswith("Rss:"):
+                    rss += int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss += int(line.split()[1])
+        except OSError:
+            continue
+    return rss / 1024, pss / 1024
+
+
+def start_server(workers, port, env_overrides):
+    """在临时目录中启动服务（uploads/、outputs/ 等不写入仓库）"""
+    env = dict(os.environ, INFERENCE_WORKERS=str(workers), PORT=str(port))
+    env.update(env_overrides)
+    workdir = tempfile.mkdtemp(prefix="ocr-bench-")
+    server = subprocess.Popen([sys.executable, str(REPO_ROOT / "app.py")], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://localhost:{port}/health", timeout=2).json().get("status") == "ready":
+                return server
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"服务启动失败（exitcode={server.returncode}）")
+        time.sleep(2)
+    server.terminate()
+    raise RuntimeError("等待服务就绪超时")
+
+
+def run_round(workers, image_data, args, env_overrides):
+    server = start_server(workers, args.port, env_overrides)
+    idle_rss, idle_pss = memory_mb(server.pid)
+    peak = [idle_rss, idle_pss]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.5):
+            rss, pss = memory_mb(server.pid)
+            peak[0], peak[1] = max(peak[0], rss), max(peak[1], pss)
+
+    def ocr(_):
+        """返回 "ok"、"coalesced"（合并到其他请求，没有单独识别）或 None"""
+        response = requests.post(f"http://localhost:{args.port}/ocr/binary", params=PARAMS, data=image_data,
+                                 headers={"Content-Type": "application/octet-stream"}, timeout=600)
+        if response.status_code != 200:
+            return None
+        return "coalesced" if response.json().get("coalesced") else "ok"
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        # 预热一页，不计入统计
+        ocr(0)
+        start = time.time()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            outcomes = list(executor.map(ocr, range(args.pages)))
+        elapsed = time.time() - start
+    finally:
+        done.set()
+        sampler.join()
+        server.terminate()
+        server.wait(timeout=30)
+
+    # 合并到其他请求的响应不计入吞吐量
+    ok = outcomes.count("ok")
+    return {
+        "workers": workers,
+        "ok": ok,
+        "coalesced": outcomes.count("coalesced"),
+        "pages_per_second": ok / elapsed,
+        "idle_rss": idle_rss,
+        "idle_pss": idle_pss,
+        "peak_rss": peak[0],
+        "peak_pss": peak[1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程推理基准测试（INFERENCE_WORKERS）")
+    parser.add_argument("--image", help="测试图片路径（默认使用合成的文档页面）")
+    parser.add_argument("--workers", default=",".join(map(str, WORKER_COUNTS)), help="依次测试的推理进程数，逗号分隔")
+    parser.add_argument("--pages", type=int, default=TOTAL_PAGES, help="每轮提交的页数")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="并发请求数")
+    parser.add_argument("--port", type=int, default=PORT, help="服务端口")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="启动服务时额外设置的环境变量（可重复）")
+    args = parser.parse_args()
+
+    if args.image is not None:
+        if not Path(args.image).exists():
+            print(f"❌ 测试图片不存在: {args.image}")
+            sys.exit(1)
+        image_data = Path(args.image).read_bytes()
+    else:
+        image_data = synthesize_page()
+    env_overrides = dict(item.split("=", 1) for item in args.server_env)
+
+    print("=" * 70)
+    print(f"多进程推理基准: {args.pages} 页，并发 {args.concurrency}，CPU 核数 {os.cpu_count()}")
+    print("=" * 70)
+
+    rows = []
+    for workers in [int(n) for n in args.workers.split(",")]:
+        print(f"\n测试 INFERENCE_WORKERS={workers} ...")
+        row = run_round(workers, image_data, args, env_overrides)
+        rows.append(row)
+        print(f"  识别 {row['ok']}/{args.pages} 页（合并 {row['coalesced']} 页），{row['pages_per_second']:.3f} 页/秒")
+
+    base = rows[0]["pages_per_second"] or 1
+    print()
+    print(f"{'进程数':>6} {'页/秒':>8} {'加速比':>6} {'空闲RSS(MB)':>12} {'空闲PSS(MB)':>12} {'峰值RSS(MB)':>12} {'峰值PSS(MB)':>12}")
+    for row in rows:
+        print(f"{row['workers']:>6} {row['pages_per_second']:>8.3f} {row['pages_per_second'] / base:>6.2f} "
+              f"{row['idle_rss']:>12.0f} {row['idle_pss']:>12.0f} {row['peak_rss']:>12.0f} {row['peak_pss']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+压测 / 浸泡测试（/ocr、/ocr/base64、/download）
+
+按配置的并发数、到达速率和文档组合发送识别请求，成功后按比例下载结果文件，
+输出各接口的吞吐量、p50/p95/p99 延迟和错误率。浸泡模式（--soak）在整个运行期间定期采样
+服务进程树的 RSS / PSS、打开的文件描述符数以及 uploads/、outputs/ 的大小，检查内存、句柄和磁盘是否持续增长。
+
+测试文档在本地合成（带文字的 PNG 图片和多页 PDF），不依赖固定路径。
+不指定 --url 时在临时目录中以 fake 推理后端（INFERENCE_BACKEND=fake）启动服务，不需要模型权重和 GPU:
+    python tests/load_test.py --requests 500 --concurrency 16
+    python tests/load_test.py --soak --requests 5000 --rate 20
+    python tests/load_test.py --server-env FAKE_OUTPUT_TOKEN_MS=1 --server-env INFERENCE_WORKERS=2
+
+对已运行的服务（资源采样需要在服务所在主机上运行，并给出服务进程 pid 和工作目录）:
+    python tests/load_test.py --url http://localhost:3030 --pid 12345 --workdir /path/to/service
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import requests
+from PIL import Image, ImageDraw
+
+# 与 benchmark_workers.py 同目录，从任意工作目录运行都能导入
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from benchmark_workers import memory_mb, process_tree
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+STARTUP_TIMEOUT = 300  # 等待服务就绪的最长时间（秒）
+
+# 识别模式 -> 表单参数
+MODES = {
+    "tiny": {"base_size": 512, "image_size": 512, "crop_mode": "false"},
+    "small": {"base_size": 640, "image_size": 640, "crop_mode": "false"},
+    "base": {"base_size": 1024, "image_size": 1024, "crop_mode": "false"},
+    "large": {"base_size": 1280, "image_size": 1280, "crop_mode": "false"},
+    "gundam": {"base_size": 1024, "image_size": 640, "crop_mode": "true"},
+}
+
+
+def parse_weights(spec):
+    """解析 "a:3,b:1" 形式的权重"""
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.strip().partition(":")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values, p):
+    """最近秩百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+# ---------------------------------------------------------------- 测试文档
+
+def render_page(width, height, seed):
+    """合成一页文档图片：标题和若干行文字"""
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(seed)
+    draw.text((width // 10, height // 20), f"Load test document {seed}", fill="black")
+    line_height = max(14, height // 60)
+    for row in range(rng.randrange(10, 40)):
+        words = " ".join(rng.choice(("total", "amount", "date", "item", "value", "report", "page", "data"))
+                         for _ in range(rng.randrange(3, 12)))
+        draw.text((width // 10, height // 10 + row * line_height), words, fill="black")
+    return image
+
+
+def make_document(kind, seed, pdf_pages):
+    """返回 (文件名, 内容, 页数)"""
+    if kind == "receipt":
+        buffer = io.BytesIO()
+        render_page(600, 900, seed).save(buffer, "PNG")
+        return f"receipt_{seed}.png", buffer.getvalue(), 1
+    if kind == "image":
+        buffer = io.BytesIO()
+        render_page(1240, 1754, seed).save(buffer, "PNG")
+        return f"page_{seed}.png", buffer.getvalue(), 1
+    if kind == "pdf":
+        pages = [render_page(1240, 1754, seed * 1000 + i) for i in range(pdf_pages)]
+        buffer = io.BytesIO()
+        pages[0].save(buffer, "PDF", save_all=True, append_images=pages[1:], resolution=150)
+        return f"doc_{seed}.pdf", buffer.getvalue(), pdf_pages
+    raise ValueError(f"未知的文档类型: {kind}（可选: receipt, image, pdf）")
+
+
+# ---------------------------------------------------------------- 服务
+
+def start_server(port, env_overrides):
+    """在临时目录中启动服务（默认 fake 推理后端），返回 (进程, 工作目录)"""
+    workdir = Path(tempfile.mkdtemp(prefix="ocr-load-"))
+    env = dict(os.environ, PORT=str(port), INFERENCE_BACKEND="fake", WARMUP_MODES="none")
+    env.update(env_overrides)
+    log = open(workdir / "server.log", "w")
+    server = subprocess.Popen([sys.executable, str(REPO_ROOT / "app.py")], cwd=workdir, env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://localhost:{port}/health", timeout=2).json().get("status") == "ready":
+                return server, workdir
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"服务启动失败（exitcode={server.returncode}），日志: {workdir / 'server.log'}")
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"等待服务就绪超时，日志: {workdir / 'server.log'}")
+
+
+def directory_usage(path):
+    """目录下的 (字节数, 文件数)"""
+    size = count = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+                count += 1
+            except OSError:
+                continue
+    return size, count
+
+
+def open_fds(root_pid):
+    """进程树打开的文件描述符数"""
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            total += len(os.listdir(f"/proc/{pid}/fd"))
+        except OSError:
+            continue
+    return total
+
+
+class ResourceSampler(threading.Thread):
+    """定期采样服务进程树的内存、文件描述符和 uploads/、outputs/ 的大小"""
+
+    def __init__(self, pid, workdir, interval, progress):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.workdir = Path(workdir) if workdir else None
+        self.interval = interval
+        self.progress = progress  # 返回已完成的请求数
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def sample(self):
+        row = {"elapsed": time.time() - self.started, "completed": self.progress()}
+        if self.pid:
+            row["rss_mb"], row["pss_mb"] = memory_mb(self.pid)
+            row["fds"] = open_fds(self.pid)
+        if self.workdir:
+            for name in ("uploads", "outputs"):
+                size, count = directory_usage(self.workdir / name)
+                row[f"{name}_mb"], row[f"{name}_files"] = size / 1024 / 1024, count
+        self.samples.append(row)
+        print("  [soak] " + "  ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in row.items()),
+              flush=True)
+
+    def run(self):
+        self.started = time.time()
+        self.sample()
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+    def report(self):
+        """以运行 10% 之后的第一个采样为基线，计算每 1000 个请求的增长量"""
+        if len(self.samples) < 2:
+            return {}
+        last = self.samples[-1]
+        baseline = next((s for s in self.samples if s["completed"] >= last["completed"] * 0.1), self.samples[0])
+        requests_done = max(1, last["completed"] - baseline["completed"])
+        growth = {}
+        for key in ("rss_mb", "pss_mb", "fds", "uploads_mb", "uploads_files", "outputs_mb", "outputs_files"):
+            if key in last:
+                growth[key] = {
+                    "baseline": baseline[key],
+                    "last": last[key],
+                    "max": max(s[key] for s in self.samples),
+                    "per_1000_requests": (last[key] - baseline[key]) / requests_done * 1000
+                }
+        return growth
+
+
+# ---------------------------------------------------------------- 负载
+
+class LoadTest:
+    def __init__(self, args, base_url):
+        self.args = args
+        self.base_url = base_url
+        self.rng = random.Random(args.seed)
+        self.form = {**MODES[args.mode], "bypass_cache": "false" if args.use_cache else "true"}
+        self.records = []  # (接口, 状态码, 延迟秒数, 页数)
+        self.coalesced = 0
+        self.saved = 0  # 要求保存结果并成功的请求数（服务会保留它们的上传文件）
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.local = threading.local()
+
+        doc_weights = parse_weights(args.docs)
+        self.doc_kinds, self.doc_weights = list(doc_weights), list(doc_weights.values())
+        endpoint_weights = parse_weights(args.endpoints)
+        for name in endpoint_weights:
+            if name not in ("ocr", "base64"):
+                raise ValueError(f"未知的接口: {name}（可选: ocr, base64）")
+        self.endpoints, self.endpoint_weights = list(endpoint_weights), list(endpoint_weights.values())
+
+        # 每种文档预先生成 doc_pool 个不同的样本，避免客户端编码图片成为瓶颈
+        print(f"生成测试文档（每种 {args.doc_pool} 个）...")
+        self.documents = {
+            kind: [make_document(kind, seed, args.pdf_pages) for seed in range(args.doc_pool)]
+            for kind in self.doc_kinds
+        }
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def record(self, endpoint, status, seconds, pages=0):
+        with self.lock:
+            self.records.append((endpoint, status, seconds, pages))
+
+    def one_request(self, index, scheduled_at):
+        """发送一个识别请求（延迟从计划到达时刻算起，包含客户端排队，避免协调遗漏）"""
+        rng = random.Random(self.args.seed * 1000003 + index)
+        kind = rng.choices(self.doc_kinds, self.doc_weights)[0]
+        filename, data, _ = rng.choice(self.documents[kind])
+        endpoint = rng.choices(self.endpoints, self.endpoint_weights)[0]
+        form = {**self.form, "save_results": "true" if rng.random() < self.args.save_results else "false"}
+
+        try:
+            if endpoint == "ocr":
+                response = self.session().post(f"{self.base_url}/ocr", data=form, files={"file": (filename, data)},
+                                               timeout=self.args.timeout)
+            else:
+                form["image_base64"] = base64.b64encode(data).decode()
+                response = self.session().post(f"{self.base_url}/ocr/base64", data=form, timeout=self.args.timeout)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+            response = None
+
+        pages = 0
+        result = None
+        if status == 200:
+            result = response.json()
+            pages = len(result.get("pages") or [])
+            with self.lock:
+                self.coalesced += bool(result.get("coalesced"))
+                self.saved += form["save_results"] == "true"
+        self.record(endpoint, status, time.time() - scheduled_at, pages)
+
+        if result is not None and rng.random() < self.args.download:
+            self.download(result.get("files") or {})
+
+        with self.lock:
+            self.completed += 1
+
+    def download(self, files):
+        """下载结果文件（text / markdown / 可视化图片）"""
+        urls = []
+        for value in files.values():
+            if isinstance(value, list):
+                urls.extend(value)
+            elif value:
+                urls.append(value)
+        for url in urls:
+            start = time.time()
+            try:
+                response = self.session().get(f"{self.base_url}{url}", timeout=self.args.timeout)
+                status = response.status_code if response.content or response.status_code != 200 else "empty"
+            except requests.RequestException as e:
+                status = type(e).__name__
+            self.record("download", status, time.time() - start)
+
+    def run(self):
+        """
+        闭环（--rate 0）：concurrency 个客户端各自发完一个再发下一个；
+        开环（--rate R）：按泊松过程每秒平均到达 R 个请求，同时最多 concurrency 个在途，其余在客户端排队
+        """
+        args = self.args
+        stop_at = time.time() + args.duration if args.duration else None
+        start = time.time()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            futures = []
+            pending = set()
+            next_arrival = start
+            index = 0
+            while (stop_at is None and index < args.requests) or (stop_at is not None and time.time() < stop_at):
+                if args.rate > 0:
+                    next_arrival += self.rng.expovariate(args.rate)
+                    time.sleep(max(0.0, next_arrival - time.time()))
+                    scheduled_at = next_arrival
+                else:
+                    # 闭环：等到有空闲的客户端再发
+                    if len(pending) >= args.concurrency:
+                        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    scheduled_at = time.time()
+                future = executor.submit(self.one_request, index, scheduled_at)
+                futures.append(future)
+                if args.rate <= 0:
+                    pending.add(future)
+                index += 1
+            for future in futures:
+                future.result()
+        return time.time() - start
+
+
+# ---------------------------------------------------------------- 报告
+
+def summarize(records, elapsed):
+    rows = {}
+    for endpoint in ("ocr", "base64", "download"):
+        items = [r for r in records if r[0] == endpoint]
+        if not items:
+            continue
+        ok = [r for r in items if r[1] == 200]
+        latencies = [r[2] * 1000 for r in ok]
+        statuses = {}
+        for r in items:
+            statuses[str(r[1])] = statuses.get(str(r[1]), 0) + 1
+        rows[endpoint] = {
+            "requests": len(items),
+            "ok": len(ok),
+            "error_rate": 1 - len(ok) / len(items),
+            "throughput_rps": len(ok) / elapsed,
+            "pages_per_second": sum(r[3] for r in ok) / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": max(latencies, default=0.0),
+            "statuses": statuses
+        }
+    return rows
+
+
+def print_report(rows, elapsed, coalesced, saved, growth):
+    print()
+    print("=" * 100)
+    print(f"运行 {elapsed:.1f} 秒，合并到其他请求的响应 {coalesced} 个")
+    print("=" * 100)
+    print(f"{'接口':<10} {'请求数':>7} {'成功':>7} {'错误率':>7} {'req/s':>8} {'页/秒':>8} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'最大(ms)':>9}  状态码")
+    for endpoint, row in rows.items():
+        print(f"{endpoint:<10} {row['requests']:>7} {row['ok']:>7} {row['error_rate']:>7.2%} "
+              f"{row['throughput_rps']:>8.2f} {row['pages_per_second']:>8.2f} {row['p50_ms']:>9.0f} "
+              f"{row['p95_ms']:>9.0f} {row['p99_ms']:>9.0f} {row['max_ms']:>9.0f}  {row['statuses']}")
+
+    if growth:
+        print()
+        print(f"{'资源':<14} {'基线':>10} {'结束':>10} {'峰值':>10} {'每千请求增长':>14}")
+        for key, value in growth.items():
+            print(f"{key:<14} {value['baseline']:>10.1f} {value['last']:>10.1f} {value['max']:>10.1f} "
+                  f"{value['per_1000_requests']:>14.2f}")
+        # 句柄数应回到基线附近；只有要求保存结果的请求会保留上传文件，其余应在请求结束后删除。
+        # outputs/ 由结果保留策略（RETENTION_*）定期清理，短时间内随请求数线性增长是正常的
+        if growth.get("fds", {}).get("per_1000_requests", 0) > 10:
+            print("⚠️  文件描述符持续增长，可能存在句柄泄漏")
+        if "uploads_files" in growth and growth["uploads_files"]["last"] > saved:
+            print(f"⚠️  uploads/ 中有 {growth['uploads_files']['last']:.0f} 个文件，"
+                  f"多于要求保存结果的请求数 {saved}，上传文件可能未被清理")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek-OCR 服务压测 / 浸泡测试")
+    parser.add_argument("--url", help="被测服务地址；不指定时在临时目录中以 fake 推理后端启动服务")
+    parser.add_argument("--port", type=int, default=3032, help="自行启动服务时的端口")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="自行启动服务时额外的环境变量（可重复）")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留自行启动服务的临时工作目录（含 server.log）")
+    parser.add_argument("--pid", type=int, help="被测服务的进程 pid（--url 时用于采样内存和文件描述符）")
+    parser.add_argument("--workdir", help="被测服务的工作目录（--url 时用于采样 uploads/、outputs/）")
+    parser.add_argument("--requests", type=int, default=200, help="识别请求总数")
+    parser.add_argument("--duration", type=float, default=0, help="运行时长（秒），大于 0 时代替 --requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时在途的请求数上限")
+    parser.add_argument("--rate", type=float, default=0, help="平均到达速率（请求/秒，泊松到达），0 为闭环")
+    parser.add_argument("--docs", default="receipt:3,image:6,pdf:1", help="文档组合权重（receipt / image / pdf）")
+    parser.add_argument("--pdf-pages", type=int, default=4, help="PDF 文档的页数")
+    parser.add_argument("--doc-pool", type=int, default=32, help="每种文档预先生成的不同样本数")
+    parser.add_argument("--endpoints", default="ocr:3,base64:1", help="识别接口权重（ocr / base64）")
+    parser.add_argument("--download", type=float, default=1.0, help="成功后下载结果文件的请求比例")
+    parser.add_argument("--save-results", type=float, default=0.2, help="要求保存结果（可视化图片、markdown）的请求比例")
+    parser.add_argument("--mode", choices=list(MODES), default="gundam", help="识别模式")
+    parser.add_argument("--use-cache", action="store_true", help="允许命中结果缓存（默认 bypass_cache=true）")
+    parser.add_argument("--timeout", type=float, default=600, help="单个请求的超时（秒）")
+    parser.add_argument("--soak", action="store_true", help="浸泡模式：定期采样内存、文件描述符和磁盘占用")
+    parser.add_argument("--sample-interval", type=float, default=10, help="浸泡模式的采样间隔（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    server = None
+    pid, workdir = args.pid, args.workdir
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        env = dict(item.split("=", 1) for item in args.server_env)
+        print(f"启动服务（{env.get('INFERENCE_BACKEND', 'fake')} 推理后端，端口 {args.port}）...")
+        server, workdir = start_server(args.port, env)
+        pid = server.pid
+        base_url = f"http://localhost:{args.port}"
+        print(f"服务工作目录: {workdir}")
+
+    sampler = None
+    try:
+        test = LoadTest(args, base_url)
+        if args.soak:
+            if not pid and not workdir:
+                print("⚠️  未指定 --pid / --workdir，浸泡模式只统计请求")
+            sampler = ResourceSampler(pid, workdir, args.sample_interval, lambda: test.completed)
+            sampler.start()
+        print(f"开始压测: {args.requests if not args.duration else f'{args.duration:.0f} 秒'}，"
+              f"并发 {args.concurrency}，{f'到达速率 {args.rate}/秒' if args.rate else '闭环'}，"
+              f"文档 {args.docs}，接口 {args.endpoints}")
+        elapsed = test.run()
+        if sampler is not None:
+            sampler.stop()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+            if not args.keep_workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    rows = summarize(test.records, elapsed)
+    growth = sampler.report() if sampler is not None else {}
+    print_report(rows, elapsed, test.coalesced, test.saved, growth)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({
+            "elapsed_seconds": elapsed,
+            "coalesced": test.coalesced,
+            "saved_results": test.saved,
+            "endpoints": rows,
+            "resources": growth,
+            "samples": sampler.samples if sampler is not None else []
+        }, ensure_ascii=False, indent=2))
+        print(f"\n结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+测试异步任务接口（POST /jobs + GET /jobs/{task_id}）
+"""
+
+import requests
+import json
+import sys
+import time
+from pathlib import Path
+
+# API 配置
+API_BASE_URL = "http://localhost:3030"
+TEST_FILE = "DeepSeek_OCR_paper.pdf"  # 修改为你的测试文件路径（图片或 PDF）
+POLL_INTERVAL = 2  # 轮询间隔（秒）
+TIMEOUT = 600  # 最长等待时间（秒）
+
+
+def submit_job():
+    """提交异步任务"""
+    print("\n" + "=" * 50)
+    print("测试 1: 提交异步任务")
+    print("=" * 50)
+
+    if not Path(TEST_FILE).exists():
+        print(f"❌ 测试文件不存在: {TEST_FILE}")
+        return None
+
+    with open(TEST_FILE, 'rb') as f:
+        files = {'file': f}
+        data = {
+            'base_size': 1024,
+            'image_size': 640,
+            'crop_mode': True
+        }
+        start = time.time()
+        response = requests.post(f"{API_BASE_URL}/jobs", files=files, data=data, timeout=60)
+
+    print(f"状态码: {response.status_code}（耗时 {time.time() - start:.2f} 秒）")
+    print(f"响应: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
+
+    if response.status_code != 202:
+        return None
+    return response.json()["task_id"]
+
+
+def wait_for_job(task_id):
+    """轮询任务状态直到结束"""
+    print("\n" + "=" * 50)
+    print("测试 2: 查询任务进度")
+    print("=" * 50)
+
+    # 任务执行期间健康检查应立即返回
+    start = time.time()
+    health = requests.get(f"{API_BASE_URL}/health", timeout=10)
+    print(f"推理期间健康检查: {health.status_code}（耗时 {time.time() - start:.3f} 秒）")
+
+    deadline = time.time() + TIMEOUT
+    while time.time() < deadline:
+        response = requests.get(f"{API_BASE_URL}/jobs/{task_id}", timeout=10)
+        job = response.json()
+        progress = job["progress"]
+        print(f"  状态: {job['status']}  进度: {progress['completed_pages']}/{progress['total_pages']} ({progress['percent']}%)")
+
+        if job["status"] == "success":
+            print(f"\n结果文件: {json.dumps(job['files'], indent=2, ensure_ascii=False)}")
+            return True
+        if job["status"] == "failed":
+            print(f"\n❌ 任务失败: {job['error']}")
+            return False
+
+        time.sleep(POLL_INTERVAL)
+
+    print("❌ 等待超时")
+    return False
+
+
+def main():
+    """主测试函数"""
+    print("=" * 50)
+    print("DeepSeek-OCR 异步任务测试")
+    print("=" * 50)
+    print(f"API 地址: {API_BASE_URL}")
+
+    try:
+        task_id = submit_job()
+        success = task_id is not None and wait_for_job(task_id)
+    except requests.exceptions.ConnectionError:
+        print(f"\n❌ 无法连接到 API 服务: {API_BASE_URL}")
+        print("请确保服务正在运行")
+        sys.exit(1)
+
+    if success:
+        print("\n✅ 测试通过！")
+        sys.exit(0)
+    else:
+        print("\n❌ 测试失败")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
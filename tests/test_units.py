@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+单元测试：不启动服务、不需要模型权重，直接导入 app.py 测试其中的纯逻辑
+
+使用 fake 推理后端（INFERENCE_BACKEND=fake），并切换到临时目录导入，uploads/、outputs/ 等不写入仓库。
+覆盖页码范围、结果缓存、准入控制、请求去重、下载的 Range / If-Range 以及文件保留清理。
+"""
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+WORKDIR = tempfile.mkdtemp(prefix="ocr-units-")
+os.environ["INFERENCE_BACKEND"] = "fake"
+os.chdir(WORKDIR)
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+
+class PageSpecTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(app.parse_page_spec("1-3,10,-1"), [(1, 3), (10, 10), (-1, -1)])
+        self.assertEqual(app.parse_page_spec("5-"), [(5, -1)])
+        self.assertEqual(app.parse_page_spec(" 2 , 4 "), [(2, 2), (4, 4)])
+
+    def test_parse_invalid(self):
+        for spec in ("", "a", "1-2-3", "0", "1-0", "1,,2"):
+            with self.subTest(spec=spec), self.assertRaises(app.PageRangeError):
+                app.parse_page_spec(spec)
+
+    def test_select(self):
+        self.assertEqual(app.select_pages("1-3,10,-1", 12), [1, 2, 3, 10, 12])
+        self.assertEqual(app.select_pages("5-", 7), [5, 6, 7])
+        self.assertEqual(app.select_pages("-2-", 7), [6, 7])
+        self.assertEqual(app.select_pages("2,1-3,2", 5), [1, 2, 3])
+
+    def test_select_out_of_range(self):
+        for spec in ("8", "1-8", "-8", "3-2"):
+            with self.subTest(spec=spec), self.assertRaises(app.PageRangeError):
+                app.select_pages(spec, 7)
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(tempfile.mkdtemp(dir=WORKDIR))
+
+    def result(self, text="hello"):
+        return app.OCRResult(text=text, image_size=(100, 200), output_tokens=3, vision_tokens=64)
+
+    def test_make_key(self):
+        settings = {"prompt": "p", "base_size": 640, "image_size": 640, "crop_mode": False}
+        key = app.ResultCache.make_key("abc", settings, "r1")
+        self.assertEqual(key, app.ResultCache.make_key("abc", dict(reversed(settings.items())), "r1"))
+        self.assertNotEqual(key, app.ResultCache.make_key("abc", settings, "r2"))
+        self.assertNotEqual(key, app.ResultCache.make_key("abd", settings, "r1"))
+
+    def test_roundtrip(self):
+        cache = app.ResultCache(self.cache_dir)
+        self.assertIsNone(cache.get("k"))
+        cache.put("k", [self.result("a"), self.result("b")])
+        pages = cache.get("k")
+        self.assertEqual([p.text for p in pages], ["a", "b"])
+        self.assertEqual(pages[0].image_size, (100, 200))
+        self.assertEqual(pages[0].output_tokens, 3)
+
+    def test_disk_hit_after_memory_eviction(self):
+        cache = app.ResultCache(self.cache_dir, memory_entries=1)
+        cache.put("k1", [self.result("one")])
+        cache.put("k2", [self.result("two")])
+        self.assertNotIn("k1", cache._memory)
+        self.assertEqual(cache.get("k1")[0].text, "one")
+        # 新实例从磁盘读取
+        self.assertEqual(app.ResultCache(self.cache_dir).get("k2")[0].text, "two")
+
+    def test_disk_eviction(self):
+        cache = app.ResultCache(self.cache_dir, disk_bytes=1)
+        cache.put("k1", [self.result("one")])
+        cache.put("k2", [self.result("two")])
+        self.assertEqual(list(self.cache_dir.glob("*.json")), [])
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_acquire_and_release(self):
+        controller = app.AdmissionController(max_requests=2, max_pages=0)
+        first = controller.acquire()
+        controller.acquire()
+        with self.assertRaises(HTTPException) as ctx:
+            controller.acquire()
+        self.assertEqual(ctx.exception.status_code, 429)
+        self.assertIn("Retry-After", ctx.exception.headers)
+
+        controller.release(first)
+        controller.release(first)  # 重复释放不重复计数
+        self.assertEqual(controller.requests, 1)
+        controller.acquire()
+
+    def test_reserve_pages(self):
+        controller = app.AdmissionController(max_requests=0, max_pages=10)
+        big = controller.acquire()
+        # 队列中只有一个请求时，超长文档也放行
+        controller.reserve(big, 30)
+        self.assertEqual(controller.pages, 30)
+        with self.assertRaises(HTTPException):
+            controller.acquire()
+
+        controller.release(big)
+        small = controller.acquire()
+        other = controller.acquire()
+        controller.reserve(small, 5)
+        with self.assertRaises(HTTPException) as ctx:
+            controller.reserve(other, 8)
+        self.assertEqual(ctx.exception.status_code, 429)
+        controller.page_done(small)
+        self.assertEqual(controller.pages, 5)
+        controller.release(small)
+        controller.release(other)
+        self.assertEqual((controller.requests, controller.pages), (0, 0))
+
+    def test_split(self):
+        controller = app.AdmissionController(max_requests=0, max_pages=0)
+        ticket = controller.acquire(pages=2)
+        items = [controller.split(ticket) for _ in range(3)]
+        # 前两项使用预占的页，第三项另计一页；分出的额度不计请求数
+        self.assertEqual((controller.requests, controller.pages), (1, 3))
+        controller.reserve(items[0], 4)
+        self.assertEqual(controller.pages, 6)
+        for item in items:
+            controller.release(item)
+        self.assertEqual((controller.requests, controller.pages), (1, 0))
+        controller.release(ticket)
+        self.assertEqual((controller.requests, controller.pages), (0, 0))
+
+
+class DuplicateJobTest(unittest.TestCase):
+    SETTINGS = {"prompt": "p", "base_size": 640, "image_size": 640, "crop_mode": False}
+
+    def setUp(self):
+        app.JOBS.clear()
+        app.INFLIGHT_JOBS.clear()
+        app.IDEMPOTENCY_KEYS.clear()
+
+    def key(self, content="abc"):
+        return app.make_request_key(content, self.SETTINGS, None, False, False)
+
+    def test_inflight(self):
+        self.assertIsNone(app.find_duplicate_job(self.key(), None))
+        job = app.create_job("t1", "a.png", self.SETTINGS, request_key=self.key())
+        self.assertEqual(app.find_duplicate_job(self.key(), None), (job, "inflight"))
+        self.assertIsNone(app.find_duplicate_job(self.key("other"), None))
+
+    def test_bypass_cache_not_inflight(self):
+        app.create_job("t1", "a.png", self.SETTINGS, bypass_cache=True, request_key=self.key())
+        self.assertIsNone(app.find_duplicate_job(self.key(), None))
+
+    def test_idempotency_key(self):
+        job = app.create_job("t1", "a.png", self.SETTINGS, request_key=self.key(), idempotency_key="k1")
+        job.status = "success"
+        self.assertEqual(app.find_duplicate_job(self.key(), "k1"), (job, "idempotency"))
+        with self.assertRaises(HTTPException) as ctx:
+            app.find_duplicate_job(self.key("other"), "k1")
+        self.assertEqual(ctx.exception.status_code, 422)
+        # 失败的任务不复用
+        job.status = "failed"
+        self.assertIsNone(app.find_duplicate_job(self.key("other"), "k1"))
+
+    def test_deadline(self):
+        now = time.monotonic()
+        job = app.create_job("t1", "a.png", self.SETTINGS, request_key=self.key())
+        job.deadline = now + 10
+        # 任务的截止时间早于新请求（或新请求没有截止时间）时不合并
+        self.assertIsNone(app.find_duplicate_job(self.key(), None))
+        self.assertIsNone(app.find_duplicate_job(self.key(), None, deadline=now + 20))
+        self.assertEqual(app.find_duplicate_job(self.key(), None, deadline=now + 5), (job, "inflight"))
+        # 带截止时间的 /jobs 请求不合并
+        job.deadline = None
+        self.assertIsNone(app.find_duplicate_job(self.key(), None, deadline=now + 5, detached=True))
+        self.assertEqual(app.find_duplicate_job(self.key(), None, detached=True), (job, "inflight"))
+
+
+class RangeTest(unittest.TestCase):
+    def test_parse_range(self):
+        self.assertEqual(app.parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(app.parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(app.parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(app.parse_range("bytes=-500", 100), (0, 99))
+        self.assertEqual(app.parse_range("bytes=50-500", 100), (50, 99))
+
+    def test_parse_range_ignored(self):
+        for header in ("items=0-9", "bytes=0-9,20-29", "bytes=a-b", "bytes=-", "bytes"):
+            with self.subTest(header=header):
+                self.assertIsNone(app.parse_range(header, 100))
+
+    def test_parse_range_unsatisfiable(self):
+        for header in ("bytes=100-", "bytes=20-10"):
+            with self.subTest(header=header), self.assertRaises(HTTPException) as ctx:
+                app.parse_range(header, 100)
+            self.assertEqual(ctx.exception.status_code, 416)
+            self.assertEqual(ctx.exception.headers["Content-Range"], "bytes */100")
+
+    def test_if_range(self):
+        path = Path(tempfile.mkstemp(dir=WORKDIR)[1])
+        stat = path.stat()
+        last_modified = app.email.utils.formatdate(stat.st_mtime, usegmt=True)
+        self.assertTrue(app.if_range_matches(None, "e1", stat))
+        self.assertTrue(app.if_range_matches('"e1"', "e1", stat))
+        self.assertFalse(app.if_range_matches('"e2"', "e1", stat))
+        self.assertFalse(app.if_range_matches('W/"e1"', "e1", stat))  # 弱 ETag 不满足强比较
+        self.assertTrue(app.if_range_matches(last_modified, "e1", stat))
+        self.assertFalse(app.if_range_matches(app.email.utils.formatdate(stat.st_mtime - 60, usegmt=True), "e1", stat))
+        self.assertFalse(app.if_range_matches("garbage", "e1", stat))
+
+
+class RetentionTest(unittest.TestCase):
+    def setUp(self):
+        root = Path(tempfile.mkdtemp(dir=WORKDIR))
+        self.upload_dir = root / "uploads"
+        self.output_dir = root / "outputs"
+        self.upload_dir.mkdir()
+        self.output_dir.mkdir()
+
+    def make_task(self, task_id, size, age):
+        """上传文件和输出目录各 size 字节，修改时间为 age 秒前"""
+        mtime = time.time() - age
+        upload = self.upload_dir / f"{task_id}.pdf"
+        upload.write_bytes(b"x" * size)
+        output = self.output_dir / task_id
+        output.mkdir()
+        (output / "result.md").write_bytes(b"x" * size)
+        for path in (upload, output / "result.md", output):
+            os.utime(path, (mtime, mtime))
+
+    def manager(self, ttl_hours=0, max_gb=0):
+        return app.RetentionManager(self.upload_dir, self.output_dir, ttl_hours=ttl_hours, max_gb=max_gb,
+                                    interval_seconds=60)
+
+    def test_ttl(self):
+        self.make_task("old", 10, age=7200)
+        self.make_task("new", 10, age=60)
+        self.make_task("running", 10, age=7200)
+        self.assertEqual(self.manager(ttl_hours=1).sweep({"running"}), {"old"})
+        self.assertEqual(sorted(p.name for p in self.output_dir.iterdir()), ["new", "running"])
+        self.assertEqual(sorted(p.name for p in self.upload_dir.iterdir()), ["new.pdf", "running.pdf"])
+
+    def test_quota(self):
+        self.make_task("t1", 400, age=300)
+        self.make_task("t2", 400, age=200)
+        self.make_task("t3", 400, age=100)
+        # 配额 1800 字节，共 2400 字节：从最旧的条目开始删除，直到不超过配额
+        expired = self.manager(max_gb=1800 / 1024 ** 3).sweep(set())
+        self.assertEqual(expired, {"t1"})
+        self.assertFalse((self.upload_dir / "t1.pdf").exists())
+        self.assertTrue((self.upload_dir / "t2.pdf").exists())
+        self.assertTrue((self.output_dir / "t2").exists())
+        self.assertTrue((self.output_dir / "t3").exists())
+
+
+class FakeBackendTest(unittest.TestCase):
+    def test_abstract_backend(self):
+        with self.assertRaises(TypeError):
+            app.InferenceBackend()
+
+    def test_infer_and_warmup(self):
+        backend = app.FakeBackend(vision_token_ms=0, output_token_ms=0, output_tokens=20)
+        backend.load()
+        settings = app.build_settings(None, 512, 512, False)
+        result = backend.infer_page(app.make_warmup_image(), settings)
+        self.assertGreater(result.output_tokens, 0)
+        self.assertGreaterEqual(backend.warmup(settings), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()